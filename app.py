@@ -1,9 +1,26 @@
-from flask import Flask, make_response, jsonify, request
+from flask import Flask, Response, make_response, jsonify, request, g, has_request_context
 import requests
 import hashlib
 import os
+import sys
+import json
+import mmap
+import struct
+import zlib
 import time
 import math
+import random
+import threading
+import socket
+import bisect
+import heapq
+import asyncio
+from array import array
+from urllib.parse import urlsplit, urlencode
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from kvs_client.placement import get_key_shard
 
 app = Flask(__name__)
 
@@ -32,45 +49,744 @@ def make_shard_groups():
 
     return shard_groups
 
+# This function will rebuild the shard groups for a new shard count, keeping every replica in its current group when it can
+# NOTE: with jump/ring placement most keys keep their shard id, so replicas that stay put also keep most of their data
+def rebalance_shard_groups(new_shard_count):
+    # Get globals
+    global shard_groups, view_list
+
+    # Every group gets len(view) / new_shard_count replicas, the first ones get the remainder
+    base, remainder = divmod(len(view_list), new_shard_count)
+    targets = [base + (1 if i < remainder else 0) for i in range(new_shard_count)]
+
+    # Keep current members of groups that still exist
+    new_shard_groups = {}
+    for i in range(new_shard_count):
+        new_shard_groups[i] = [replica for replica in (shard_groups or {}).get(i, []) if replica in view_list]
+    assigned = {replica for members in new_shard_groups.values() for replica in members}
+    unassigned = [replica for replica in view_list if replica not in assigned]
+
+    # Take extra replicas out of groups that are too big
+    for i in range(new_shard_count):
+        while len(new_shard_groups[i]) > targets[i]:
+            unassigned.append(new_shard_groups[i].pop())
+
+    # Hand them to groups that are too small
+    unassigned.sort()
+    for i in range(new_shard_count):
+        while len(new_shard_groups[i]) < targets[i]:
+            new_shard_groups[i].append(unassigned.pop(0))
+        new_shard_groups[i].sort()
+
+    return new_shard_groups
+
 # This function will get the shard number for a replica
 def get_shard_number(replica):
-    global view_list, shard_count
+    global view_list, shard_count, shard_groups
+
+    # Look it up in the shard groups first (add-member & reshard can move replicas out of their startup group)
+    for shard_id, members in (shard_groups or {}).items():
+        if replica in members:
+            return shard_id
+
+    if replica not in view_list:
+        return None
     return view_list.index(replica) % shard_count 
 
-# This function will find the shard group that a key will be assigned to
-def get_key_shard_desination(key):
+# This function will find the shard group that a key will be assigned to (count defaults to the current shard_count)
+# NOTE: the placement strategies live in kvs_client/placement.py, so the client library routes keys exactly like the replicas do
+def get_key_shard_desination(key, count=None):
     global shard_count
-    key_hash = int(hashlib.md5(key.encode()).hexdigest(), 16)
-    return hash(key_hash) % shard_count
+    if count is None:
+        count = shard_count
+    return get_key_shard(key, count, PLACEMENT_STRATEGY, PLACEMENT_VNODES)
 
 
 # ================================================================================================================
 # ----------------------------------------------------------------------------------------------------------------
-# HELPER FUNCTIONS:                   BROADCASTING UPDATES TO VIEW
+# HELPER FUNCTIONS:                  NETWORK ENGINE (CALLS TO OTHER REPLICAS)
 # ----------------------------------------------------------------------------------------------------------------
 # ================================================================================================================
 
 
-# This function will broadcast a view update to everyone in the view_list
-def broadcast_view(method, replica_address):
-    # Get gloabls
-    global view_list, my_socket_address
+# NOTE: NETWORK_ENGINE=threads sends every call to another replica with requests (a pooled session per replica, a thread per call in a fan-out)
+# NETWORK_ENGINE=asyncio sends them from one event loop thread over pooled keep-alive connections instead, so a fan-out to N replicas is
+# N coroutines, not N threads, and any number of calls can be in flight at once. Either way callers get a response with
+# status_code, headers, content & json(), and the same requests.exceptions when a replica can't be reached or times out
+# With threads every replica gets its own pool of REPLICATION_POOL_SIZE threads, so calls hung on one replica can't hold the
+# threads calls to the others need (gossip has a pool of its own & heartbeats don't go through the engine at all, see heartbeat_loop)
 
-    # Broadcast to everyone 
-    for replica in view_list[:]:
-        if replica != my_socket_address:
-                try:
-                    data = {'socket-address': replica_address}
-                    url = f"http://{replica}/view"
-                    if method == 'PUT':
-                        requests.put(url, json=data, timeout=1)
-                    elif method == 'DELETE':
-                        requests.delete(url, json=data, timeout=10)
+# This class is the response of a call made by the asyncio engine (the part of requests.Response the callers use)
+class PeerResponse:
+    __slots__ = ('status_code', 'headers', 'content')
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error from a replica", response=self)
+
+# This class stands in for a requests.Session to one replica when the asyncio engine is used
+class AsyncPeerSession:
+    def request(self, method, url, json=None, params=None, headers=None, timeout=None, data=None):
+        return run_on_network_loop(peer_request(method, url, json=json, params=params, headers=headers, timeout=timeout, data=data))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+# This function will return the event loop of the asyncio engine, starting its thread the first time
+def get_network_loop():
+    # Get globals
+    global network_loop
+
+    with network_loop_lock:
+        if network_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            network_loop = loop
+    return network_loop
+
+# This function will run a coroutine on the engine's event loop & wait for its result (never call it from the loop itself)
+def run_on_network_loop(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_network_loop()).result()
+
+# This coroutine will make one HTTP call to another replica within timeout (seconds)
+async def peer_request(method, url, json=None, params=None, headers=None, timeout=None, data=None):
+    try:
+        return await asyncio.wait_for(send_peer_request(method, url, json, params, headers, data), timeout)
+    except asyncio.TimeoutError:
+        raise requests.exceptions.Timeout(f"{method} {url} timed out after {timeout}s")
+    except (OSError, EOFError, ValueError) as e:
+        raise requests.exceptions.ConnectionError(f"{method} {url} failed: {e}")
+
+# This coroutine will send a request over a pooled connection & read the response
+# NOTE: a pooled connection the replica already closed fails before any response, so the request is retried once on a new one
+async def send_peer_request(method, url, json_data, params, headers, data):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    query = '&'.join(part for part in (parts.query, urlencode(params) if params else '') if part)
+    if query:
+        path = f"{path}?{query}"
+
+    body = data if data is not None else (json.dumps(json_data).encode() if json_data is not None else b'')
+    head = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}", f"Content-Length: {len(body)}"]
+    if json_data is not None and data is None:
+        head.append('Content-Type: application/json')
+    for name, value in (headers or {}).items():
+        head.append(f"{name}: {value}")
+    message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+    for attempt in range(2):
+        reader, writer, reused = await open_peer_connection(parts.netloc)
+        try:
+            writer.write(message)
+            await writer.drain()
+            response, keep_alive = await read_peer_response(reader, method)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            if reused and attempt == 0:
+                continue
+            raise ConnectionError(str(e))
+        except BaseException:
+            # Timed out (cancelled) in the middle of a response, the connection can't be used again
+            writer.close()
+            raise
+        release_peer_connection(parts.netloc, reader, writer, keep_alive)
+        return response
+
+# This coroutine will return an idle pooled connection to a replica (or a new one) & whether it was reused
+# NOTE: the pools are only touched from the event loop thread, so they need no lock
+async def open_peer_connection(host):
+    pool = network_connections.setdefault(host, [])
+    while len(pool) > 0:
+        reader, writer = pool.pop()
+        if not writer.is_closing() and not reader.at_eof():
+            return reader, writer, True
+        writer.close()
+    hostname, port = host.rsplit(':', 1)
+    reader, writer = await asyncio.open_connection(hostname, int(port))
+    return reader, writer, False
+
+# This function will put a connection back in its replica's pool (keeping at most REPLICATION_POOL_SIZE idle ones)
+def release_peer_connection(host, reader, writer, keep_alive):
+    pool = network_connections.setdefault(host, [])
+    if keep_alive and len(pool) < REPLICATION_POOL_SIZE:
+        pool.append((reader, writer))
+    else:
+        writer.close()
+
+# This coroutine will read an HTTP/1.1 response (Content-Length, chunked or until the connection closes)
+# Returns the response & whether the connection can be used again
+async def read_peer_response(reader, method):
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    version, status = head[0].split(' ', 2)[:2]
+    headers = requests.structures.CaseInsensitiveDict()
+    for line in head[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip()] = value.strip()
+    keep_alive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+
+    status = int(status)
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'Content-Length' in headers:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    # The body is decoded already, the hop-by-hop headers don't apply to whoever gets this response next
+    for name in ('Transfer-Encoding', 'Connection', 'Keep-Alive'):
+        headers.pop(name, None)
+    headers['Content-Length'] = str(len(body))
+    return PeerResponse(status, headers, body), keep_alive
+
+# This function will return the thread pool calls to a replica run on with the threads engine, creating it the first time
+def get_peer_pool(replica):
+    # Get globals
+    global peer_pools
+
+    with peer_pools_lock:
+        pool = peer_pools.get(replica)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=REPLICATION_POOL_SIZE)
+            peer_pools[replica] = pool
+    return pool
+
+# This function will make one call to another replica with the selected network engine
+def peer_call(method, url, **kwargs):
+    return get_peer_session(urlsplit(url).netloc).request(method, url, **kwargs)
+
+# This function will make many calls to other replicas at the same time, calls are (method, url, {json, params, headers, timeout, ...})
+# Returns their responses in order, with the exception instead of the response for a call that failed
+# NOTE: with abandon(replica), a call still running once abandon says so (e.g. the failure detector took the replica out) isn't waited on,
+# it fails with a ConnectionError right away. With handoff (seconds), a call still running after that long isn't waited on either,
+# its response is None & the caller delivers it another way. With timings (a list), the seconds each call took are appended to it
+# (None if abandoned or handed off). Calls run on the threads of their replica's pool, or of pool if one is given
+def fan_out(calls, abandon=None, timings=None, handoff=None, pool=None):
+    if len(calls) == 0:
+        return []
+    replicas = [urlsplit(url).netloc for _, url, _ in calls]
+    started = time.perf_counter()
+    finished = [None] * len(calls)
+    if NETWORK_ENGINE == 'asyncio':
+        async def send(i, method, url, kwargs):
+            try:
+                return await peer_request(method, url, **kwargs)
+            finally:
+                finished[i] = time.perf_counter()
+
+        async def send_all():
+            tasks = [asyncio.ensure_future(send(i, method, url, kwargs)) for i, (method, url, kwargs) in enumerate(calls)]
+            pending = set(tasks)
+            abandoned = set()
+            handed_off = set()
+            while len(pending) > 0:
+                _, pending = await asyncio.wait(pending, timeout=None if abandon is None and handoff is None else FAN_OUT_POLL_INTERVAL)
+                late = handoff is not None and time.perf_counter() - started >= handoff
+                for i, task in enumerate(tasks):
+                    if task not in pending:
+                        continue
+                    if abandon is not None and abandon(replicas[i]):
+                        abandoned.add(task)
+                    elif late:
+                        handed_off.add(task)
                     else:
-                        return make_response(jsonify({'error': 'Server error'}), 500)
-                except requests.exceptions.RequestException as e:
-                    # No need to delete/broadcast replica bc it will eventually get detected kvs broadcast
-                    print(f"Exception caught in broadcast_view() to {replica}: {e}")
+                        continue
+                    task.cancel()
+                    pending.discard(task)
+            results = []
+            for replica, task in zip(replicas, tasks):
+                if task in abandoned:
+                    results.append(requests.exceptions.ConnectionError(f"{replica} was taken out of the view"))
+                elif task in handed_off:
+                    results.append(None)
+                else:
+                    results.append(task.exception() or task.result())
+            if timings is not None:
+                timings.extend(None if task in abandoned or task in handed_off else finished[i] - started for i, task in enumerate(tasks))
+            return results
+        return run_on_network_loop(send_all())
+
+    def send(i, method, url, kwargs):
+        try:
+            return peer_call(method, url, **kwargs)
+        finally:
+            finished[i] = time.perf_counter()
+
+    futures = [(pool or get_peer_pool(replica)).submit(send, i, method, url, kwargs) for i, (replica, (method, url, kwargs)) in enumerate(zip(replicas, calls))]
+    pending = set(futures)
+    abandoned = set()
+    handed_off = set()
+    while len(pending) > 0:
+        _, pending = wait(pending, timeout=None if abandon is None and handoff is None else FAN_OUT_POLL_INTERVAL)
+        late = handoff is not None and time.perf_counter() - started >= handoff
+        for i, future in enumerate(futures):
+            if future not in pending:
+                continue
+            if abandon is not None and abandon(replicas[i]):
+                abandoned.add(future)
+            elif late:
+                handed_off.add(future)
+            else:
+                continue
+            # A call that already started keeps its thread (of its replica's pool) until it times out, one still queued never runs
+            future.cancel()
+            pending.discard(future)
+    results = []
+    for replica, future in zip(replicas, futures):
+        if future in abandoned:
+            results.append(requests.exceptions.ConnectionError(f"{replica} was taken out of the view"))
+            continue
+        if future in handed_off:
+            results.append(None)
+            continue
+        try:
+            results.append(future.result())
+        except requests.exceptions.RequestException as e:
+            results.append(e)
+    if timings is not None:
+        timings.extend(None if future in abandoned or future in handed_off else finished[i] - started for i, future in enumerate(futures))
+    return results
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                    METRICS (PROMETHEUS TEXT FORMAT)
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# NOTE: metrics are kept in memory & exposed at GET /metrics in the Prometheus text format, labels are tuples of (name, value) pairs
+# Counters & histograms are updated in place under metrics_lock (a dict lookup & a few adds per observation),
+# gauges (key count, queue depths, ...) are only read when /metrics is scraped
+
+# This function will add to a counter
+def count_metric(name, labels=(), amount=1):
+    with metrics_lock:
+        metric_counters[(name, labels)] = metric_counters.get((name, labels), 0) + amount
+
+# This function will add an observation (in seconds) to a histogram with the METRICS_BUCKETS buckets
+def observe_metric(name, seconds, labels=()):
+    bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+    with metrics_lock:
+        histogram = metric_histograms.get((name, labels))
+        if histogram is None:
+            histogram = metric_histograms[(name, labels)] = {'buckets': [0] * (len(METRICS_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+        histogram['buckets'][bucket] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+# This function will return the gauges, read from the current state: [(name, labels, value)]
+def get_metric_gauges():
+    gauges = [
+        ('kvs_keys', (), len(key_value_store)),
+        ('kvs_store_bytes', (), get_store_bytes()),
+        ('kvs_vector_clock_entries', (), len(vector_clock.to_dict())),
+        ('kvs_hold_back_queue_updates', (), sum(len(updates) for updates in list(hold_back_queue.values()))),
+        ('kvs_view_replicas', (), len(view_list)),
+        ('kvs_routing_epoch', (), routing_epoch),
+        ('kvs_ready', (), int(startup_done and not joining_shard)),
+        ('kvs_wal_failed', (), int(wal_error is not None)),
+    ]
+    for replica, status in get_replication_status().items():
+        gauges.append(('kvs_replication_queue_depth', (('peer', replica),), status['depth']))
+        gauges.append(('kvs_replication_lag_seconds', (('peer', replica),), status['lag']))
+    with forwarding_lock:
+        for replica, outstanding in forwarding_outstanding.items():
+            gauges.append(('kvs_forward_outstanding', (('peer', replica),), outstanding))
+    return gauges
+
+# This function will estimate the bytes the kvs holds (keys & JSON encoded values) from METRICS_SAMPLE_SIZE keys picked at random
+def get_store_bytes():
+    with storage_lock:
+        keys = key_index.sample(METRICS_SAMPLE_SIZE)
+        sizes = [len(key.encode()) + len(json.dumps(key_value_store[key]).encode()) for key in keys if key in key_value_store]
+        count = len(key_value_store)
+    if len(sizes) == 0:
+        return 0
+    return int(sum(sizes) / len(sizes) * count)
+
+# This function will format labels for the text format
+def format_metric_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+# This function will render every metric in the Prometheus text format
+def render_metrics():
+    with metrics_lock:
+        counters = sorted(metric_counters.items())
+        histograms = sorted((key, {'buckets': histogram['buckets'][:], 'sum': histogram['sum'], 'count': histogram['count']}) for key, histogram in metric_histograms.items())
+
+    lines = []
+    typed = set()
+    def add_type(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        add_type(name, 'counter')
+        lines.append(f"{name}{format_metric_labels(labels)} {value}")
+
+    for (name, labels), histogram in histograms:
+        add_type(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{format_metric_labels(labels)} {histogram['count']}")
+
+    for name, labels, value in sorted(get_metric_gauges()):
+        add_type(name, 'gauge')
+        lines.append(f"{name}{format_metric_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+# This function will remember when a request started, for its latency
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# This function will count every request & record its latency by route (& for /kvs, whether it was served here or forwarded)
+# NOTE: registered before the other after_request hooks so it runs after them (the wait for durable writes is included)
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    count_metric('kvs_http_requests_total', (('route', route), ('method', request.method), ('status', str(response.status_code))))
+    observe_metric('kvs_http_request_seconds', elapsed, (('route', route), ('method', request.method)))
+    if route == '/kvs/<key>':
+        observe_metric('kvs_key_request_seconds', elapsed, (('method', request.method), ('path', g.get('kvs_path', 'local'))))
+    return response
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                REQUEST TRACING & SAMPLING PROFILER
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# NOTE: a /kvs request is traced when it carries a Trace-Id header (or TRACE_SAMPLE_RATE of client requests that don't),
+# every step of it is timed as a span (name, seconds, where) & the breakdown goes back in the Server-Timing header & to the log.
+# The Trace-Id is passed on with forwards & replicated updates, so the replicas they reach trace their part under the same id
+# & their Server-Timing comes back in mine. Untraced requests only pay for a g lookup per span.
+
+# This function will return the trace of the request being handled, or None if it isn't traced
+def get_trace():
+    if not has_request_context():
+        return None
+    return g.get('trace')
+
+# This function will time a span of the request being handled (when it is traced)
+@contextmanager
+def trace_span(name, where=None):
+    trace = get_trace()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace['spans'].append((name, time.perf_counter() - started, where or my_socket_address))
+
+# This function will add the Trace-Id of the request being handled to the headers of a call to another replica
+def add_trace_header(headers):
+    trace = get_trace()
+    if trace is not None:
+        headers['Trace-Id'] = trace['id']
+    return headers
+
+# This function will add a span for each replica of a fan-out (see fan_out timings) & keep the spans they sent back
+def trace_fan_out(name, replicas, responses, timings):
+    trace = get_trace()
+    if trace is None:
+        return
+    for replica, response, elapsed in zip(replicas, responses, timings):
+        if elapsed is not None:
+            trace['spans'].append((name, elapsed, f"{my_socket_address} to {replica}"))
+        if response is not None and not isinstance(response, Exception) and response.headers.get('Server-Timing'):
+            trace['remote'].append(response.headers.get('Server-Timing'))
+
+# This function will start a trace for a /kvs request that asked for one (or was sampled)
+# NOTE: a Trace-Id is at most 64 letters, digits & dashes, anything else gets a new one
+@app.before_request
+def start_trace():
+    trace_id = request.headers.get('Trace-Id')
+    if trace_id is None:
+        if not request.path.startswith('/kvs') or 'Replica' in request.headers or random.random() >= TRACE_SAMPLE_RATE:
+            return
+        trace_id = os.urandom(8).hex()
+    elif len(trace_id) == 0 or len(trace_id) > 64 or not trace_id.replace('-', '').isalnum():
+        trace_id = os.urandom(8).hex()
+    g.trace = {'id': trace_id, 'spans': [], 'remote': [], 'started': time.perf_counter()}
+
+# This function will send the span breakdown of a traced request back in the Server-Timing header & log it
+@app.after_request
+def finish_trace(response):
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    trace['spans'].append(('total', time.perf_counter() - trace['started'], my_socket_address))
+    entries = [f'{name};dur={seconds * 1000:.3f};desc="{where}"' for name, seconds, where in trace['spans']]
+    entries += trace['remote']
+    if response.headers.get('Server-Timing'):
+        entries.append(response.headers.get('Server-Timing'))
+    response.headers['Server-Timing'] = ', '.join(entries)
+    response.headers['Trace-Id'] = trace['id']
+    breakdown = ' '.join(f"{name}={seconds * 1000:.3f}ms" + (f"({where})" if where != my_socket_address else '') for name, seconds, where in trace['spans'])
+    print(f"Trace {trace['id']}: {request.method} {request.path} {response.status_code} {breakdown}")
+    return response
+
+# This function will return a frame's name in a flame graph: function (file:first line)
+def get_frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+# This function will sample the stack of every thread (but mine) every interval seconds for the given seconds
+# Returns how many times each stack was seen ({'thread;outermost;...;innermost': count}) & how many samples were taken
+# NOTE: it samples wall-clock time, threads waiting on a lock, a socket or a sleep show up as much as running ones
+def sample_stacks(seconds, interval):
+    me = threading.get_ident()
+    stacks = {}
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(get_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f"thread-{ident}"))
+            stack = ';'.join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                      GOSSIP MEMBERSHIP (SWIM)
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# NOTE: every replica has a versioned entry in the membership table: its status ('alive' or 'dead') & an incarnation number
+# that only the replica itself bumps. The entry with the higher incarnation wins, at the same incarnation 'dead' wins over 'alive'.
+# A replica that hears it was declared dead refutes it with a higher incarnation (see rejoin_view).
+# A change is piggybacked on the next GOSSIP_RETRANSMIT_MULT * log2(n) gossip messages & heartbeat answers, gossip goes to
+# GOSSIP_FANOUT random replicas every GOSSIP_INTERVAL seconds, so it reaches everyone in O(log n) rounds (not one call per replica)
+
+# This function will return my entry of a replica in the membership table, as it is gossiped
+def get_member_entry(replica):
+    entry = membership.get(replica, {'status': 'alive', 'incarnation': 0})
+    return {'socket-address': replica, 'status': entry['status'], 'incarnation': entry['incarnation']}
+
+# This function will return my whole membership table, as it is gossiped
+def get_membership_table():
+    with routing_lock:
+        return [get_member_entry(replica) for replica in membership]
+
+# This function will queue a replica's entry to be piggybacked on the next GOSSIP_RETRANSMIT_MULT * log2(n) gossip messages
+def queue_member_update(replica):
+    with routing_lock:
+        gossip_queue[replica] = GOSSIP_RETRANSMIT_MULT * max(1, math.ceil(math.log2(len(membership) + 1)))
+
+# This function will apply a membership entry if it is newer than mine (adding it to or taking it out of the view & shard groups)
+# & queue it to be gossiped on, returns whether it was applied
+def apply_member_entry(replica, status, incarnation):
+    # Get globals
+    global view_list, shard_groups
+
+    with routing_lock:
+        entry = membership.get(replica)
+        if entry is not None:
+            if incarnation < entry['incarnation']:
+                return False
+            if incarnation == entry['incarnation'] and (status == entry['status'] or status == 'alive'):
+                return False
+        membership[replica] = {'status': status, 'incarnation': incarnation}
+        queue_member_update(replica)
+
+        if status == 'alive':
+            if replica not in view_list:
+                view_list.append(replica)
+                view_list.sort()
+        else:
+            bad_replica_group = get_shard_number(replica) if shard_groups is not None else None
+            if replica in view_list:
+                view_list.remove(replica)
+            if bad_replica_group is not None and replica in shard_groups[bad_replica_group]:
+                shard_groups[bad_replica_group].remove(replica)
+                persist_routing()
+                scope_vector_clock()
+            print(f"New shard-groups: {shard_groups}")
+    return True
+
+# This function will take a replica out of the view & shard groups (at its current incarnation), returns whether it was in the view
+def remove_member(replica):
+    with routing_lock:
+        incarnation = membership.get(replica, {'incarnation': 0})['incarnation']
+        return apply_member_entry(replica, 'dead', incarnation)
+
+# This function will merge gossiped membership entries into mine
+# NOTE: an entry that says I'm dead isn't applied, I refute it instead (& catch up on the writes I missed)
+def merge_membership(entries):
+    refuted = None
+    for entry in entries or []:
+        if not isinstance(entry, dict):
+            continue
+        replica = entry.get('socket-address')
+        if replica is None or entry.get('status') not in ('alive', 'dead'):
+            continue
+        try:
+            incarnation = int(entry.get('incarnation', 0))
+        except (ValueError, TypeError):
+            continue
+        if replica == my_socket_address:
+            if entry['status'] == 'dead' and incarnation >= membership[my_socket_address]['incarnation']:
+                refuted = max(refuted or 0, incarnation)
+            continue
+        apply_member_entry(replica, entry['status'], incarnation)
+
+    if refuted is not None:
+        threading.Thread(target=rejoin_view, args=(refuted,), daemon=True).start()
+
+# This function will pick the membership updates to piggyback on a gossip message, the ones sent the fewest times first
+def pick_gossip_updates():
+    with routing_lock:
+        replicas = sorted(gossip_queue, key=lambda replica: -gossip_queue[replica])[:GOSSIP_MAX_UPDATES]
+        for replica in replicas:
+            gossip_queue[replica] -= 1
+            if gossip_queue[replica] <= 0:
+                del gossip_queue[replica]
+        return [get_member_entry(replica) for replica in replicas]
+
+# This function will return what to piggyback on an answer to a replica: pending updates (or my whole table), plus its own entry
+# if I have it as dead (it doesn't know yet & has to refute it)
+def get_gossip_reply(sender, full_sync=False):
+    updates = get_membership_table() if full_sync else pick_gossip_updates()
+    if sender is not None and membership.get(sender, {}).get('status') == 'dead':
+        updates.append(get_member_entry(sender))
+    return updates
+
+# This function will gossip with GOSSIP_FANOUT random replicas of my view: sends them my pending updates (or my whole table
+# when full_sync) & merges what they send back, returns how many of them answered
+def gossip_round(full_sync=False, fanout=None):
+    peers = [replica for replica in view_list[:] if replica != my_socket_address]
+    targets = random.sample(peers, min(fanout or GOSSIP_FANOUT, len(peers)))
+    calls = []
+    for replica in targets:
+        updates = get_membership_table() if full_sync else pick_gossip_updates()
+        if len(updates) == 0:
+            continue
+        data = {'updates': updates, 'full': full_sync}
+        calls.append(('PUT', f"http://{replica}/gossip", {'json': data, 'headers': {'Replica': my_socket_address}, 'timeout': 1}))
+
+    answered = 0
+    for response in fan_out(calls, pool=gossip_pool):
+        # No need to remove an unreachable replica here, the failure detector finds it
+        if isinstance(response, Exception) or response.status_code != 200:
+            continue
+        try:
+            merge_membership(response.json().get('updates'))
+        except ValueError:
+            continue
+        answered += 1
+    return answered
+
+# This function runs in a background thread & gossips every GOSSIP_INTERVAL seconds
+# NOTE: every GOSSIP_SYNC_ROUNDS rounds the whole table is exchanged with one replica, in case an update ran out of sends too early
+def gossip_loop():
+    rounds = 0
+    while True:
+        time.sleep(GOSSIP_INTERVAL)
+        rounds += 1
+        if rounds % GOSSIP_SYNC_ROUNDS == 0:
+            gossip_round(full_sync=True, fanout=1)
+        else:
+            gossip_round()
+
+# This function will announce me to the view on startup: gossips my entry & swaps whole tables with GOSSIP_FANOUT replicas,
+# so I learn the current view (& find out if I was taken out of it before I went down)
+# NOTE: tried again with backoff until one of them answers, the rest of the view may still be starting up too
+def join_view():
+    # Get globals
+    global view_joined
+
+    with routing_lock:
+        membership.setdefault(my_socket_address, {'status': 'alive', 'incarnation': 0})
+        queue_member_update(my_socket_address)
+
+    attempt = 0
+    while any(replica != my_socket_address for replica in view_list[:]) and gossip_round(full_sync=True) == 0:
+        time.sleep(min(GOSSIP_INTERVAL * 2 ** attempt, STARTUP_MAX_BACKOFF))
+        attempt += 1
+    view_joined = True
+
+# This function runs in a background thread on startup, so I serve requests right away: joins the view, catches up on my shard
+# if I restarted from DATA_DIR & then marks me ready (see /ready)
+def start_node():
+    # Get globals
+    global startup_done
+
+    started = time.time()
+    join_view()
+    if recovered_from_disk and shard_number is not None:
+        rejoin_shard()
+    startup_done = True
+    print(f"Joined the view of {len(view_list)} replicas & ready after {time.time() - started:.2f}s")
+
+# This function brings me back after I was taken out of the view: gossips me as alive with an incarnation above the one
+# I was declared dead at & rejoins my shard group (it took me out of it too)
+def rejoin_view(dead_incarnation):
+    with routing_lock:
+        if membership[my_socket_address]['incarnation'] > dead_incarnation:
+            return
+        apply_member_entry(my_socket_address, 'alive', dead_incarnation + 1)
+    print(f"I was taken out of the view at incarnation {dead_incarnation}, refuting it & rejoining shard {shard_number}")
+    gossip_round()
+    if shard_number is not None and not joining_shard:
+        rejoin_shard()
 
 
 # ================================================================================================================
@@ -114,14 +830,11 @@ def view():
             return make_response(jsonify({"result": "already present"}), 200)
 
 
-        # Add new replica to view list
-        if socket_address not in view_list:
-            view_list.append(socket_address)
-            view_list.sort()
-
-        # Add new replica address in vector clock
-        if socket_address not in vector_clock:
-            vector_clock[socket_address] = 0
+        # Add new replica to view list (with an incarnation above the one it was taken out at) & gossip it
+        with routing_lock:
+            entry = membership.get(socket_address)
+            incarnation = 0 if entry is None else entry['incarnation'] + (entry['status'] == 'dead')
+            apply_member_entry(socket_address, 'alive', incarnation)
 
         # Make response
         return make_response(jsonify(data={"result": "added"}), 201)
@@ -132,20 +845,51 @@ def view():
         if socket_address is None:
             return make_response(jsonify({'error': 'Bad request, missing socket-address'}), 400)
 
-        # Check if socket-address exists in your view
-        if socket_address in view_list and socket_address != my_socket_address:
-            bad_replica_group = get_shard_number(socket_address)
-            view_list.remove(socket_address)
-            if socket_address in shard_groups[bad_replica_group]:
-                shard_groups[bad_replica_group].remove(socket_address)
-            print(f"New shard-groups: {shard_groups}")
-            return make_response(jsonify({"result": "deleted"}), 200)
+        # Check if socket-address exists in your view, take it out & gossip it
+        with routing_lock:
+            if socket_address in view_list and socket_address != my_socket_address:
+                remove_member(socket_address)
+                return make_response(jsonify({"result": "deleted"}), 200)
         
         return make_response(jsonify({"error": "View has no such replica"}), 404)
     else:
         return make_response(jsonify({'error': 'Server error'}), 500)
 
 
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                              /gossip, /membership & /ready endpoints
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint merges membership updates gossiped by a replica & answers with mine (my whole table if it sent its whole table)
+@app.route('/gossip', methods=['PUT'])
+def gossip():
+    # Get data from request
+    data = request.get_json(silent=True)
+    if data is None or not isinstance(data.get('updates'), list):
+        return make_response(jsonify({'error': 'Bad request, missing updates'}), 400)
+
+    merge_membership(data['updates'])
+    updates = get_gossip_reply(request.headers.get('Replica'), full_sync=bool(data.get('full')))
+    return make_response(jsonify({'updates': updates}), 200)
+
+# This endpoint reports my membership table, dead replicas included
+@app.route('/membership', methods=['GET'])
+def get_membership():
+    with routing_lock:
+        pending = len(gossip_queue)
+    return make_response(jsonify({'membership': get_membership_table(), 'pending-updates': pending}), 200)
+
+# This endpoint reports whether I'm ready for traffic: I joined the view & caught up on my shard (503 until then)
+@app.route('/ready', methods=['GET'])
+def ready():
+    is_ready = startup_done and not joining_shard
+    data = {'ready': is_ready, 'joined-view': view_joined, 'catching-up': joining_shard, 'shard': shard_number, 'epoch': routing_epoch}
+    return make_response(jsonify(data), 200 if is_ready else 503)
+
+
 # ================================================================================================================
 # ----------------------------------------------------------------------------------------------------------------
 # HELPER FUNCTIONS:                  VECTOR CLOCKS COMPARISON     
@@ -153,70 +897,1206 @@ def view():
 # ================================================================================================================
 
 
-# This function will update the replicas current position by 1
+# NOTE: every replica address gets a fixed slot the first time it is seen, a vector clock is an array of counters indexed by slot
+# Clocks are compared & merged in place, dicts are only built at the JSON boundaries (to_dict)
+
+# This function will return the slot of a replica address in every vector clock, giving it the next one if it has none
+def get_clock_slot(address):
+    slot = clock_slots.get(address)
+    if slot is None:
+        with clock_slots_lock:
+            slot = clock_slots.get(address)
+            if slot is None:
+                slot = len(clock_addresses)
+                clock_addresses.append(address)
+                clock_slots[address] = slot
+    return slot
+
+# This class is a vector clock backed by an array of counters, one per slot
+# NOTE: other clocks can be VectorClocks or dicts (e.g. causal metadata from a request)
+class VectorClock:
+    __slots__ = ('counters',)
+
+    def __init__(self, entries=None):
+        self.counters = array('q')
+        if entries:
+            self.merge(entries)
+
+    # This function will return the counter of a replica (0 if it has none)
+    def get(self, address, default=0):
+        slot = clock_slots.get(address)
+        if slot is None or slot >= len(self.counters):
+            return default
+        return self.counters[slot]
+
+    # This function will set the counter of a replica
+    def set(self, address, counter):
+        slot = get_clock_slot(address)
+        if slot >= len(self.counters):
+            self.counters.extend([0] * (slot + 1 - len(self.counters)))
+        self.counters[slot] = counter
+
+    # This function will add 1 to the counter of a replica & return it
+    def increment(self, address):
+        counter = self.get(address) + 1
+        self.set(address, counter)
+        return counter
+
+    # This function will raise the counter of a replica to counter if it is behind
+    def advance(self, address, counter):
+        if counter > self.get(address):
+            self.set(address, counter)
+
+    # This function will merge another clock into this one using point-wise maximum
+    def merge(self, other):
+        if isinstance(other, VectorClock):
+            counters, theirs = self.counters, other.counters
+            if len(theirs) > len(counters):
+                counters.extend([0] * (len(theirs) - len(counters)))
+            counters[:len(theirs)] = array('q', map(max, counters, theirs))
+        else:
+            for address, counter in other.items():
+                self.advance(address, counter)
+
+    # This function will merge many clocks into this one at once, in a single point-wise maximum over all of them
+    def merge_many(self, others):
+        clocks = [self.counters] + [other.counters if isinstance(other, VectorClock) else VectorClock(other).counters for other in others if other]
+        if len(clocks) == 1:
+            return
+        size = max(len(counters) for counters in clocks)
+        clocks = [counters if len(counters) == size else counters + array('q', [0] * (size - len(counters))) for counters in clocks]
+        self.counters = array('q', map(max, *clocks))
+
+    # This function will check that this clock has seen everything the other clock has, only looking at the given replicas
+    # NOTE: ignore is a replica the check skips (the sender of a replicated update)
+    def covers(self, other, addresses=None, ignore=None):
+        # Another VectorClock is compared slot by slot, without building a dict
+        if addresses is None and isinstance(other, VectorClock):
+            mine, skip = self.counters, clock_slots.get(ignore)
+            size = len(mine)
+            for slot, counter in enumerate(other.counters):
+                if counter > (mine[slot] if slot < size else 0) and slot != skip:
+                    return False
+            return True
+        for address in (other.keys() if addresses is None else addresses):
+            if address != ignore and other.get(address, 0) > self.get(address):
+                return False
+        return True
+
+    # This function will return the (non-zero) entries of this clock
+    def items(self):
+        return [(clock_addresses[slot], counter) for slot, counter in enumerate(self.counters) if counter > 0]
+
+    # This function will return the (non-zero) entries of this clock as a dict, ready for JSON
+    def to_dict(self):
+        return dict(self.items())
+
+    # This function will return a copy of this clock
+    def copy(self):
+        clock = VectorClock()
+        clock.counters = array('q', self.counters)
+        return clock
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+# NOTE: vector_clock only has (non-zero) entries for the replicas of my shard group, the only ones a dependency test looks at
+# Entries of replicas that left my shard group are kept aside in departed_clock (never sent anywhere) until they come back
+
+# This function will update the replicas current position by 1 & return it
 def update_vector_clock():
+    with state_lock:
+        return vector_clock.increment(my_socket_address)
+
+# This function will return the replicas whose entries belong in my vector clock (None if I'm not in a shard group yet)
+def get_clock_scope():
+    if shard_groups is None or shard_number is None:
+        return None
+    return set(shard_groups.get(shard_number, [])) | {my_socket_address}
+
+# This function will move the entries of replicas that left my shard group to departed_clock & bring back the ones that rejoined
+def scope_vector_clock():
     # Get globals
-    global vector_clock
-    # Update your socket address in vector clock
-    vector_clock[my_socket_address] += 1
+    global vector_clock, departed_clock
+
+    scope = get_clock_scope()
+    if scope is None:
+        return
+    with state_lock:
+        known = get_known_vector_clock()
+        scoped_vc, departed_vc = VectorClock(), VectorClock()
+        for address, counter in known.items():
+            (scoped_vc if address in scope else departed_vc).set(address, counter)
+        vector_clock, departed_clock = scoped_vc, departed_vc
+
+# This function will return the writes I know of from a replica, whether it is still in my shard group or not
+def known_counter(address):
+    return max(vector_clock.get(address), departed_clock.get(address))
+
+# This function will return every entry I know of, departed replicas included
+def get_known_vector_clock():
+    known = vector_clock.copy()
+    known.merge(departed_clock)
+    return known
+
+# This function will return every entry I know of as a dict (only sent to replicas)
+def get_known_clock():
+    return get_known_vector_clock().to_dict()
+
+# This function will build the causal metadata of a client response: what the client sent, my shard's entries & the key's dependencies
+# NOTE: entries of replicas that left the view are dropped, no dependency test looks at them anymore
+def get_response_metadata(causal_metadata, key=None):
+    metadata = {}
+    for clock in (causal_metadata or {}, vector_clock, key_dependencies.get(key, {})):
+        for address, counter in list(clock.items()):
+            if counter > metadata.get(address, 0) and address in view_list:
+                metadata[address] = counter
+    return metadata
+
+# This function will return the entries of a client's causal metadata that are outside my shard group (a write's dependencies)
+def get_foreign_dependencies(causal_metadata):
+    scope = get_clock_scope() or set()
+    dependencies = {address: counter for address, counter in (causal_metadata or {}).items() if address not in scope and counter > 0}
+    return dependencies or None
 
 # This function will do preform a dependency test for a client NOTE: VC2 is the vector_clock of the requesting client
 def dependency_test_client(VC2): 
-    # Get globals
-    global vector_clock, shard_groups, shard_number
-    VC1 = vector_clock.copy()
-
     # check if VC2 is empty
     if VC2 is None:
         return True
-    # Only compare addresses in view list (NOTE: We're not deleting vc info on replicas that are down)
-    for address in shard_groups[shard_number][:]:
-        if address in VC2:
-            if VC1[address] < VC2[address]:
-                return False
-    
-    return True
+
+    # Only compare addresses in my shard group (NOTE: the rest are the write's dependencies, not mine to check)
+    return vector_clock.covers(VC2, shard_groups[shard_number])
 
 # This function will do preform a dependency test for a client NOTE: VC2 is the vector_clock of the requesting replica and sender is the requesting replica socket-address
 def dependency_test_replica(VC2, sender): 
-    # Get global
-    global vector_clock, view_list
-    VC1 = vector_clock.copy()
-
     # Check that the sender vc is only 1 ahead of your vc
-    if VC2[sender] != VC1[sender] + 1:
+    if VC2.get(sender, 0) != known_counter(sender) + 1:
         return False
     
     # Check that the sender vc knows the same amount of writes as you
-    for key in shard_groups[shard_number][:]:
-        if key in VC2:
-            if key != sender and VC2[key] > VC1[key]:
-                return False
-    return True
+    return vector_clock.covers(VC2, shard_groups[shard_number], ignore=sender)
+
+# This function will merge vector clocks into mine using point-wise maximum technique 
+# NOTE: entries outside my shard group go to departed_clock, many clocks (e.g. at the end of a reshard) are merged in one pass
+def merge_vector_clocks(*clocks):
+    clocks = [clock for clock in clocks if clock]
+
+    # If there is no clock, then it's the first time a client requested a write, no need to merge 
+    if not clocks:
+        return
+    if len(clocks) > 1:
+        merged = VectorClock()
+        merged.merge_many(clocks)
+        clocks = [merged]
+
+    scope = get_clock_scope()
+    with trace_span('merge-vc'), state_lock:
+        for address, counter in clocks[0].items():
+            if scope is None or address in scope:
+                vector_clock.advance(address, counter)
+            else:
+                departed_clock.advance(address, counter)
 
-# This function will merge the vector clocks using point-wise maximum technique 
-def merge_vector_clocks(VC2):
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:            CAUSAL DELIVERY OF REPLICATED UPDATES (HOLD-BACK QUEUE)
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This function will apply a replicated update to the kvs & merge the sender's vector clock
+# NOTE: dependencies are the entries outside my shard group the write depended on, they are kept with the key
+def deliver_replicated_update(method, key, value, causal_metadata, sender, dependencies=None):
+    dot = (sender, causal_metadata.get(sender, 0))
+    with trace_span('local-write'), state_lock:
+        if method == 'PUT':
+            store_put(key, value, dot, dependencies)
+        else: # method == DELETE
+            store_delete(key, dot)
+
+        merge_vector_clocks(causal_metadata)
+        persist_vector_clock()
+        record_update(method, key, value, sender, causal_metadata.get(sender, 0), dependencies)
+
+# This function will deliver every held back update whose dependencies are now met
+# NOTE: only the update numbered (my vc entry for the sender + 1) can be next from each sender, so we only look at that one
+def drain_hold_back_queue():
     # Get globals
-    global vector_clock
-    
-    # If VC2 is none, then it's the first time a client requested a write, no need to merge 
-    if VC2 is not None:
-        merged_vc = {}
+    global hold_back_queue
+
+    delivered = True
+    while delivered:
+        delivered = False
+        with state_lock:
+            for sender in list(hold_back_queue.keys()):
+                pending = hold_back_queue[sender]
+
+                # Drop anything we already delivered (e.g. a retried message)
+                for counter in [c for c in pending if c <= known_counter(sender)]:
+                    del pending[counter]
+
+                update = pending.get(known_counter(sender) + 1)
+                if update is not None and dependency_test_replica(update[3], sender):
+                    del pending[known_counter(sender) + 1]
+                    method, key, value, causal_metadata, dependencies = update
+                    deliver_replicated_update(method, key, value, causal_metadata, sender, dependencies)
+                    delivered = True
+
+                if not pending:
+                    del hold_back_queue[sender]
+
+# This function will accept a replicated update from a replica in my shard group
+# It is delivered right away if its dependencies are met, otherwise it is held back until they are
+# Returns "delivered", "duplicate" or "buffered"
+# NOTE: drain=False lets a batch drain the hold-back queue once at the end instead of after every update
+def receive_replicated_update(method, key, value, causal_metadata, sender, drain=True, dependencies=None):
+    # Get globals
+    global hold_back_queue
+
+    counter = causal_metadata.get(sender, 0)
+
+    with state_lock:
+        # Still joining the shard group, updates from now on are newer than anything the snapshot gives me
+        if joining_shard:
+            join_fresh_keys.add(key)
+            deliver_replicated_update(method, key, value, causal_metadata, sender, dependencies)
+            return 'delivered'
+
+        # We already have this update
+        if counter <= known_counter(sender):
+            return 'duplicate'
+
+        # Dependencies are NOT met, hold it back (keyed by sender and the sender's position in its vector clock)
+        if not dependency_test_replica(causal_metadata, sender):
+            hold_back_queue.setdefault(sender, {})[counter] = (method, key, value, causal_metadata, dependencies)
+            print(f"Holding back {method} {key} from {sender} at {counter}")
+            count_metric('kvs_hold_back_buffered_total', (('peer', sender),))
+            return 'buffered'
+
+        # Dependencies ARE met, deliver it & anything that was waiting on it
+        deliver_replicated_update(method, key, value, causal_metadata, sender, dependencies)
+    if drain:
+        drain_hold_back_queue()
+    return 'delivered'
+
+# This function will accept an ordered batch of replicated updates from one replica as a unit
+# NOTE: after the first update, the causal metadata only has the entries that changed since the update before (see send_kvs_batch)
+# Returns how many updates were delivered, held back or already delivered
+def receive_replicated_batch(updates, sender):
+    results = {'delivered': 0, 'buffered': 0, 'duplicate': 0}
+    causal_metadata = {}
+    for update in updates:
+        if 'causal-metadata-delta' in update:
+            causal_metadata = {**causal_metadata, **update.get('causal-metadata-delta')}
+        else:
+            causal_metadata = update.get('causal-metadata')
+        result = receive_replicated_update(update.get('method'), update.get('key'), update.get('value'), causal_metadata, sender, drain=False, dependencies=update.get('dependencies'))
+        results[result] += 1
+
+    # Some of the batch may have unblocked updates that were already waiting
+    if results['delivered'] > 0:
+        drain_hold_back_queue()
+    return results
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                        ORDERED KEY INDEX
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This class keeps the keys of the kvs in order for scans, as a list of sorted sublists of about INDEX_LOAD keys each
+# Adding or removing a key is a binary search over the sublists' last keys & an insert into one sublist: O(log n + INDEX_LOAD)
+# A scan finds its first key the same way & walks on from there: O(log n + k) for k keys
+# NOTE: it is only changed through store_put, store_delete & store_drop (under storage_lock), scans take storage_lock too
+class SortedKeyIndex:
+    __slots__ = ('lists', 'maxes')
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.lists = [keys[i:i + INDEX_LOAD] for i in range(0, len(keys), INDEX_LOAD)]
+        self.maxes = [sublist[-1] for sublist in self.lists]
+
+    def __len__(self):
+        return sum(len(sublist) for sublist in self.lists)
+
+    def add(self, key):
+        if len(self.lists) == 0:
+            self.lists.append([key])
+            self.maxes.append(key)
+            return
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            # Bigger than every key, goes at the end of the last sublist
+            i -= 1
+            self.lists[i].append(key)
+            self.maxes[i] = key
+        else:
+            sublist = self.lists[i]
+            j = bisect.bisect_left(sublist, key)
+            if j < len(sublist) and sublist[j] == key:
+                return
+            sublist.insert(j, key)
+
+        # Split a sublist that grew too big in two
+        sublist = self.lists[i]
+        if len(sublist) > 2 * INDEX_LOAD:
+            self.lists.insert(i + 1, sublist[INDEX_LOAD:])
+            del sublist[INDEX_LOAD:]
+            self.maxes.insert(i, sublist[-1])
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return
+        sublist = self.lists[i]
+        j = bisect.bisect_left(sublist, key)
+        if j == len(sublist) or sublist[j] != key:
+            return
+        del sublist[j]
+        if len(sublist) == 0:
+            del self.lists[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = sublist[-1]
+
+    # This function will return count keys picked at random (about uniformly, the sublists are about the same size)
+    def sample(self, count):
+        if len(self.lists) == 0:
+            return []
+        return [random.choice(random.choice(self.lists)) for _ in range(count)]
+
+    # This function will return up to limit keys in order, starting at start (or right after after), before end & with prefix
+    def scan(self, start='', after=None, end=None, prefix='', limit=100):
+        # Begin at the greatest of start, the key after the cursor & the prefix
+        begin = max(start, prefix)
+        if after is not None and after >= begin:
+            begin = after
+        i = bisect.bisect_left(self.maxes, begin)
+        j = bisect.bisect_left(self.lists[i], begin) if i < len(self.lists) else 0
+
+        keys = []
+        while i < len(self.lists) and len(keys) < limit:
+            sublist = self.lists[i]
+            while j < len(sublist) and len(keys) < limit:
+                key = sublist[j]
+                j += 1
+                if key == after:
+                    continue
+                if (end is not None and key >= end) or not key.startswith(prefix):
+                    return keys
+                keys.append(key)
+            i += 1
+            j = 0
+        return keys
+
+
+# This function will walk over every key of the kvs in order, size keys at a time (never a copy of the whole key list)
+# NOTE: a key added or removed during the walk may or may not be seen, every key there the whole time is seen exactly once
+def walk_key_index(size):
+    after = None
+    while True:
+        with storage_lock:
+            keys = key_index.scan(after=after, limit=size)
+        if len(keys) == 0:
+            return
+        yield keys
+        after = keys[-1]
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                 STORAGE ENGINE (WRITE-AHEAD LOG & SNAPSHOTS)
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# NOTE: the kvs only goes to disk when DATA_DIR is set, otherwise these just update the dict
+# DATA_DIR holds a snapshot (kvs, key versions, vector clock & shard metadata at one point) & wal-<segment>.log files with every change after it
+
+# This function will write a key:value pair to the kvs & the write-ahead log
+# NOTE: dot is the (origin, counter) of the write, it becomes the key's version
+# dependencies are the entries outside my shard group the write depended on, reads of the key return them
+def store_put(key, value, dot, dependencies=None):
+    with storage_lock:
+        if key not in key_value_store:
+            key_index.add(key)
+        key_value_store[key] = value
+        set_key_version(key, dot)
+        set_key_dependencies(key, dependencies)
+        wal_append(['PUT', key, value, dot, dependencies])
+
+# This function will delete a key from the kvs & the write-ahead log, the key's version stays behind as a tombstone
+def store_delete(key, dot):
+    with storage_lock:
+        if key_value_store.pop(key, MISSING_VALUE) is not MISSING_VALUE:
+            key_index.remove(key)
+        set_key_version(key, dot)
+        set_key_dependencies(key, None)
+        wal_append(['DELETE', key, dot])
+
+# This function will forget a key that is not in my shard anymore, or a tombstone every replica has seen (no tombstone is left)
+def store_drop(key):
+    with storage_lock:
+        if key_value_store.pop(key, MISSING_VALUE) is not MISSING_VALUE:
+            key_index.remove(key)
+        set_key_version(key, None)
+        set_key_dependencies(key, None)
+        wal_append(['DROP', key])
+
+# This function will set (or forget, if there are none) the dependencies of a key
+def set_key_dependencies(key, dependencies):
+    if dependencies:
+        key_dependencies[key] = dependencies
+    else:
+        key_dependencies.pop(key, None)
 
-        # Merge keys from both vector clocks
-        all_keys = set(vector_clock.keys()).union(set(VC2.keys()))
+# This function will log the vector clock entries (departed ones included) that changed since the last time it was logged
+def persist_vector_clock():
+    # Get globals
+    global wal_vector_clock
+
+    if not DATA_DIR:
+        return
+    with storage_lock:
+        changed = {address: counter for address, counter in get_known_clock().items() if wal_vector_clock.get(address) != counter}
+        if len(changed) > 0:
+            wal_vector_clock.update(changed)
+            wal_append(['VC', changed])
+
+# This function will log the shard groups, shard count & routing epoch
+def persist_routing():
+    if not DATA_DIR or shard_groups is None:
+        return
+    with storage_lock:
+        wal_append(['ROUTING', {'shard-groups': shard_groups, 'shard-count': shard_count, 'epoch': routing_epoch}])
+
+# This function will hand a record to the wal writer thread (callers hold storage_lock so the log is in kvs order)
+# NOTE: the request doesn't wait here, wait_for_durable_writes() waits for it once before the response goes out
+def wal_append(record):
+    # Get globals
+    global wal_appended, wal_records_since_snapshot
+
+    if not DATA_DIR:
+        return
+    payload = json.dumps(record, separators=(',', ':')).encode()
+    with wal_cond:
+        # The log can't be written anymore, the request still gets a ticket so it is answered with 503
+        if wal_error is None:
+            wal_pending.append(struct.pack('>II', len(payload), zlib.crc32(payload)) + payload)
+        wal_appended += 1
+        wal_local.ticket = wal_appended
+        wal_cond.notify_all()
+
+    # Compact the log every SNAPSHOT_EVERY records
+    wal_records_since_snapshot += 1
+    if wal_records_since_snapshot >= SNAPSHOT_EVERY:
+        wal_records_since_snapshot = 0
+        request_snapshot()
+
+# This function will write & fsync everything appended to the log, one batch at a time (group commit)
+# NOTE: records appended while an fsync is running all go out with the next one
+# NOTE: if the disk fails (full, gone, read-only, ...) the log stops for good, waiting & later writes are answered with 503
+def wal_writer():
+    # Get globals
+    global wal_durable, wal_file, wal_error
 
-        # Iterate over all keys
-        for key in all_keys:
-            # Get values for the key from both vector clocks
-            value1 = vector_clock.get(key, 0)
-            value2 = VC2.get(key, 0)
+    while True:
+        with wal_cond:
+            while len(wal_pending) == 0:
+                wal_cond.wait()
+            batch = wal_pending[:]
+            del wal_pending[:]
+            appended = wal_appended
 
-            # Use point-wise maximum to merge values
-            merged_vc[key] = max(value1, value2)
+        try:
+            for item in batch:
+                if isinstance(item, bytes):
+                    wal_file.write(item)
+                else: # A snapshot started, the records after it go in a new segment
+                    wal_file.flush()
+                    os.fsync(wal_file.fileno())
+                    wal_file.close()
+                    wal_file = open(get_wal_path(item), 'ab')
+            wal_file.flush()
+            if WAL_FSYNC:
+                os.fsync(wal_file.fileno())
+        except OSError as e:
+            print(f"Unable to write the write-ahead log, writes are no longer durable: {e}")
+            count_metric('kvs_wal_failures_total')
+            with wal_cond:
+                wal_error = str(e)
+                del wal_pending[:]
+                wal_cond.notify_all()
+            return
+
+        with wal_cond:
+            wal_durable = appended
+            wal_cond.notify_all()
+
+# This function will wait until the writes made by this thread are on disk
+# Returns False if the log failed before they got there
+def wait_for_durable_writes():
+    ticket = getattr(wal_local, 'ticket', 0)
+    if ticket == 0:
+        return True
+    wal_local.ticket = 0
+    with wal_cond:
+        while wal_durable < ticket and wal_error is None:
+            wal_cond.wait()
+        return wal_durable >= ticket
+
+# This function will hold every response back until the writes it acknowledges are on disk
+@app.after_request
+def wait_for_durable_response(response):
+    with trace_span('wal-sync'):
+        durable = wait_for_durable_writes()
+    if not durable:
+        return make_response(jsonify({'error': f'Unable to write the write-ahead log: {wal_error}'}), 503)
+    return response
+
+# This function will return the path of a write-ahead log segment
+def get_wal_path(segment):
+    return os.path.join(DATA_DIR, f"wal-{segment}.log")
+
+# This function will start a snapshot in the background (unless one is already running, then that one runs again)
+def request_snapshot():
+    # Get globals
+    global snapshot_state
+
+    if not DATA_DIR:
+        return
+    with snapshot_lock:
+        if snapshot_state is not None:
+            snapshot_state = 'again'
+            return
+        snapshot_state = 'running'
+    threading.Thread(target=run_snapshots, daemon=True).start()
+
+def run_snapshots():
+    # Get globals
+    global snapshot_state
 
-        vector_clock.clear()
-        vector_clock = merged_vc
+    while True:
+        try:
+            take_snapshot()
+        except OSError as e:
+            print(f"Unable to write a snapshot to {DATA_DIR}: {e}")
+        with snapshot_lock:
+            if snapshot_state != 'again':
+                snapshot_state = None
+                return
+            snapshot_state = 'running'
+
+# This function will write the kvs, vector clock & shard metadata to DATA_DIR/snapshot & delete the log segments it covers
+# NOTE: only a shallow copy is made under the lock, writing the file happens while the kvs keeps taking writes
+def take_snapshot():
+    # Get globals
+    global wal_segment, wal_records_since_snapshot
+
+    with storage_lock:
+        wal_segment += 1
+        segment = wal_segment
+        with wal_cond:
+            wal_pending.append(segment)
+            wal_cond.notify_all()
+        kvs = key_value_store.copy()
+        versions = key_versions.copy()
+        dependencies = key_dependencies.copy()
+        meta = {'vc': get_known_clock(), 'wal-segment': segment}
+        if shard_groups is not None:
+            meta.update({'shard-groups': shard_groups, 'shard-count': shard_count, 'epoch': routing_epoch})
+        meta = json.dumps(meta).encode()
+        wal_records_since_snapshot = 0
+
+    # Write it next to the old one & swap them
+    path = os.path.join(DATA_DIR, 'snapshot')
+    # Every record is [version, value] (+ dependencies if it has any), or just [version] for a tombstone
+    with open(path + '.tmp', 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack('>Q', len(meta)) + meta)
+        for key in kvs.keys() | versions.keys():
+            if key not in kvs:
+                record = [versions.get(key)]
+            elif key in dependencies:
+                record = [versions.get(key), kvs[key], dependencies[key]]
+            else:
+                record = [versions.get(key), kvs[key]]
+            key = key.encode()
+            record = json.dumps(record).encode()
+            f.write(struct.pack('>I', len(key)) + key + struct.pack('>I', len(record)) + record)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+    # The older log segments are in the snapshot now
+    for name in os.listdir(DATA_DIR):
+        if name.startswith('wal-') and name.endswith('.log') and int(name[4:-4]) < segment:
+            os.remove(os.path.join(DATA_DIR, name))
+    print(f"Snapshot of {len(kvs)} keys written to {path}")
+
+# This function will read a snapshot through mmap, returns its metadata, kvs & key versions
+def load_snapshot(path):
+    kvs = {}
+    versions = {}
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not a snapshot")
+            offset = len(SNAPSHOT_MAGIC)
+            (meta_length,) = struct.unpack_from('>Q', mm, offset)
+            offset += 8
+            meta = json.loads(mm[offset:offset + meta_length])
+            offset += meta_length
+            while offset < len(mm):
+                (key_length,) = struct.unpack_from('>I', mm, offset)
+                key = mm[offset + 4:offset + 4 + key_length].decode()
+                offset += 4 + key_length
+                (record_length,) = struct.unpack_from('>I', mm, offset)
+                record = json.loads(mm[offset + 4:offset + 4 + record_length])
+                offset += 4 + record_length
+                if record[0] is not None:
+                    versions[key] = record[0]
+                if len(record) >= 2:
+                    kvs[key] = record[1]
+                if len(record) == 3:
+                    key_dependencies[key] = record[2]
+    return meta, kvs, versions
+
+# This function will replay a log segment into the kvs, stops at the first torn or corrupt record (a crash mid-write)
+# Returns how many records were replayed
+def replay_wal_segment(path):
+    # Get globals
+    global shard_groups, shard_count, routing_epoch
+
+    replayed = 0
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + 8 <= len(data):
+        length, crc = struct.unpack_from('>II', data, offset)
+        payload = data[offset + 8:offset + 8 + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            print(f"Stopped replaying {path} at a torn record")
+            break
+        offset += 8 + length
+        record = json.loads(payload)
+
+        if record[0] == 'PUT':
+            key_value_store[record[1]] = record[2]
+            set_key_version(record[1], record[3])
+            set_key_dependencies(record[1], record[4])
+        elif record[0] == 'DELETE':
+            key_value_store.pop(record[1], None)
+            set_key_version(record[1], record[2])
+            set_key_dependencies(record[1], None)
+        elif record[0] == 'DROP':
+            key_value_store.pop(record[1], None)
+            set_key_version(record[1], None)
+            set_key_dependencies(record[1], None)
+        elif record[0] == 'VC':
+            merge_vector_clocks(record[1])
+        elif record[0] == 'ROUTING':
+            shard_groups = {int(k): v for k, v in record[1]['shard-groups'].items()}
+            shard_count = record[1]['shard-count']
+            routing_epoch = record[1]['epoch']
+        replayed += 1
+    return replayed
+
+# This function will load the latest snapshot & replay the log after it, then start the wal writer on a new segment
+# Returns True if there was anything to recover
+def recover_from_disk():
+    # Get globals
+    global key_value_store, key_index, shard_groups, shard_count, shard_number, routing_epoch, wal_segment, wal_file, wal_vector_clock
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    recovered = False
+    first_segment = 0
+
+    # Load the snapshot
+    path = os.path.join(DATA_DIR, 'snapshot')
+    if os.path.exists(path):
+        meta, key_value_store, versions = load_snapshot(path)
+        for key, dot in versions.items():
+            set_key_version(key, dot)
+        merge_vector_clocks(meta.get('vc'))
+        if meta.get('shard-groups') is not None:
+            shard_groups = {int(k): v for k, v in meta.get('shard-groups').items()}
+            shard_count = meta.get('shard-count')
+            routing_epoch = meta.get('epoch')
+        first_segment = meta.get('wal-segment')
+        recovered = True
+
+    # Replay the log after it (older segments are left over from a crash right after a snapshot)
+    segments = sorted(int(name[4:-4]) for name in os.listdir(DATA_DIR) if name.startswith('wal-') and name.endswith('.log'))
+    for segment in segments:
+        if segment >= first_segment and replay_wal_segment(get_wal_path(segment)) > 0:
+            recovered = True
+
+    if shard_groups is not None:
+        shard_number = get_shard_number(my_socket_address)
+    scope_vector_clock()
+
+    # The snapshot & log were loaded straight into the kvs, index them once
+    key_index = SortedKeyIndex(key_value_store.keys())
+
+    # Start a new segment, the last one may end in a torn record
+    wal_segment = max([first_segment] + [segment + 1 for segment in segments])
+    wal_file = open(get_wal_path(wal_segment), 'ab')
+    wal_vector_clock = get_known_clock()
+    threading.Thread(target=wal_writer, daemon=True).start()
+
+    if recovered:
+        print(f"Recovered {len(key_value_store)} keys from {DATA_DIR}, vector clock: {vector_clock.to_dict()}")
+    return recovered
+
+# This function brings a replica that restarted from DATA_DIR (or was taken out of the view) back into its shard group
+# It only pulls the writes it missed (by their dots) from a peer, or the buckets that differ if the peer's log doesn't go back that far
+def rejoin_shard():
+    # Get globals
+    global joining_shard, join_fresh_keys
+
+    # From now on replicated updates are applied right away & the catch-up never overwrites them
+    with join_lock, state_lock:
+        join_fresh_keys = set()
+        joining_shard = True
+
+    # Get back in my shard group so the replicated writes come to me again
+    started = time.perf_counter()
+    broadcast_add_member(shard_number, my_socket_address)
+
+    for attempt in range(JOIN_ATTEMPTS):
+        if attempt > 0:
+            count_metric('kvs_populate_retries_total', (('kind', 'catch-up'),))
+        peers = [replica for replica in shard_groups.get(shard_number, []) if replica != my_socket_address]
+        for peer in peers:
+            try:
+                response = get_peer_session(peer).put(f"http://{peer}/populate/catch-up", json={'vc': get_known_clock()}, timeout=JOIN_TIMEOUT)
+                if response.status_code == 410:
+                    print(f"{peer} no longer has every write I missed, repairing from its Merkle tree")
+                    if run_anti_entropy(peer) is None:
+                        join_shard(peer)
+                        return
+                    with join_lock:
+                        joining_shard = False
+                    drain_hold_back_queue()
+                    return
+                if response.status_code != 200:
+                    raise ValueError(f"{peer} answered {response.status_code} to a catch-up")
+                data = response.json()
+                with state_lock:
+                    for update in data.get('updates'):
+                        if update['key'] in join_fresh_keys:
+                            continue
+                        dot = (update['origin'], update['counter'])
+                        if update['method'] == 'PUT':
+                            store_put(update['key'], update['value'], dot, update.get('dependencies'))
+                        else: # method == DELETE
+                            store_delete(update['key'], dot)
+                merge_vector_clocks(data.get('vc'))
+                persist_vector_clock()
+                with join_lock:
+                    joining_shard = False
+                drain_hold_back_queue()
+                observe_metric('kvs_populate_seconds', time.perf_counter() - started, (('kind', 'catch-up'),))
+                print(f"Caught up on {len(data.get('updates'))} missed writes from {peer}")
+                return
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Catch-up from {peer} failed: {e}")
+        if len(peers) == 0:
+            break
+        time.sleep(1)
+
+    # Nobody to catch up from, go with what I have
+    with join_lock:
+        joining_shard = False
+    drain_hold_back_queue()
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                 ANTI-ENTROPY (MERKLE TREE OF THE KEY SPACE)
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# NOTE: every key has a version, the (origin, counter) dot of the last write to it (deletes leave a tombstone version)
+# The key space is split into 2^MERKLE_DEPTH buckets by key hash, a bucket's hash is the XOR of hash(key, version) of its keys
+# so it is updated in place on every write. A tree node covers a range of buckets & its hash is the XOR of theirs
+# A tombstone is forgotten once the clock of every replica of my shard group covers its dot (see collect_tombstones), so a key
+# that is missing on one side although that side's clock covers the other side's version was deleted there & is not brought back
+
+# This function will return the Merkle bucket a key falls in
+def get_merkle_bucket(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], 'big') >> (32 - MERKLE_DEPTH)
+
+# This function will return the 64-bit hash of a key at a version
+def get_version_hash(key, dot):
+    return int.from_bytes(hashlib.md5(f"{key}\0{dot[0]}\0{dot[1]}".encode()).digest()[:8], 'big')
+
+# This function will set (or forget, if dot is None) the version of a key & update its Merkle bucket
+# NOTE: callers hold storage_lock
+def set_key_version(key, dot):
+    bucket = get_merkle_bucket(key)
+    old_dot = key_versions.pop(key, None)
+    if old_dot is not None:
+        merkle_leaves[bucket] ^= get_version_hash(key, old_dot)
+        merkle_bucket_keys[bucket].discard(key)
+    if dot is not None:
+        dot = (dot[0], int(dot[1]))
+        key_versions[key] = dot
+        merkle_leaves[bucket] ^= get_version_hash(key, dot)
+        merkle_bucket_keys[bucket].add(key)
+    if dot is not None and key not in key_value_store:
+        tombstone_keys.add(key)
+    else:
+        tombstone_keys.discard(key)
+
+# This function will return the hashes of some nodes at one level of my Merkle tree (level 0 is the root, MERKLE_DEPTH the buckets)
+def get_merkle_hashes(level, nodes):
+    width = 1 << (MERKLE_DEPTH - level)
+    leaves = merkle_leaves[:]
+    hashes = []
+    for node in nodes:
+        node_hash = 0
+        for leaf in leaves[node * width:(node + 1) * width]:
+            node_hash ^= leaf
+        hashes.append(node_hash)
+    return hashes
+
+# This function will return every key (& tombstone) in some buckets as {key: [origin, counter, value]} ([origin, counter] for a tombstone)
+# NOTE: a key with dependencies gets them as a 4th item
+def get_bucket_entries(buckets):
+    entries = {}
+    with storage_lock:
+        for bucket in buckets:
+            for key in merkle_bucket_keys[bucket]:
+                dot = key_versions[key]
+                if key in key_dependencies:
+                    entries[key] = [dot[0], dot[1], key_value_store[key], key_dependencies[key]]
+                elif key in key_value_store:
+                    entries[key] = [dot[0], dot[1], key_value_store[key]]
+                else:
+                    entries[key] = [dot[0], dot[1]]
+    return entries
+
+# This function decides if a peer's version of a key should replace mine
+# The version whose write the other side has already seen wins, concurrent ones are ordered by (counter, origin) so both sides pick the same
+def remote_version_wins(key, remote_dot, remote_vc):
+    local_dot = key_versions.get(key)
+    if local_dot is None:
+        return True
+    if local_dot == remote_dot:
+        return False
+    local_saw_remote = known_counter(remote_dot[0]) >= remote_dot[1]
+    remote_saw_local = remote_vc.get(local_dot[0], 0) >= local_dot[1]
+    if remote_saw_local and not local_saw_remote:
+        return True
+    if local_saw_remote and not remote_saw_local:
+        return False
+    return (remote_dot[1], remote_dot[0]) > (local_dot[1], local_dot[0])
+
+# This function will apply the entries a peer sent for some buckets wherever its version wins
+# Returns how many keys were repaired
+# NOTE: a key of these buckets the peer doesn't have, although its clock covers my version, was deleted there & its tombstone
+# collected, so I forget it too (& the other way around, I never take back a write I saw whose key I don't have anymore)
+def apply_bucket_entries(entries, remote_vc, buckets=()):
+    repaired = 0
+    for key, entry in entries.items():
+        # Not my key (anymore), the reshard takes care of it
+        if get_key_shard_desination(key) != shard_number:
+            continue
+        dot = (entry[0], int(entry[1]))
+        with state_lock:
+            if key not in key_versions and known_counter(dot[0]) >= dot[1]:
+                continue
+            if not remote_version_wins(key, dot, remote_vc):
+                continue
+            if len(entry) >= 3:
+                store_put(key, entry[2], dot, entry[3] if len(entry) == 4 else None)
+            else:
+                store_delete(key, dot)
+        repaired += 1
+
+    with storage_lock:
+        missing = [key for bucket in buckets for key in merkle_bucket_keys[bucket] if key not in entries]
+    for key in missing:
+        with state_lock:
+            dot = key_versions.get(key)
+            if dot is not None and remote_vc.get(dot[0], 0) >= dot[1]:
+                store_drop(key)
+                repaired += 1
+    return repaired
+
+# This function will forget the tombstones whose dot every replica of my shard group has seen (by the last clock it sent me)
+# Returns how many were collected
+# NOTE: a replica that never sent me its clock holds every tombstone back, a delete it missed could otherwise come back from it
+def collect_tombstones():
+    peers = [replica for replica in shard_groups.get(shard_number, []) if replica != my_socket_address]
+    clocks = [peer_clocks.get(replica) for replica in peers]
+    if any(clock is None for clock in clocks):
+        return 0
+
+    collected = 0
+    with state_lock:
+        clocks.append(get_known_clock())
+        with storage_lock:
+            candidates = [(key, key_versions[key]) for key in tombstone_keys]
+        for key, dot in candidates:
+            if all(clock.get(dot[0], 0) >= dot[1] for clock in clocks):
+                store_drop(key)
+                collected += 1
+    return collected
+
+# This function will compare my Merkle tree with a peer's & exchange only the buckets that differ (push-pull)
+# Returns how many keys were repaired here, or None if the peer doesn't have me in its view anymore
+# NOTE: push_vc sends my vc even when no bucket differs, so the peer takes it too
+def run_anti_entropy(peer, push_vc=False):
+    session = get_peer_session(peer)
+    url = f"http://{peer}/anti-entropy"
+    headers = {'Replica': my_socket_address}
+
+    # Take my vc first, the buckets I send cover at least the writes in it
+    with state_lock:
+        my_vc = get_known_clock()
+
+    # Get the root & the peer's vc (its tree covers at least the writes in it)
+    response = session.put(f"{url}/tree", json={'level': 0, 'nodes': [0]}, headers=headers, timeout=REPLICATION_TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    tree = response.json()
+    their_vc = tree.get('vc')
+
+    # Walk down the tree, only into the nodes that differ
+    level = 0
+    nodes = [0]
+    while True:
+        differing = [node for node, their_hash, my_hash in zip(nodes, tree.get('hashes'), get_merkle_hashes(level, nodes)) if their_hash != my_hash]
+        if len(differing) == 0 or level == MERKLE_DEPTH:
+            break
+        next_level = min(level + MERKLE_LEVELS_PER_ROUND, MERKLE_DEPTH)
+        fanout = 1 << (next_level - level)
+        nodes = [child for node in differing for child in range(node * fanout, (node + 1) * fanout)]
+        response = session.put(f"{url}/tree", json={'level': next_level, 'nodes': nodes}, headers=headers, timeout=REPLICATION_TIMEOUT)
+        response.raise_for_status()
+        tree = response.json()
+        level = next_level
+
+    # Send my side of the differing buckets & get theirs back
+    repaired = 0
+    if len(differing) > 0 or push_vc:
+        data = {'buckets': differing, 'entries': get_bucket_entries(differing), 'vc': my_vc}
+        response = session.put(f"{url}/buckets", json=data, headers=headers, timeout=REPLICATION_TIMEOUT)
+        response.raise_for_status()
+        repaired = apply_bucket_entries(response.json().get('entries'), their_vc, differing)
+    if len(differing) > 0:
+        print(f"Anti-entropy with {peer}: {len(differing)} buckets differed, repaired {repaired} keys here")
+
+    # I have everything their vc covers now
+    peer_clocks[peer] = their_vc
+    merge_vector_clocks(their_vc)
+    persist_vector_clock()
+    drain_hold_back_queue()
+    return repaired
+
+# This function will run anti-entropy with a random replica of my shard group every ANTI_ENTROPY_INTERVAL seconds
+def anti_entropy_loop():
+    while True:
+        time.sleep(ANTI_ENTROPY_INTERVAL * random.uniform(0.5, 1.5))
+
+        # Not while my shard's data is moving
+        if shard_number is None or joining_shard or pending_reshard is not None:
+            continue
+        peers = [replica for replica in shard_groups.get(shard_number, []) if replica != my_socket_address]
+        if len(peers) == 0:
+            continue
+        peer = random.choice(peers)
+        try:
+            if run_anti_entropy(peer) is None:
+                # I was taken out of the view while I was unreachable, get back in & catch up
+                print(f"{peer} no longer has me in its view")
+                rejoin_view(membership[my_socket_address]['incarnation'])
+                continue
+            collected = collect_tombstones()
+            if collected > 0:
+                print(f"Collected {collected} tombstones every replica of shard {shard_number} has seen")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Anti-entropy with {peer} failed: {e}")
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                 FAILURE DETECTOR (PHI ACCRUAL HEARTBEATS)
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# NOTE: every HEARTBEAT_INTERVAL seconds I send a heartbeat to the HEARTBEAT_PEERS replicas after me in the view & keep the last
+# PHI_WINDOW intervals between their answers (so every replica is watched by HEARTBEAT_PEERS others, not by everyone)
+# phi is how unlikely it is (-log10 of the probability) that a replica is still up given how long it has been silent, with the intervals
+# taken as normally distributed. A replica with phi above PHI_THRESHOLD is taken out of the view & shard groups right away & it is gossiped,
+# so kvs broadcasts & forwards stop waiting on it. A replica is only judged once it has answered a heartbeat (one that never came up
+# is still found by the timeouts of broadcasts & forwards)
+# Heartbeats are UDP datagrams to the port of the replica's socket address, sent & answered by threads of their own (heartbeat_loop
+# & heartbeat_listener), so they never wait behind client requests or calls to other replicas that are stuck on a hung replica
+
+# This function will return the replicas I send heartbeats to: the HEARTBEAT_PEERS after me in the (sorted) view, wrapping around
+def get_monitored_replicas():
+    replicas = view_list[:]
+    if my_socket_address in replicas:
+        i = replicas.index(my_socket_address)
+        replicas = replicas[i + 1:] + replicas[:i]
+    return replicas[:HEARTBEAT_PEERS]
+
+# This function will record that a replica answered a heartbeat at now
+def record_heartbeat(replica, now):
+    with heartbeat_lock:
+        history = heartbeat_histories.get(replica)
+        if history is None:
+            heartbeat_histories[replica] = {'intervals': deque(maxlen=PHI_WINDOW), 'last': now}
+            return
+        history['intervals'].append(now - history['last'])
+        history['last'] = now
+
+# This function will return the phi (suspicion level) of a replica at now, 0 if it never answered a heartbeat
+def get_phi(replica, now):
+    with heartbeat_lock:
+        history = heartbeat_histories.get(replica)
+        if history is None:
+            return 0.0
+        # A replica I just started watching is expected to answer every HEARTBEAT_INTERVAL until it has a history
+        intervals = list(history['intervals']) or [HEARTBEAT_INTERVAL]
+        silence = now - history['last']
+
+    mean = sum(intervals) / len(intervals)
+    deviation = max(math.sqrt(sum((interval - mean) ** 2 for interval in intervals) / len(intervals)), PHI_MIN_DEVIATION)
+    mean += PHI_ACCEPTABLE_PAUSE
+
+    # Logistic approximation of the normal distribution's tail (clamped, phi is ~38 at the edge already)
+    y = max(-10.0, min(10.0, (silence - mean) / deviation))
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if silence > mean:
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+# This function will return my answer to a heartbeat from a replica: whether it is still in my view & piggybacked membership updates
+def get_heartbeat_answer(sender):
+    return {'replica': my_socket_address, 'member': sender in view_list, 'epoch': routing_epoch, 'updates': get_gossip_reply(sender)}
+
+# This function will return the (host, port) a replica gets its heartbeats on (UDP, the port of its socket address)
+def get_heartbeat_address(replica):
+    host, port = replica.rsplit(':', 1)
+    return host, int(port)
+
+# This function runs in a background thread & answers the heartbeats sent to my UDP port
+def heartbeat_listener():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        listener.bind(('', get_heartbeat_address(my_socket_address)[1]))
+    except OSError as e:
+        print(f"Unable to listen for heartbeats on UDP port {get_heartbeat_address(my_socket_address)[1]}: {e}")
+        return
+
+    while True:
+        message, address = listener.recvfrom(HEARTBEAT_MAX_BYTES)
+        try:
+            heartbeat = json.loads(message)
+            answer = get_heartbeat_answer(heartbeat['replica'])
+            answer['seq'] = heartbeat['seq']
+        except (ValueError, KeyError, TypeError):
+            continue
+        try:
+            listener.sendto(json.dumps(answer).encode(), address)
+        except OSError as e:
+            print(f"Unable to answer a heartbeat from {address}: {e}")
+
+# This function runs in a background thread & sends a heartbeat to the replicas I watch every HEARTBEAT_INTERVAL seconds
+# NOTE: every heartbeat is numbered, an answer that comes after the next heartbeat was sent is too late & ignored
+def heartbeat_loop():
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    seq = 0
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        peers = get_monitored_replicas()
+        seq += 1
+        message = json.dumps({'replica': my_socket_address, 'seq': seq}).encode()
+        for replica in peers:
+            try:
+                sender.sendto(message, get_heartbeat_address(replica))
+            except (OSError, ValueError) as e:
+                print(f"Unable to send a heartbeat to {replica}: {e}")
+
+        # Forget the replicas I no longer watch, they start over if I ever watch them again
+        with heartbeat_lock:
+            for replica in list(heartbeat_histories.keys()):
+                if replica not in peers:
+                    del heartbeat_histories[replica]
+
+        # Wait up to HEARTBEAT_INTERVAL for the answers, they carry membership updates (& my own entry if they took me out of the view)
+        answered = set()
+        deadline = time.time() + HEARTBEAT_INTERVAL
+        while len(answered) < len(peers) and time.time() < deadline:
+            sender.settimeout(max(deadline - time.time(), 0.001))
+            try:
+                answer = json.loads(sender.recv(HEARTBEAT_MAX_BYTES))
+            except socket.timeout:
+                break
+            except (OSError, ValueError):
+                continue
+            if not isinstance(answer, dict) or answer.get('seq') != seq:
+                continue
+            replica = answer.get('replica')
+            if replica not in peers or replica in answered:
+                continue
+            answered.add(replica)
+            record_heartbeat(replica, time.time())
+            merge_membership(answer.get('updates'))
+
+        now = time.time()
+
+        # Take the replicas I suspect out of the view, they start over if they ever come back
+        suspected = [replica for replica in peers if get_phi(replica, now) > PHI_THRESHOLD]
+        if len(suspected) > 0:
+            print(f"Failure detector suspects {suspected}, removing them from the view")
+            with heartbeat_lock:
+                for replica in suspected:
+                    heartbeat_histories.pop(replica, None)
+            remove_down_replicas(suspected)
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS:                            UPDATE LOG
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This function will append a write I applied to the update log (a bounded, numbered log used to catch up new members)
+# NOTE: origin & counter are the replica that coordinated the write & its vector clock entry for it
+def record_update(method, key, value, origin, counter, dependencies=None):
+    # Get globals
+    global update_log_seq
+
+    with update_log_lock:
+        update_log_seq += 1
+        update_log.append({'seq': update_log_seq, 'method': method, 'key': key, 'value': value, 'origin': origin, 'counter': counter, 'dependencies': dependencies})
+
+# This function will return up to limit updates logged after seq, or None if the log doesn't go back that far anymore
+def get_updates_since(seq, limit):
+    with update_log_lock:
+        if len(update_log) > 0 and update_log[0]['seq'] > seq + 1:
+            return None
+        if len(update_log) == 0 and update_log_seq > seq:
+            return None
+        updates = []
+        for update in reversed(update_log):
+            if update['seq'] <= seq:
+                break
+            updates.append(update)
+    updates.reverse()
+    return updates[:limit]
 
 
 # ================================================================================================================
@@ -226,68 +2106,351 @@ def merge_vector_clocks(VC2):
 # ================================================================================================================
 
 
+# This function will return the keep-alive session used to talk to a replica (one per peer)
+def get_peer_session(replica):
+    # Get globals
+    global peer_sessions
+
+    with peer_sessions_lock:
+        session = peer_sessions.get(replica)
+        if session is None and NETWORK_ENGINE == 'asyncio':
+            session = AsyncPeerSession()
+            peer_sessions[replica] = session
+        elif session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=REPLICATION_POOL_SIZE)
+            session.mount('http://', adapter)
+            peer_sessions[replica] = session
+    return session
+
+# This function will return the ordered outbound queue for a replica, starting its worker thread the first time
+def get_outbound_queue(replica):
+    # Get globals
+    global outbound_queues
+
+    with outbound_queues_lock:
+        outbound = outbound_queues.get(replica)
+        if outbound is None:
+            outbound = {'updates': deque(), 'ready': threading.Condition(), 'enqueued': 0, 'sent': 0, 'last-lag': 0.0}
+            outbound_queues[replica] = outbound
+            threading.Thread(target=outbound_worker, args=(replica, outbound), daemon=True).start()
+    return outbound
+
+# This function will add a kvs update to the end of a replica's outbound queue
+def enqueue_kvs_update(replica, method, key, data):
+    outbound = get_outbound_queue(replica)
+    with outbound['ready']:
+        outbound['updates'].append((time.time(), method, key, data))
+        outbound['enqueued'] += 1
+        outbound['ready'].notify()
+
+# This function will hand a kvs update a sync broadcast couldn't get acknowledged in time over to the replica's outbound queue
+# NOTE: the replica may get it twice (if the call it was handed off from gets through), the dependency test drops the second one
+def handoff_kvs_update(replica, method, key, data):
+    count_metric('kvs_replication_handoffs_total', (('peer', replica),))
+    enqueue_kvs_update(replica, method, key, data)
+
+# This function will tell whether a replica still has kvs updates waiting in its outbound queue
+def has_queued_updates(replica):
+    with outbound_queues_lock:
+        outbound = outbound_queues.get(replica)
+    if outbound is None:
+        return False
+    with outbound['ready']:
+        return len(outbound['updates']) > 0
+
+# This function will build the body of a /replicate-batch request from an ordered list of (time, method, key, data) kvs updates
+def build_kvs_batch(updates):
+    # Consecutive updates mostly differ in one entry of the vector clock, only send the entries that changed
+    data = {'updates': []}
+    previous = {}
+    for _, method, key, update_data in updates:
+        update = {'method': method, 'key': key, **update_data}
+        causal_metadata = update.pop('causal-metadata')
+        if all(address in causal_metadata for address in previous):
+            update['causal-metadata-delta'] = {address: counter for address, counter in causal_metadata.items() if previous.get(address) != counter}
+        else:
+            update['causal-metadata'] = causal_metadata
+        previous = causal_metadata
+        data['updates'].append(update)
+    return data
+
+# This function will send an ordered batch of kvs updates to one replica in a single request
+# Returns "acknowledged" (200), "down" if the replica could not be reached or "rejected" for any other answer (the batch is sent again)
+def send_kvs_batch(replica, updates):
+    # Create request
+    url = f"http://{replica}/replicate-batch"
+    headers = {'Replica': my_socket_address}
+    session = get_peer_session(replica)
+    data = build_kvs_batch(updates)
+
+    started = time.perf_counter()
+    try:
+        response = session.put(url, json=data, headers=headers, timeout=REPLICATION_TIMEOUT)
+    except requests.exceptions.RequestException:
+        # Found down replica
+        count_metric('kvs_replication_failures_total', (('peer', replica),))
+        return 'down'
+    observe_metric('kvs_replication_peer_seconds', time.perf_counter() - started, (('peer', replica),))
+
+    if response.status_code != 200:
+        count_metric('kvs_replication_failures_total', (('peer', replica),))
+        print(f"Unexpected response to a batch of {len(updates)} updates from {replica}: {response.status_code}")
+        return 'rejected'
+    return 'acknowledged'
+
+# This function runs in a background thread per replica & sends its queued kvs updates in order, in batches
+# NOTE: a batch the replica rejected stays at the head of the queue & is sent again, waiting REPLICATION_RETRY_BACKOFF seconds
+# (doubling up to REPLICATION_RETRY_MAX_BACKOFF) in between, until the replica acknowledges it or leaves the view
+def outbound_worker(replica, outbound):
+    backoff = REPLICATION_RETRY_BACKOFF
+    while True:
+        # Wait for updates (they stay at the head of the queue until the replica acknowledges them)
+        with outbound['ready']:
+            while len(outbound['updates']) == 0:
+                outbound['ready'].wait()
+
+            # Give the batch a short window to fill up
+            deadline = time.time() + REPLICATION_BATCH_WINDOW
+            while len(outbound['updates']) < REPLICATION_BATCH_SIZE and time.time() < deadline:
+                outbound['ready'].wait(deadline - time.time())
+
+            batch = [outbound['updates'][i] for i in range(min(len(outbound['updates']), REPLICATION_BATCH_SIZE))]
+
+        # Replica is down (or gone), forget its queue & tell everyone
+        result = send_kvs_batch(replica, batch)
+        if result == 'rejected' and replica in view_list:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, REPLICATION_RETRY_MAX_BACKOFF)
+            continue
+        if result != 'acknowledged':
+            with outbound_queues_lock:
+                outbound_queues.pop(replica, None)
+            remove_down_replicas([replica] if result == 'down' else [])
+            return
+        backoff = REPLICATION_RETRY_BACKOFF
+
+        with outbound['ready']:
+            for _ in batch:
+                outbound['updates'].popleft()
+            outbound['sent'] += len(batch)
+            outbound['last-lag'] = time.time() - batch[-1][0]
+            outbound['ready'].notify_all()
+
+# This function waits (up to timeout seconds) until every kvs update broadcast so far was acknowledged by the shard group
+def wait_for_replication_flush(timeout):
+    deadline = time.time() + timeout
+
+    # Sync broadcasts still waiting on replicas
+    with inflight_broadcasts_done:
+        while inflight_broadcasts > 0 and time.time() < deadline:
+            inflight_broadcasts_done.wait(deadline - time.time())
+
+    # Async updates queued so far
+    with outbound_queues_lock:
+        queues = list(outbound_queues.values())
+    for outbound in queues:
+        with outbound['ready']:
+            target = outbound['enqueued']
+            while outbound['sent'] < target and time.time() < deadline:
+                outbound['ready'].wait(deadline - time.time())
+
+# This function will report the depth & replication lag (seconds) of every outbound queue
+def get_replication_status():
+    now = time.time()
+    peers = {}
+    with outbound_queues_lock:
+        queues = list(outbound_queues.items())
+    for replica, outbound in queues:
+        with outbound['ready']:
+            depth = len(outbound['updates'])
+            lag = now - outbound['updates'][0][0] if depth > 0 else 0.0
+            peers[replica] = {'depth': depth, 'lag': lag, 'last-lag': outbound['last-lag'], 'sent': outbound['sent']}
+    return peers
+
+# This function will remove down replicas from the view & shard groups and tell everyone else
+def remove_down_replicas(down_replicas):
+    # Get globals
+    global shard_groups, view_list
+
+    # If you find any replicas that are down & you're not alone, take them out & start gossiping it right away
+    if len(down_replicas) > 0 and len(view_list) != 1:
+        removed = [replica for replica in down_replicas if replica != my_socket_address and remove_member(replica)]
+        if len(removed) > 0:
+            gossip_round()
+
 # This function will broadcast a kvs update to everyone in the shard-group
-def broadcast_kvs(method, key, value=None):
+# NOTE: causal_metadata is my vc right after the write, in async replication mode it only queues the update for each replica & returns right away
+def broadcast_kvs(method, key, causal_metadata, value=None, dependencies=None):
     # Get globals
     global shard_groups, my_socket_address, shard_number, view_list
 
-    # Create a list to hold replicas that are down
-    down_replicas = []
+    # Create data once, every replica gets the same snapshot of the vector clock
+    if method == 'PUT':
+        data = {'value': value, 'causal-metadata': causal_metadata}
+        if dependencies:
+            data['dependencies'] = dependencies
+    else: # method == DELETE
+        data = {'causal-metadata': causal_metadata}
+
+    peers = [replica for replica in shard_groups[shard_number][:] if replica != my_socket_address]
+
+    # Async mode, the outbound workers deliver it in the background
+    if REPLICATION_MODE == 'async':
+        for replica in peers:
+            enqueue_kvs_update(replica, method, key, data)
+        return
+
+    # A replica that still has updates queued from a handoff gets this one queued behind them
+    for replica in [replica for replica in peers if has_queued_updates(replica)]:
+        handoff_kvs_update(replica, method, key, data)
+        peers.remove(replica)
+
+    # Send to everyone in shard group (skip yourself) at the same time, to PUT/DELETE a key in kvs
+    global inflight_broadcasts
+    with inflight_broadcasts_done:
+        inflight_broadcasts += 1
+    try:
+        headers = add_trace_header({'Replica': my_socket_address})
+        started = time.perf_counter()
+        timings = []
+        responses = fan_out([(method, f"http://{replica}/kvs/{key}", {'json': data, 'headers': headers, 'timeout': REPLICATION_TIMEOUT}) for replica in peers], abandon=lambda replica: replica not in view_list, timings=timings, handoff=REPLICATION_HANDOFF_TIMEOUT or None)
+        observe_metric('kvs_replication_seconds', time.perf_counter() - started, (('kind', 'key'),))
+
+        # Wait for the slowest replica (until the failure detector takes it out or it is handed off) & collect the ones that are down
+        # Replicas accept (or hold back) every update right away, anything else is unexpected behavior
+        down_replicas = []
+        for replica, response, elapsed in zip(peers, responses, timings):
+            if response is None:
+                handoff_kvs_update(replica, method, key, data)
+            elif isinstance(response, Exception):
+                count_metric('kvs_replication_failures_total', (('peer', replica),))
+                down_replicas.append(replica)
+            elif response.status_code not in (200, 201, 202, 404):
+                print(f"Unexpected response to {method} {key} from {replica}: {response.status_code}")
+            if elapsed is not None:
+                observe_metric('kvs_replication_peer_seconds', elapsed, (('peer', replica),))
+        trace_fan_out('peer', peers, responses, timings)
+    finally:
+        with inflight_broadcasts_done:
+            inflight_broadcasts -= 1
+            inflight_broadcasts_done.notify_all()
+    remove_down_replicas(down_replicas)
+
+# This function will broadcast an ordered list of (method, key, data) kvs updates I coordinated to my shard group, in one request per replica
+def broadcast_kvs_batch(updates):
+    # Get globals
+    global shard_groups, my_socket_address, shard_number
+
+    if len(updates) == 0:
+        return
+    peers = [replica for replica in shard_groups[shard_number][:] if replica != my_socket_address]
+
+    # Async mode, the outbound workers deliver them in the background
+    if REPLICATION_MODE == 'async':
+        for replica in peers:
+            for method, key, data in updates:
+                enqueue_kvs_update(replica, method, key, data)
+        return
+
+    # A replica that still has updates queued from a handoff gets these queued behind them
+    for replica in [replica for replica in peers if has_queued_updates(replica)]:
+        for method, key, update_data in updates:
+            handoff_kvs_update(replica, method, key, update_data)
+        peers.remove(replica)
+
+    # Send the whole batch to everyone in shard group (skip yourself) at the same time
+    global inflight_broadcasts
+    with inflight_broadcasts_done:
+        inflight_broadcasts += 1
+    try:
+        data = build_kvs_batch([(None, method, key, update_data) for method, key, update_data in updates])
+        headers = add_trace_header({'Replica': my_socket_address})
+        started = time.perf_counter()
+        timings = []
+        responses = fan_out([('PUT', f"http://{replica}/replicate-batch", {'json': data, 'headers': headers, 'timeout': REPLICATION_TIMEOUT}) for replica in peers], abandon=lambda replica: replica not in view_list, timings=timings, handoff=REPLICATION_HANDOFF_TIMEOUT or None)
+        observe_metric('kvs_replication_seconds', time.perf_counter() - started, (('kind', 'batch'),))
+
+        # Wait for the slowest replica (until the failure detector takes it out or it is handed off) & collect the ones that are down
+        down_replicas = []
+        for replica, response, elapsed in zip(peers, responses, timings):
+            if response is None:
+                for method, key, update_data in updates:
+                    handoff_kvs_update(replica, method, key, update_data)
+            elif isinstance(response, Exception):
+                count_metric('kvs_replication_failures_total', (('peer', replica),))
+                down_replicas.append(replica)
+            elif response.status_code != 200:
+                print(f"Unexpected response to a batch of {len(updates)} updates from {replica}: {response.status_code}")
+            if elapsed is not None:
+                observe_metric('kvs_replication_peer_seconds', elapsed, (('peer', replica),))
+        trace_fan_out('peer', peers, responses, timings)
+    finally:
+        with inflight_broadcasts_done:
+            inflight_broadcasts -= 1
+            inflight_broadcasts_done.notify_all()
+    remove_down_replicas(down_replicas)
 
-    # Broadcast to everyone in shard group (skip yourself), to PUT/DELETE a key in kvs
-    for replica in shard_groups[shard_number][:]:
-        if replica != my_socket_address:
-            while True:
-                try:
-                    # Create request
-                    url = f"http://{replica}/kvs/{key}"
-
-                    # Create data
-                    if method == 'PUT':
-                        data = {'value': value, 'causal-metadata': vector_clock}
-                    else: # method == DELETE
-                        data = {'causal-metadata': vector_clock}
-
-                    # Create header
-                    headers = {'Replica': my_socket_address}
-
-                    # Make request
-                    if method == 'PUT':
-                        response = requests.put(url, json=data, headers=headers,timeout=10)
-                    elif method == 'DELETE':
-                        response = requests.delete(url, json=data, headers=headers,timeout=10)
-
-                    # Dependencies are NOT met, sleep and try again
-                    if response.status_code == 503:
-                        time.sleep(1)
-                        continue
-                    # Dependencies ARE met, break the while loop & continue the for-loop
-                    elif response.status_code == 200 or response.status_code == 201 or response.status_code == 404:
-                        break
-                    # Unexpected behavior 
-                    else:
-                        # raise Exception
-                        continue
-                except requests.exceptions.RequestException:
-                    # Found down replica, delete from view list & add to down_replicas
-                    down_replicas.append(replica)
-                    break  # Continue to for loop iteration and break while loop iteration(aka next replica)
-   
-    # If you find any replicas that are down & you're not alone, broadcast it  
-    if len(down_replicas) > 0 and len(view_list) != 1:
-        for replica in down_replicas:
-            if replica != my_socket_address:
-                bad_replica_group = get_shard_number(replica)
 
-                if replica in view_list:
-                    view_list.remove(replica)
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                        /replication/status, /metrics & /admin/profile endpoints
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
 
-                if replica in shard_groups[bad_replica_group]:
-                    shard_groups[bad_replica_group].remove(replica)
-                print(f"New shard-groups: {shard_groups}")
-                broadcast_view('DELETE', replica)
-    
+# This endpoint reports the outbound replication queues
+@app.route('/replication/status', methods=['GET'])
+def replication_status():
+    return make_response(jsonify({'mode': REPLICATION_MODE, 'peers': get_replication_status()}), 200)
+
+# This endpoint exposes every metric in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# This endpoint samples the stack of every thread for ?seconds= (default 10) every ?interval= seconds & returns them as flame graph data
+# The answer is in the collapsed stack format (a 'thread;outermost;...;innermost count' line per stack) flamegraph.pl & speedscope read
+# NOTE: it holds a request thread for the whole run & only one runs at a time
+@app.route('/admin/profile', methods=['GET'])
+def profile():
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', PROFILE_INTERVAL))
+    except ValueError:
+        return make_response(jsonify({'error': 'seconds & interval must be numbers'}), 400)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval <= 0:
+        return make_response(jsonify({'error': f'seconds must be over 0 & at most {PROFILE_MAX_SECONDS}, interval over 0'}), 400)
+    if not profile_lock.acquire(blocking=False):
+        return make_response(jsonify({'error': 'A profile is already running'}), 409)
+    try:
+        stacks, samples = sample_stacks(seconds, interval)
+    finally:
+        profile_lock.release()
+    print(f"Profiled {samples} samples over {seconds}s")
+    lines = [f"{stack} {count}" for stack, count in sorted(stacks.items())]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                /heartbeat & /failure-detector endpoints
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint answers a heartbeat over HTTP, the same answer replicas get over UDP (see heartbeat_listener)
+@app.route('/heartbeat', methods=['GET'])
+def heartbeat():
+    return make_response(jsonify(get_heartbeat_answer(request.headers.get('Replica'))), 200)
 
+# This endpoint reports the phi (suspicion level) of every replica I have heard a heartbeat from
+@app.route('/failure-detector', methods=['GET'])
+def failure_detector_status():
+    now = time.time()
+    with heartbeat_lock:
+        replicas = list(heartbeat_histories.keys())
+    return make_response(jsonify({'threshold': PHI_THRESHOLD, 'phi': {replica: get_phi(replica, now) for replica in replicas}}), 200)
 
 
 # ================================================================================================================
@@ -301,7 +2464,8 @@ def broadcast_kvs(method, key, value=None):
 @app.route('/kvs/<key>', methods=['PUT', 'GET','DELETE'])
 def put_key_value(key):
     # Get data from json
-    data = request.get_json(silent=True)
+    with trace_span('parse'):
+        data = request.get_json(silent=True)
 
     # Check to see if data is empty
     if data is None:
@@ -320,53 +2484,122 @@ def put_key_value(key):
     # Process request
     return process_request(method, key, data)
 
-# This function acts as the proxy/forwarder to the correct shard group
-def handle_forwarded_request(method, key):
-    # Make a response variable
-    response = None
+# This function will order the replicas to forward a request to: fewest requests I have outstanding at them first (ties broken at random)
+# NOTE: a replica whose circuit is open (it kept failing) is skipped until its cooldown ends, then it gets one trial request
+def get_forwarding_order(replicas):
+    now = time.time()
+    order = []
+    with forwarding_lock:
+        for replica in replicas:
+            breaker = forwarding_breakers.get(replica)
+            if breaker is not None and breaker['failures'] >= FORWARD_BREAKER_FAILURES:
+                if now < breaker['open-until']:
+                    continue
+                # Half open, let this request try it & hold everyone else off for another cooldown
+                breaker['open-until'] = now + FORWARD_BREAKER_COOLDOWN
+            order.append((forwarding_outstanding.get(replica, 0), random.random(), replica))
+    return [replica for _, _, replica in sorted(order)]
+
+# This function will record the result of a request forwarded to a replica (any response closes its circuit)
+def record_forwarding_result(replica, reachable):
+    with forwarding_lock:
+        forwarding_outstanding[replica] -= 1
+        breaker = forwarding_breakers.setdefault(replica, {'failures': 0, 'open-until': 0.0})
+        if reachable:
+            breaker['failures'] = 0
+            return
+        breaker['failures'] += 1
+        if breaker['failures'] == FORWARD_BREAKER_FAILURES:
+            print(f"Stopped forwarding to {replica} for {FORWARD_BREAKER_COOLDOWN}s, it failed {FORWARD_BREAKER_FAILURES} times in a row")
+        if breaker['failures'] >= FORWARD_BREAKER_FAILURES:
+            breaker['open-until'] = time.time() + FORWARD_BREAKER_COOLDOWN
+
+# This function will return how many times the request was forwarded already (its Forwarded-Hops header)
+# Returns None if the header is not a count
+def get_forwarded_hops():
+    try:
+        hops = int(request.headers.get('Forwarded-Hops', 0))
+    except ValueError:
+        return None
+    return hops if hops >= 0 else None
+
+# This function acts as the proxy/forwarder to the correct shard group (or to the given replicas)
+# NOTE: the request body is sent on as is (never parsed again) & the whole request gets FORWARD_TIMEOUT seconds, across every replica tried
+def handle_forwarded_request(method, key, replicas=None):
+    # While replicas switch routing epochs they can briefly disagree on the owner, don't bounce a request around forever
+    hops = get_forwarded_hops()
+    if hops is None:
+        return make_response(jsonify({'error': 'Forwarded-Hops must be a count'}), 400)
+    hops += 1
+    if hops > MAX_FORWARD_HOPS:
+        return make_response(jsonify({'error': 'Shard groups are changing; try again later'}), 503)
+    headers = add_trace_header({'Forwarded-Hops': str(hops), 'Routing-Epoch': str(routing_epoch)})
+    if request.content_type:
+        headers['Content-Type'] = request.content_type
+    body = request.get_data()
+    deadline = time.time() + FORWARD_TIMEOUT
 
     # Find out what shard this key belongs to
     key_shard_destination = get_key_shard_desination(key)
 
+    if replicas is None:
+        replicas = shard_groups[key_shard_destination][:]
+
     # Forward to 1 replica in shard group  (NOTE: only forward to 1 because they will broadcast to everyone in their group)
-    for replica in shard_groups[key_shard_destination][:]:
+    # Each replica tried gets an equal share of the time left, so a hung replica can't use up the time of the ones after it
+    g.kvs_path = 'forward'
+    order = get_forwarding_order(replicas)
+    for i, replica in enumerate(order):
+        timeout = (deadline - time.time()) / (len(order) - i)
+        if timeout <= 0:
+            return make_response(jsonify({'error': 'Forwarded request timed out'}), 503)
+        if i > 0:
+            count_metric('kvs_forward_retries_total')
+
+        # Make a url to replica
+        url = f"http://{replica}/kvs/{key}"
+        if method == 'PUT':
+            print(f"Trying to forward to {replica}")
+        with forwarding_lock:
+            forwarding_outstanding[replica] = forwarding_outstanding.get(replica, 0) + 1
         try:
-            # Make a url to replica
-            url = f"http://{replica}/kvs/{key}"
             # forward respective method and return response to client
-            if method == 'GET':
-                response = requests.get(url, json=request.get_json(silent=True))
-            elif method == 'PUT':
-                print(f"Trying to forward to {replica}")
-                response = requests.put(url, json=request.get_json(silent=True), timeout=30)
-            elif method == 'DELETE':
-                response = requests.delete(url, json=request.get_json(silent=True))
-            else:
-                return make_response(jsonify({'error': 'Server error'}), 500)
-            # break out of loop
-            if response is not None:
-                return response.content, response.status_code, response.headers.items()
-            else:
-                time.sleep(1)
-                continue
+            with trace_span('forward', f"{my_socket_address} to {replica}"):
+                response = get_peer_session(replica).request(method, url, data=body, headers=headers, timeout=timeout)
         except requests.exceptions.RequestException as e:
             # forwarding request failed & the shard-group will catch this error then tell everyone to delete this shard
+            record_forwarding_result(replica, False)
             print(f'Forwarding request failed, could not connect to {replica}: {e}')
             continue
-    
+        record_forwarding_result(replica, True)
+        response_headers = [(name, value) for name, value in response.headers.items() if name.lower() not in FORWARD_HOP_HEADERS]
+        return response.content, response.status_code, response_headers
+
     return make_response(jsonify({'error': 'All replicas failed to respond'}), 503)
 
+# This function hands a replicated update to the hold-back queue & acknowledges it immediately
+def replica_update_response(method, key, value, causal_metadata, dependencies=None):
+    result = receive_replicated_update(method, key, value, causal_metadata, request.headers.get('Replica'), dependencies=dependencies)
+    if result == 'buffered':
+        return make_response(jsonify({"result": "buffered"}), 202)
+    return make_response(jsonify({"result": result, "causal-metadata": vector_clock.to_dict()}), 200)
+
 # This function handles the logic for kvs endpoint
 def process_request(method, key, data):
     # Get global
     global key_value_store, vector_clock
 
     # Hash the key
-    key_shard_destination = get_key_shard_desination(key)
+    with trace_span('shard-lookup'):
+        key_shard_destination = get_key_shard_desination(key)
 
     # Check if key belongs to my shard group
     if key_shard_destination != shard_number:
         return handle_forwarded_request(method, key)
+
+    # I don't have my shard's data yet, let the rest of my shard group answer clients
+    if joining_shard and 'Replica' not in request.headers:
+        return handle_forwarded_request(method, key, [replica for replica in shard_groups[shard_number] if replica != my_socket_address])
     print(f"Not forwarding request, key_shard_destination: {key_shard_destination}")
     # Create a local status code variable 
     status_code = 0
@@ -390,41 +2623,54 @@ def process_request(method, key, data):
 
         # Check header to see if request is from a client
         if 'Replica' not in request.headers:
-            dependency = dependency_test_client(causal_metadata)
+            with trace_span('dependency-test'):
+                dependency = dependency_test_client(causal_metadata)
             from_client = True
-        else: # From a replica
+        else: # From a replica, accept it right away (it gets delivered once its dependencies are met)
             print(f"From replica {request.headers.get('Replica')}")
-            dependency = dependency_test_replica(causal_metadata, request.headers.get('Replica'))
+            return replica_update_response('PUT', key, value, causal_metadata, data.get('dependencies'))
 
         if dependency:    
             # Check if key is to long
             if len(key) > 50:
                 return make_response(jsonify({'error': 'Key is too long'}), 400)
             
-            # Check if key exists or not in kvs
-            if key in key_value_store:
-                status_code = 200
-            else:
-                status_code = 201
-
-            # Write to key value store
-            key_value_store[key] = value
+            # The client's entries outside my shard group become the key's dependencies (my vc already covers the rest)
+            dependencies = get_foreign_dependencies(causal_metadata)
 
-            # Merge vector clocks
-            merge_vector_clocks(causal_metadata)
-
-            # Update vector clock & broadcast to everyone if from client
+            # Update vector clock, write to key value store (versioned by the write's dot) & broadcast to everyone if from client
+            # NOTE: the clock, kvs & log change together under state_lock, the broadcast goes out after with the vc of this write
             if from_client:
                 print("from_client = True")
-                update_vector_clock()
-                broadcast_kvs('PUT', key, value)
+                with trace_span('local-write'), state_lock:
+                    # A reshard moved the key away since it was routed here
+                    moved = get_key_shard_desination(key) != shard_number
+                    if not moved:
+                        # Check if key exists or not in kvs
+                        if key in key_value_store:
+                            status_code = 200
+                        else:
+                            status_code = 201
+
+                        dot = (my_socket_address, update_vector_clock())
+                        store_put(key, value, dot, dependencies)
+                        persist_vector_clock()
+                        record_update('PUT', key, value, my_socket_address, dot[1], dependencies)
+                        replicated_metadata = vector_clock.to_dict()
+                        live_chunk, live_recipients = get_live_migration('PUT', key, replicated_metadata, value, dot, dependencies)
+                if moved:
+                    return handle_forwarded_request(method, key)
+                with trace_span('replicate'):
+                    broadcast_kvs('PUT', key, replicated_metadata, value, dependencies)
+                migrate_live_update(live_chunk, live_recipients)
 
             # Reuslt was replaced
             if status_code == 200:
-                return make_response(jsonify({"result": "replaced", "causal-metadata": vector_clock}), 200)
+                return make_response(jsonify({"result": "replaced", "causal-metadata": get_response_metadata(causal_metadata)}), 200)
             # Result was created
-            return make_response(jsonify({"result": "created", "causal-metadata": vector_clock}), 201)
+            return make_response(jsonify({"result": "created", "causal-metadata": get_response_metadata(causal_metadata)}), 201)
         else:
+            count_metric('kvs_dependency_failures_total', (('method', method),))
             return make_response(jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503)
         
 #          ~~~~~~~~~~~~~~~~~~~~~
@@ -437,20 +2683,21 @@ def process_request(method, key, data):
         causal_metadata = data.get('causal-metadata')
 
         # Check dependency test (only clients use this)
-        dependency = dependency_test_client(causal_metadata)
+        with trace_span('dependency-test'):
+            dependency = dependency_test_client(causal_metadata)
 
         if dependency:
-            # Merge the vector clocks
-            merge_vector_clocks(causal_metadata)
-
-            # Found key:value
-            if key in key_value_store:
-                return make_response(jsonify({"result": "found", "value": key_value_store[key], "causal-metadata": vector_clock}), 200)
+            # Found key:value (the client now depends on whatever the write depended on)
+            # NOTE: reads never take state_lock, a GET doesn't wait behind writes or replication
+            value = key_value_store.get(key, MISSING_VALUE)
+            if value is not MISSING_VALUE:
+                return make_response(jsonify({"result": "found", "value": value, "causal-metadata": get_response_metadata(causal_metadata, key)}), 200)
             else: # Does not exist
                 return make_response(jsonify({"error": "Key does not exist"}), 404)
             
         else: 
             # Dependencies are NOT met
+            count_metric('kvs_dependency_failures_total', (('method', method),))
             return make_response(jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503)
 #          ~~~~~~~~~~~~~~~~~~~~~~
 #          ~~~~ DELETE logic ~~~~
@@ -463,34 +2710,589 @@ def process_request(method, key, data):
 
         # Check header to see if request is from a client
         if 'Replica' not in request.headers:
-            dependency = dependency_test_client(causal_metadata)
+            with trace_span('dependency-test'):
+                dependency = dependency_test_client(causal_metadata)
             from_client = True
-        else: # From a replica
-            dependency = dependency_test_replica(causal_metadata, request.headers.get('Replica'))
+        else: # From a replica, accept it right away (it gets delivered once its dependencies are met)
+            return replica_update_response('DELETE', key, None, causal_metadata)
 
 
         if dependency:
-            # Check if key exists in the store
-            if key not in key_value_store:
-                return make_response(jsonify({"error": "Key does not exist"}), 404)
-            
-            # Delete key
-            del key_value_store[key]
-
-            # Merge vector clocks
-            merge_vector_clocks(causal_metadata)
-            
-            # Update vector clock & broadcast to everyone if from client
+            # Update vector clock, delete key (leaving a tombstone) & broadcast to everyone if from client
             if from_client:
-                update_vector_clock()
-                broadcast_kvs('DELETE', key)
-            return make_response(jsonify({"result": "deleted", "causal-metadata": vector_clock}), 200)
+                with trace_span('local-write'), state_lock:
+                    # A reshard moved the key away since it was routed here
+                    moved = get_key_shard_desination(key) != shard_number
+                    if not moved:
+                        # Check if key exists in the store
+                        if key not in key_value_store:
+                            return make_response(jsonify({"error": "Key does not exist"}), 404)
+
+                        dot = (my_socket_address, update_vector_clock())
+                        store_delete(key, dot)
+                        persist_vector_clock()
+                        record_update('DELETE', key, None, my_socket_address, dot[1])
+                        replicated_metadata = vector_clock.to_dict()
+                        live_chunk, live_recipients = get_live_migration('DELETE', key, replicated_metadata, dot=dot)
+                if moved:
+                    return handle_forwarded_request(method, key)
+                with trace_span('replicate'):
+                    broadcast_kvs('DELETE', key, replicated_metadata)
+                migrate_live_update(live_chunk, live_recipients)
+            return make_response(jsonify({"result": "deleted", "causal-metadata": get_response_metadata(causal_metadata)}), 200)
         else:
+            count_metric('kvs_dependency_failures_total', (('method', method),))
             return make_response(jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503)
 
 
 
 
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                       /kvs-batch endpoint
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint runs many kvs operations in one request: {'operations': [{'method', 'key', 'value'}, ...], 'causal-metadata': <V>}
+# The operations are grouped by shard group, mine are applied in one pass & every other shard group gets its own at the same time
+# Returns a result per operation (in order) & one causal-metadata covering all of them
+# NOTE: every operation depends on the batch's causal-metadata, operations of one shard group run in order, across shard groups they are concurrent
+@app.route('/kvs-batch', methods=['PUT'])
+def kvs_batch():
+    # Get data from json
+    data = request.get_json(silent=True)
+
+    # Check to see if data is correct
+    if data is None or not isinstance(data.get('operations'), list):
+        return make_response(jsonify({'error': 'PUT request does not contain operations'}), 400)
+    if 'causal-metadata' not in data:
+        return make_response(jsonify({'error': 'PUT request does not contain causal-metadata'}), 400)
+    operations = data.get('operations')
+    causal_metadata = data.get('causal-metadata')
+
+    # While replicas switch routing epochs they can briefly disagree on the owner, don't bounce a batch around forever
+    hops = get_forwarded_hops()
+    if hops is None:
+        return make_response(jsonify({'error': 'Forwarded-Hops must be a count'}), 400)
+    if hops > MAX_FORWARD_HOPS:
+        return make_response(jsonify({'error': 'Shard groups are changing; try again later'}), 503)
+
+    results, metadata = run_batch(operations, causal_metadata, hops)
+    return make_response(jsonify({'results': results, 'causal-metadata': merge_batch_metadata(metadata)}), 200)
+
+# This function will run a batch of operations (see /kvs-batch)
+# Returns a result per operation & the causal-metadata returned for every part of the batch
+def run_batch(operations, causal_metadata, hops=0):
+    # Check every operation & group them by shard group
+    results = [None] * len(operations)
+    groups = {}
+    for i, operation in enumerate(operations):
+        error = check_batch_operation(operation)
+        if error is not None:
+            results[i] = {'key': operation.get('key') if isinstance(operation, dict) else None, 'status': 400, 'error': error}
+            continue
+        groups.setdefault(get_key_shard_desination(operation['key']), []).append(i)
+
+    # I don't have my shard's data yet, let the rest of my shard group run my shard group's operations
+    local = groups.pop(shard_number, [])
+    targets = {shard_id: shard_groups[shard_id][:] for shard_id in groups}
+    if joining_shard and len(local) > 0:
+        groups[shard_number] = local
+        targets[shard_number] = [replica for replica in shard_groups[shard_number] if replica != my_socket_address]
+        local = []
+
+    # Send the other shard groups their operations, while I run mine
+    # NOTE: every operation has its own slot in results, so the scatter & I fill them in at the same time
+    scatter = None
+    if len(groups) > 0:
+        scatter = replication_pool.submit(scatter_batch, operations, groups, targets, causal_metadata, hops, results)
+    metadata = [get_response_metadata(causal_metadata)]
+    moved = run_local_batch(operations, local, causal_metadata, results, metadata)
+
+    # A reshard moved some of my keys away since they were grouped, they go to their new shard groups
+    if len(moved) > 0:
+        moved_groups = {}
+        for i in moved:
+            moved_groups.setdefault(get_key_shard_desination(operations[i]['key']), []).append(i)
+        moved_targets = {shard_id: shard_groups[shard_id][:] for shard_id in moved_groups}
+        metadata.extend(scatter_batch(operations, moved_groups, moved_targets, causal_metadata, hops, results))
+    if scatter is not None:
+        metadata.extend(scatter.result())
+    return results, metadata
+
+# This function will check one operation of a batch
+# Returns the error, or None if the operation is fine
+def check_batch_operation(operation):
+    if not isinstance(operation, dict) or not isinstance(operation.get('key'), str):
+        return 'Operation does not specify a key'
+    if operation.get('method') not in ('GET', 'PUT', 'DELETE'):
+        return 'Operation method must be GET, PUT or DELETE'
+    if operation['method'] == 'PUT':
+        if 'value' not in operation:
+            return 'PUT operation does not specify a value'
+        if len(operation['key']) > 50:
+            return 'Key is too long'
+    return None
+
+# This function will run the operations of a batch that belong to my shard group (by index) in one pass & replicate the writes together
+# Fills in their results & adds the causal-metadata they return to metadata
+# Returns the indexes of operations whose key a reshard moved to another shard group in the meantime
+def run_local_batch(operations, indexes, causal_metadata, results, metadata):
+    if len(indexes) == 0:
+        return []
+
+    # Check dependency test once, every operation of the batch has the same causal-metadata
+    if not dependency_test_client(causal_metadata):
+        for i in indexes:
+            count_metric('kvs_dependency_failures_total', (('method', 'BATCH'),))
+            results[i] = {'key': operations[i]['key'], 'status': 503, 'error': 'Causal dependencies not satisfied; try again later'}
+        return []
+
+    # The client's entries outside my shard group become the dependencies of every write (my vc already covers the rest)
+    dependencies = get_foreign_dependencies(causal_metadata)
+    updates = []
+    migrations = []
+    moved = []
+
+    # The clock, kvs & log change together under state_lock, like a single write (see process_request)
+    with state_lock:
+        for i in indexes:
+            operation = operations[i]
+            method = operation['method']
+            key = operation['key']
+
+            # A reshard moved the key away since it was grouped
+            if get_key_shard_desination(key) != shard_number:
+                moved.append(i)
+                continue
+
+            if method == 'GET':
+                value = key_value_store.get(key, MISSING_VALUE)
+                if value is MISSING_VALUE:
+                    results[i] = {'key': key, 'status': 404, 'error': 'Key does not exist'}
+                    continue
+                results[i] = {'key': key, 'status': 200, 'result': 'found', 'value': value}
+                metadata.append(key_dependencies.get(key, {}))
+            elif method == 'PUT':
+                value = operation['value']
+                status_code = 200 if key in key_value_store else 201
+                dot = (my_socket_address, update_vector_clock())
+                store_put(key, value, dot, dependencies)
+                record_update('PUT', key, value, my_socket_address, dot[1], dependencies)
+                replicated_metadata = vector_clock.to_dict()
+                update_data = {'value': value, 'causal-metadata': replicated_metadata}
+                if dependencies:
+                    update_data['dependencies'] = dependencies
+                updates.append(('PUT', key, update_data))
+                migrations.append(get_live_migration('PUT', key, replicated_metadata, value, dot, dependencies))
+                results[i] = {'key': key, 'status': status_code, 'result': 'replaced' if status_code == 200 else 'created'}
+            else: # method == DELETE
+                if key not in key_value_store:
+                    results[i] = {'key': key, 'status': 404, 'error': 'Key does not exist'}
+                    continue
+                dot = (my_socket_address, update_vector_clock())
+                store_delete(key, dot)
+                record_update('DELETE', key, None, my_socket_address, dot[1])
+                replicated_metadata = vector_clock.to_dict()
+                updates.append(('DELETE', key, {'causal-metadata': replicated_metadata}))
+                migrations.append(get_live_migration('DELETE', key, replicated_metadata, dot=dot))
+                results[i] = {'key': key, 'status': 200, 'result': 'deleted'}
+        if len(updates) > 0:
+            persist_vector_clock()
+        metadata.append(vector_clock.to_dict())
+
+    # Replicate every write in one request per replica, then send the new owners their copies if a reshard is in progress
+    broadcast_kvs_batch(updates)
+    for chunk, recipients in migrations:
+        migrate_live_update(chunk, recipients)
+    return moved
+
+# This function will send the operations of a batch to their shard groups ({shard id: indexes}) at the same time
+# Each shard group gets a sub-batch at its least loaded replica (see get_forwarding_order), the ones that fail are tried at the next replica
+# Fills in their results & returns the causal-metadata of every shard group that answered
+def scatter_batch(operations, groups, targets, causal_metadata, hops, results):
+    headers = add_trace_header({'Forwarded-Hops': str(hops + 1), 'Routing-Epoch': str(routing_epoch)})
+    orders = {shard_id: get_forwarding_order(targets[shard_id]) for shard_id in groups}
+    pending = list(groups.keys())
+    metadata = []
+    deadline = time.time() + FORWARD_TIMEOUT
+
+    while len(pending) > 0 and time.time() < deadline:
+        calls = []
+        sent = []
+        for shard_id in pending:
+            if len(orders[shard_id]) == 0:
+                continue
+            replica = orders[shard_id].pop(0)
+            data = {'operations': [operations[i] for i in groups[shard_id]], 'causal-metadata': causal_metadata}
+            calls.append(('PUT', f"http://{replica}/kvs-batch", {'json': data, 'headers': headers, 'timeout': deadline - time.time()}))
+            sent.append((shard_id, replica))
+        if len(calls) == 0:
+            break
+
+        with forwarding_lock:
+            for _, replica in sent:
+                forwarding_outstanding[replica] = forwarding_outstanding.get(replica, 0) + 1
+        pending = []
+        timings = []
+        responses = fan_out(calls, timings=timings)
+        trace_fan_out('forward', [replica for _, replica in sent], responses, timings)
+        for (shard_id, replica), response in zip(sent, responses):
+            record_forwarding_result(replica, not isinstance(response, Exception))
+            if isinstance(response, Exception):
+                print(f'Forwarding a batch failed, could not connect to {replica}: {response}')
+                pending.append(shard_id)
+                continue
+
+            # Copy the sub-batch's results back into place
+            body = response.json() if response.headers.get('Content-Type', '').startswith('application/json') else {}
+            for j, i in enumerate(groups[shard_id]):
+                if response.status_code == 200:
+                    results[i] = body['results'][j]
+                else:
+                    results[i] = {'key': operations[i]['key'], 'status': response.status_code, 'error': body.get('error', response.text)}
+            if 'causal-metadata' in body:
+                metadata.append(body['causal-metadata'])
+
+    # Nobody in these shard groups answered
+    for shard_id in pending:
+        for i in groups[shard_id]:
+            results[i] = {'key': operations[i]['key'], 'status': 503, 'error': 'All replicas failed to respond'}
+    return metadata
+
+# This function will merge the causal-metadata returned for the parts of a batch into one (the entry-wise max, replicas in my view only)
+def merge_batch_metadata(metadata):
+    merged = {}
+    for clock in metadata:
+        for address, counter in (clock or {}).items():
+            if counter > merged.get(address, 0) and address in view_list:
+                merged[address] = counter
+    return merged
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                     /export & /import endpoints
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint streams key:value pairs as NDJSON (one {"key": k, "value": v} per line)
+# ?scope=shard (default) streams my shard group's keys, ?scope=cluster streams every shard group's keys, one shard group after another
+# NOTE: the response is built while it is sent, so memory stays bounded by EXPORT_CHUNK_SIZE lines (never the whole kvs)
+@app.route('/export', methods=['GET'])
+def export_kvs():
+    scope = request.args.get('scope', 'shard')
+    if scope == 'shard':
+        return Response(stream_shard_export(), mimetype='application/x-ndjson')
+    elif scope == 'cluster':
+        return Response(stream_cluster_export(), mimetype='application/x-ndjson')
+    return make_response(jsonify({'error': 'scope must be shard or cluster'}), 400)
+
+# This endpoint loads NDJSON key:value pairs (the format of /export) into the cluster, every key goes to the shard group that owns it
+# The lines are read as they arrive & run IMPORT_BATCH_SIZE at a time as a batch (see /kvs-batch), so memory stays bounded by one batch
+# Returns how many pairs were imported, how many failed (with the first errors) & causal-metadata covering the imported writes
+# NOTE: imported writes have no causal dependencies, a key should appear on one line only
+@app.route('/import', methods=['PUT'])
+def import_kvs():
+    imported = 0
+    failed = 0
+    errors = []
+    metadata = []
+    operations = []
+    lines = []
+
+    # This function will run the pairs read so far as one batch
+    def flush():
+        nonlocal imported, failed
+        results, batch_metadata = run_batch(operations, None)
+        metadata.append(merge_batch_metadata(batch_metadata))
+        for number, result in zip(lines, results):
+            if result['status'] in (200, 201):
+                imported += 1
+            else:
+                failed += 1
+                errors.append(f"line {number}: {result.get('error')}")
+        operations.clear()
+        lines.clear()
+
+    for number, line in enumerate(request.stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            failed += 1
+            errors.append(f"line {number}: not valid JSON")
+            continue
+        if not isinstance(record, dict) or 'key' not in record or 'value' not in record:
+            failed += 1
+            errors.append(f"line {number}: {record.get('error', 'missing key or value') if isinstance(record, dict) else 'missing key or value'}")
+            continue
+        operations.append({'method': 'PUT', 'key': record['key'], 'value': record['value']})
+        lines.append(number)
+        if len(operations) >= IMPORT_BATCH_SIZE:
+            flush()
+    if len(operations) > 0:
+        flush()
+
+    return make_response(jsonify({'imported': imported, 'failed': failed, 'errors': errors[:10], 'causal-metadata': merge_batch_metadata(metadata)}), 200)
+
+# This function streams my shard group's key:value pairs as NDJSON, EXPORT_CHUNK_SIZE lines at a time
+def stream_shard_export():
+    # Walk over the key index a chunk at a time, never a copy of the whole key list (keys come out in order)
+    for keys in walk_key_index(EXPORT_CHUNK_SIZE):
+        chunk = []
+        for key in keys:
+            value = key_value_store.get(key, MISSING_VALUE)
+            if value is MISSING_VALUE:
+                continue
+            chunk.append(json.dumps({'key': key, 'value': value}))
+        if len(chunk) > 0:
+            yield '\n'.join(chunk) + '\n'
+
+# This function streams every shard group's key:value pairs as NDJSON, mine from memory & the others from one of their replicas
+# NOTE: a shard group that can't be exported ends the stream with a {"error": ...} line (the 200 status was already sent)
+def stream_cluster_export():
+    for shard_id in sorted(shard_groups.keys()):
+        if shard_id == shard_number and not joining_shard:
+            yield from stream_shard_export()
+            continue
+        replicas = [replica for replica in shard_groups[shard_id] if replica != my_socket_address]
+        if not (yield from stream_remote_export(replicas)):
+            print(f"Unable to export shard {shard_id}")
+            yield json.dumps({'error': f"Shard {shard_id} could not be exported"}) + '\n'
+            return
+
+# This function streams one shard group's export from the first of its replicas that answers
+# Returns False if none of them could stream the whole export
+# NOTE: a stream holds its connection for as long as it runs, so it gets its own instead of a pooled one
+def stream_remote_export(replicas):
+    for replica in get_forwarding_order(replicas):
+        try:
+            response = requests.get(f"http://{replica}/export", params={'scope': 'shard'}, stream=True, timeout=FORWARD_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"Unable to start an export from {replica}: {e}")
+            continue
+        with response:
+            if response.status_code != 200:
+                continue
+            try:
+                for chunk in response.iter_content(chunk_size=65536):
+                    yield chunk
+            except requests.exceptions.RequestException as e:
+                # Part of the shard was already sent, another replica can't pick up where this one stopped
+                print(f"Export from {replica} stopped: {e}")
+                return False
+        return True
+    return False
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                           /scan endpoint
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint returns a page of keys in order: ?prefix=<p>&start=<first key>&end=<stop before>&limit=<n>&cursor=<next-cursor>&values=true
+# ?scope=cluster (default) merges the pages of every shard group, ?scope=shard only scans my shard group
+# Returns the keys (& their values with values=true) & the next-cursor to pass for the next page (null once the scan is done)
+# NOTE: scans are not causally checked, every shard group answers with what it has applied so far
+@app.route('/scan', methods=['GET'])
+def scan_kvs():
+    scope = request.args.get('scope', 'cluster')
+    if scope not in ('cluster', 'shard'):
+        return make_response(jsonify({'error': 'scope must be shard or cluster'}), 400)
+    try:
+        limit = int(request.args.get('limit', SCAN_DEFAULT_LIMIT))
+    except ValueError:
+        return make_response(jsonify({'error': 'limit must be an integer'}), 400)
+    if limit < 1 or limit > SCAN_MAX_LIMIT:
+        return make_response(jsonify({'error': f"limit must be between 1 and {SCAN_MAX_LIMIT}"}), 400)
+    with_values = request.args.get('values', 'false').lower() == 'true'
+    scan = {'prefix': request.args.get('prefix', ''), 'start': request.args.get('start', ''), 'end': request.args.get('end'), 'after': request.args.get('cursor')}
+
+    # One shard group, straight from my index
+    if scope == 'shard':
+        return make_response(jsonify(scan_local_index(scan, limit, with_values)), 200)
+
+    # Get a page from every shard group at the same time (mine from my index), then merge them in order & keep the first limit keys
+    # NOTE: every shard group's page holds its first limit keys, so the merged first limit keys are the cluster's first limit keys
+    pages = scan_shard_groups(scan, limit, with_values)
+    if pages is None:
+        return make_response(jsonify({'error': 'A shard group could not be scanned'}), 503)
+    return make_response(jsonify(merge_scan_pages(pages, limit, with_values)), 200)
+
+# This function will scan my index for a page of up to limit keys (& their values, if with_values)
+def scan_local_index(scan, limit, with_values):
+    with storage_lock:
+        keys = key_index.scan(scan['start'], scan['after'], scan['end'], scan['prefix'], limit)
+        values = [key_value_store[key] for key in keys] if with_values else None
+    return make_scan_page(keys, values, limit)
+
+# This function will merge the pages of every shard group ({shard id: page}) in key order into one page of up to limit keys
+# NOTE: while a reshard moves keys a key can be in two shard groups' pages, its entry from the group that owns it now is kept.
+# Entries are compared by key only (values of different types can't be ordered). A full page may run out before the merged one
+# fills up (its keys repeat other groups'), then the merged page stops at its last key & goes on from there with the next-cursor
+def merge_scan_pages(pages, limit, with_values):
+    ends = [page['keys'][-1] for page in pages.values() if page.get('next-cursor') is not None]
+    end = min(ends) if len(ends) > 0 else None
+    entries = heapq.merge(*[zip(page['keys'], page.get('values') or page['keys'], [shard_id] * len(page['keys'])) for shard_id, page in pages.items()], key=lambda item: item[0])
+
+    keys = []
+    values = []
+    for key, value, shard_id in entries:
+        if len(keys) > 0 and keys[-1] == key:
+            if shard_id == get_key_shard_desination(key):
+                values[-1] = value
+            continue
+        if len(keys) == limit or (end is not None and key > end):
+            break
+        keys.append(key)
+        values.append(value)
+
+    page = make_scan_page(keys, values if with_values else None, limit)
+    if end is not None and len(keys) > 0:
+        page['next-cursor'] = keys[-1]
+    return page
+
+# This function will make a page of a scan, a full page has a next-cursor (the scan may go on after its last key)
+def make_scan_page(keys, values, limit):
+    page = {'keys': keys, 'next-cursor': keys[-1] if len(keys) == limit else None}
+    if values is not None:
+        page['values'] = values
+    return page
+
+# This function will get a page of up to limit keys from every shard group, at the same time
+# Returns the pages by shard id, or None if a shard group could not be scanned by any of its replicas
+def scan_shard_groups(scan, limit, with_values):
+    params = {'scope': 'shard', 'limit': limit, 'prefix': scan['prefix'], 'start': scan['start'], 'values': str(with_values).lower()}
+    for name in ('end', 'after'):
+        if scan[name] is not None:
+            params['cursor' if name == 'after' else name] = scan[name]
+
+    # I don't have my shard's data yet, the rest of my shard group scans it
+    pages = {}
+    orders = {}
+    for shard_id, members in shard_groups.items():
+        if shard_id == shard_number and not joining_shard:
+            pages[shard_id] = scan_local_index(scan, limit, with_values)
+            continue
+        orders[shard_id] = get_forwarding_order([replica for replica in members if replica != my_socket_address])
+
+    # Ask one replica per shard group, the ones that fail are asked at the next replica
+    while len(orders) > 0:
+        calls = []
+        sent = []
+        for shard_id, order in orders.items():
+            if len(order) == 0:
+                return None
+            replica = order.pop(0)
+            calls.append(('GET', f"http://{replica}/scan", {'params': params, 'timeout': FORWARD_TIMEOUT}))
+            sent.append((shard_id, replica))
+        with forwarding_lock:
+            for _, replica in sent:
+                forwarding_outstanding[replica] = forwarding_outstanding.get(replica, 0) + 1
+        for (shard_id, replica), response in zip(sent, fan_out(calls)):
+            record_forwarding_result(replica, not isinstance(response, Exception))
+            if isinstance(response, Exception) or response.status_code != 200:
+                print(f"Unable to scan shard {shard_id} at {replica}: {response if isinstance(response, Exception) else response.status_code}")
+                continue
+            pages[shard_id] = response.json()
+            del orders[shard_id]
+    return pages
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                       /replicate-batch endpoint
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint accepts an ordered batch of kvs updates from a replica in my shard group
+@app.route('/replicate-batch', methods=['PUT'])
+def replicate_batch():
+    # Get data from json
+    data = request.get_json(silent=True)
+
+    # Check to see if data is correct
+    if data is None or 'updates' not in data:
+        return make_response(jsonify({'error': 'Bad request, missing updates'}), 400)
+
+    # Only replicas replicate
+    if 'Replica' not in request.headers:
+        return make_response(jsonify({'error': 'Bad request, missing Replica header'}), 400)
+
+    results = receive_replicated_batch(data.get('updates'), request.headers.get('Replica'))
+    return make_response(jsonify(results), 200)
+
+
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                       /anti-entropy endpoints
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint returns the hashes of some nodes of my Merkle tree (& my vc with the root)
+@app.route('/anti-entropy/tree', methods=['PUT'])
+def anti_entropy_tree():
+    # Get data from json
+    data = request.get_json(silent=True)
+
+    # Check to see if data is correct
+    if data is None or 'level' not in data or 'nodes' not in data:
+        return make_response(jsonify({'error': 'Bad request, missing level or nodes'}), 400)
+
+    # A replica I took out of the view has to rejoin first
+    if request.headers.get('Replica') not in view_list:
+        return make_response(jsonify({'error': 'Replica is not in my view'}), 404)
+
+    try:
+        level = int(data.get('level'))
+    except (ValueError, TypeError):
+        return make_response(jsonify({'error': 'Level must be an integer'}), 400)
+    if level < 0 or level > MERKLE_DEPTH:
+        return make_response(jsonify({'error': f'Level must be between 0 and {MERKLE_DEPTH}'}), 400)
+    nodes = data.get('nodes')
+    if not isinstance(nodes, list) or not all(isinstance(node, int) and 0 <= node < (1 << level) for node in nodes):
+        return make_response(jsonify({'error': f'Nodes must be a list of node numbers between 0 and {(1 << level) - 1}'}), 400)
+
+    # Take the vc first (not in the middle of a write), the tree covers at least the writes in it
+    with state_lock:
+        vc = get_known_clock()
+    return make_response(jsonify({'hashes': get_merkle_hashes(level, nodes), 'vc': vc}), 200)
+
+# This endpoint applies a peer's side of some buckets wherever its versions win & returns my side of them
+@app.route('/anti-entropy/buckets', methods=['PUT'])
+def anti_entropy_buckets():
+    # Get data from json
+    data = request.get_json(silent=True)
+
+    # Check to see if data is correct
+    if data is None or 'buckets' not in data or 'entries' not in data or 'vc' not in data:
+        return make_response(jsonify({'error': 'Bad request, missing buckets, entries or vc'}), 400)
+
+    if request.headers.get('Replica') not in view_list:
+        return make_response(jsonify({'error': 'Replica is not in my view'}), 404)
+
+    repaired = apply_bucket_entries(data.get('entries'), data.get('vc'), data.get('buckets'))
+    entries = get_bucket_entries(data.get('buckets'))
+    peer_clocks[request.headers.get('Replica')] = data.get('vc')
+
+    # Every bucket that didn't differ already had what their vc covers, the others do now
+    merge_vector_clocks(data.get('vc'))
+    persist_vector_clock()
+    drain_hold_back_queue()
+    if repaired > 0:
+        print(f"Anti-entropy from {request.headers.get('Replica')}: repaired {repaired} keys here")
+    return make_response(jsonify({'entries': entries}), 200)
+
+
 # ================================================================================================================
 # ----------------------------------------------------------------------------------------------------------------
 #                                       /shard/ids endpoint
@@ -552,6 +3354,27 @@ def get_shard_members(ID):
         return make_response(jsonify({'error': 'No such shard ID exists'}), 404)
 
 
+# ================================================================================================================
+# ----------------------------------------------------------------------------------------------------------------
+#                                      /shard/placement endpoint
+# ----------------------------------------------------------------------------------------------------------------
+# ================================================================================================================
+
+
+# This endpoint returns everything a client needs to route keys itself: the placement strategy, shard groups & routing epoch
+@app.route('/shard/placement', methods=['GET'])
+def get_placement():
+    with routing_lock:
+        placement = {'epoch': routing_epoch, 'strategy': PLACEMENT_STRATEGY, 'vnodes': PLACEMENT_VNODES, 'shard-count': shard_count, 'shard-groups': shard_groups}
+        return make_response(jsonify(placement), 200)
+
+# This function will tag every response with my routing epoch, so clients that cache routes know when a reshard changed them
+@app.after_request
+def add_routing_epoch(response):
+    response.headers['Routing-Epoch'] = str(routing_epoch)
+    return response
+
+
 # ================================================================================================================
 # ----------------------------------------------------------------------------------------------------------------
 #                                   /shard/key-count/<ID> endpoint
@@ -592,7 +3415,7 @@ def get_key_count_at_ID(ID):
                     url = f"http://{replica}/key-count"
 
                     # If you get a response from a single replica, break the for-loop
-                    response = requests.get(url, timeout=5)
+                    response = get_peer_session(replica).get(url, timeout=5)
                     
                     # Check that status code is 200
                     if response.status_code == 200:
@@ -607,18 +3430,12 @@ def get_key_count_at_ID(ID):
                         # Unexpected behavior from replica
                         continue
                 except requests.exceptions.RequestException as e:
-                    # Remove replica from view_list
-                    view_list.remove(replica)
-
                     # Add replica to down_replicas
                     down_replicas.append(replica)
                     continue
 
-    # Broadcast bad replicas
-    if len(down_replicas) > 0:
-        for replica in view_list:
-            if replica != my_socket_address:
-                broadcast_view('DELETE', replica)
+    # Take the bad replicas out of the view & gossip it
+    remove_down_replicas(down_replicas)
 
     # Return response
     return make_response(jsonify({'shard-key-count': size}), 200)
@@ -646,28 +3463,22 @@ def broadcast_add_member(shard_id, socket_address):
     # Create a list to hold replicas that are down
     down_replicas = []
 
-    # Broadcast to everyone in view list (skip yourself) to PUT /shard/add-member/<ID>
-    for replica in view_list[:]:
-        if replica != my_socket_address:
-            try:
-                data = {'socket-address': socket_address}
-                url = f"http://{replica}/shard/add-member/{shard_id}"
-                headers = {'Replica': my_socket_address}
-                response = requests.put(url, json=data, headers=headers, timeout=5)
-                if response.status_code == 200:
-                    continue
-                else:
-                    # unexpected behavior TODO: maybe raise an exception?????
-                    pass
-            except requests.exceptions.RequestException as e:
-                print(f"Unable to connect to {replica} ... error: {e}")
-                down_replicas.append(replica)
+    # Broadcast to everyone in view list (skip yourself) to PUT /shard/add-member/<ID>, all at the same time
+    # NOTE: the member's entry goes along, so a replica the gossip hasn't reached yet still has it in its view
+    data = {'socket-address': socket_address, 'member': get_member_entry(socket_address)}
+    headers = {'Replica': my_socket_address}
+    replicas = [replica for replica in view_list[:] if replica != my_socket_address]
+    responses = fan_out([('PUT', f"http://{replica}/shard/add-member/{shard_id}", {'json': data, 'headers': headers, 'timeout': 5}) for replica in replicas])
+    for replica, response in zip(replicas, responses):
+        if isinstance(response, Exception):
+            print(f"Unable to connect to {replica} ... error: {response}")
+            down_replicas.append(replica)
+        elif response.status_code != 200:
+            # unexpected behavior TODO: maybe raise an exception?????
+            pass
     
-    # Broadcast to everyone a replica is down
-    if len(down_replicas) > 0:
-        for replica in down_replicas:
-            if replica != my_socket_address:
-                broadcast_view('DELETE', replica)
+    # Take the replicas that are down out of the view & gossip it
+    remove_down_replicas(down_replicas)
 
 @app.route('/shard/add-member/<ID>', methods=['PUT'])
 def add_member(ID):
@@ -698,27 +3509,33 @@ def add_member(ID):
         return make_response(jsonify({'error': f'ID: {ID} does not exist in shard ids'}), 404)
     
     # Check if socket-address is in my view list
+    if isinstance(data.get('member'), dict):
+        merge_membership([data['member']])
     if new_socket_address not in view_list:
         print(f"{new_socket_address} is not in my view_list: {view_list}")
         return make_response(jsonify({'error': f'{new_socket_address} does not exist in my view'}), 404)
 
     # Add new_socket_address to shard_groups[ID] IF it's not already there
-    if new_socket_address not in shard_groups[ID]:
-        shard_groups[ID].append(new_socket_address)
-        print(f"Addinng {new_socket_address} to shard group {ID} ... shard_groups: {shard_groups}")
+    with routing_lock:
+        if new_socket_address not in shard_groups[ID]:
+            shard_groups[ID].append(new_socket_address)
+            persist_routing()
+            scope_vector_clock()
+            print(f"Addinng {new_socket_address} to shard group {ID} ... shard_groups: {shard_groups}")
 
     # Check if this request is from a client
     if 'Replica' not in request.headers:
         # Broadcast to everyone to add this replica to shard_groups[ID]
         broadcast_add_member(ID, new_socket_address)
 
-    # If ID is my shard group, send a PUT request to new_socket_address in /populate endpoint. Send KVS and VC
+    # If ID is my shard group, send a PUT request to new_socket_address in /populate endpoint
+    # NOTE: only the shard metadata is sent, the new member pulls the data from me in chunks (see join_shard)
     if ID == shard_number and new_socket_address != my_socket_address:
         try:
-            data = {'kvs': key_value_store, 'vc': vector_clock, 'shard-groups': shard_groups, 'shard-count': shard_count, 'shard-number':shard_number}
+            data = {'shard-groups': shard_groups, 'shard-count': shard_count, 'shard-number': shard_number, 'epoch': routing_epoch, 'source': my_socket_address}
             url = f"http://{new_socket_address}/populate"
             headers = {'Replica': my_socket_address}
-            response = requests.put(url, json=data, headers=headers, timeout=5)
+            response = get_peer_session(new_socket_address).put(url, json=data, headers=headers, timeout=5)
             if response.status_code != 200:
                 # Unexpected behavior TODO: maybe raise exception 
                 pass
@@ -733,52 +3550,217 @@ def add_member(ID):
 @app.route('/populate', methods=['PUT'])
 def populate():
     # if you get this route it means you're new and need the info for your shard group to participate
-    # NOTE: will need to send: shard-id, kvs & vc
+    # NOTE: only the shard metadata comes with it, the data is pulled from source in the background (see join_shard)
 
     # Get globals
-    global key_value_store, vector_clock, shard_groups, shard_count, shard_number
+    global shard_groups, shard_count, shard_number, routing_epoch, joining_shard, join_fresh_keys
 
     # Get data from request
-    data = request.get_json()
-
-    # Check that kvs is in data
-    if 'kvs' not in data:
-        make_response(jsonify({'error': 'Missing kvs in /populate route'}), 400)
+    data = request.get_json(silent=True)
 
-    # Update kvs
-    key_value_store = data.get('kvs')
+    # Check that shard-groups, shard-count, shard-number & source are in data
+    if data is None or 'shard-groups' not in data or 'shard-count' not in data or 'shard-number' not in data or 'source' not in data:
+        return make_response(jsonify({'error': 'Missing shard-groups, shard-count, shard-number or source in /populate route'}), 400)
 
-    # Check that vc is in data
-    if 'vc' not in data:
-        make_response(jsonify({'error': 'Missing vc in /populate route'}), 400)
+    # Every replica in the shard group sends this, only join once
+    with join_lock:
+        if joining_shard:
+            return make_response(jsonify({'result': 'Already joining'}), 200)
 
-    # Update vc
-    vector_clock = data.get('vc')
+        # Update shard_groups, shard_count, shard_number & routing_epoch
+        with routing_lock, state_lock:
+            shard_groups = {int(k): v for k, v in data.get('shard-groups').items()} # convert string to ints
+            shard_count = int(data.get('shard-count'))
+            shard_number = int(data.get('shard-number'))
+            routing_epoch = int(data.get('epoch', routing_epoch))
+            persist_routing()
+            scope_vector_clock()
 
-    # Check that shard-groups is in data
-    if 'shard-groups' not in data:
-        make_response(jsonify({'error': 'Missing shard-groups in /populate route'}), 400)
+            # From now on replicated updates are applied right away & the snapshot never overwrites them
+            joining_shard = True
+            join_fresh_keys = set()
 
-    # Update shard_groups
-    shard_groups = data.get('shard-groups')
+    threading.Thread(target=join_shard, args=(data.get('source'),), daemon=True).start()
 
-    # Check that shard-count is in data
-    if 'shard-count' not in data:
-        make_response(jsonify({'error': 'Missing shard-count in /populate route'}), 400)
+    # Make response 
+    print(f"Updated shard-count, and shard-groups from {request.headers.get('Replica')}, joining shard {shard_number}")
+    return make_response(jsonify({'result': f"Joining shard {shard_number} from {data.get('source')}"}))
+
+# This function pulls my shard's data from source in chunks, then replays the writes source logged meanwhile
+# Runs in the background, I'm live once it's done
+# NOTE: a failed attempt starts over (from the next member of my shard group) after a backoff of up to STARTUP_MAX_BACKOFF seconds,
+# for as long as I'm in the shard group, so a source that is down or forgot my snapshot never leaves me joining for good
+def join_shard(source):
+    # Get globals
+    global joining_shard
+
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        if attempt > 0:
+            count_metric('kvs_populate_retries_total', (('kind', 'snapshot'),))
+            time.sleep(min(2 ** (attempt - 1), STARTUP_MAX_BACKOFF))
+            if attempt % JOIN_ATTEMPTS == 0:
+                print(f"Unable to join shard {shard_number} after {attempt} attempts, still trying")
+
+        # I was taken out of the shard group (or it was resharded away) meanwhile, there is nothing to join anymore
+        members = shard_groups.get(shard_number, []) if shard_groups is not None else []
+        if my_socket_address not in members:
+            print(f"No longer in shard {shard_number}, stopped joining it")
+            with join_lock:
+                joining_shard = False
+            return
+        sources = [source] + [replica for replica in members if replica not in (source, my_socket_address)]
+        current = sources[attempt % len(sources)]
+        session = get_peer_session(current)
+        attempt += 1
+        try:
+            # Start a snapshot, source remembers its keys & where its update log was
+            response = session.put(f"http://{current}/populate/snapshot", timeout=JOIN_TIMEOUT)
+            if response.status_code != 200:
+                raise ValueError(f"{current} answered {response.status_code} to a snapshot")
+            snapshot = response.json()
+            snapshot_id = snapshot.get('snapshot')
+            seq = snapshot.get('seq')
+
+            # Pull the snapshot page by page
+            params = {'limit': JOIN_CHUNK_SIZE}
+            while params is not None:
+                response = session.get(f"http://{current}/populate/snapshot/{snapshot_id}", params=params, timeout=JOIN_TIMEOUT)
+                if response.status_code != 200:
+                    raise ValueError(f"{current} answered {response.status_code} to page {params.get('after')} of snapshot {snapshot_id}")
+                page = response.json()
+                versions = page.get('versions', {})
+                dependencies = page.get('dependencies', {})
+                with state_lock:
+                    for key, value in page.get('kvs').items():
+                        if key not in join_fresh_keys:
+                            store_put(key, value, versions.get(key), dependencies.get(key))
+                params = {'after': page.get('next'), 'limit': JOIN_CHUNK_SIZE} if page.get('next') is not None else None
+
+            # Replay the writes that arrived during the transfer
+            while True:
+                response = session.get(f"http://{current}/populate/log", params={'since': seq, 'limit': JOIN_CHUNK_SIZE}, timeout=JOIN_TIMEOUT)
+                if response.status_code == 410:
+                    raise ValueError(f"{current} no longer has updates after {seq}")
+                if response.status_code != 200:
+                    raise ValueError(f"{current} answered {response.status_code} to the update log after {seq}")
+                log = response.json()
+                with state_lock:
+                    for update in log.get('updates'):
+                        if update['key'] not in join_fresh_keys:
+                            dot = (update['origin'], update['counter'])
+                            if update['method'] == 'PUT':
+                                store_put(update['key'], update['value'], dot, update.get('dependencies'))
+                            else: # method == DELETE
+                                store_delete(update['key'], dot)
+                        seq = update['seq']
+                if len(log.get('updates')) == 0:
+                    break
+
+            # Caught up, take source's causal history & go live
+            merge_vector_clocks(log.get('vc'))
+            scope_vector_clock()
+            persist_vector_clock()
+            with join_lock:
+                joining_shard = False
+            drain_hold_back_queue()
+            request_snapshot()
+            observe_metric('kvs_populate_seconds', time.perf_counter() - started, (('kind', 'snapshot'),))
+            print(f"Joined shard {shard_number} from {current} with {len(key_value_store)} keys")
+            return
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Join attempt {attempt} from {current} failed: {e}")
+
+@app.route('/populate/snapshot', methods=['PUT'])
+def start_populate_snapshot():
+    # Get globals
+    global populate_snapshots, populate_snapshot_count
+
+    # Remember where the update log is, the pages then walk my key index in order (never a copy of the key list)
+    # NOTE: a write that lands in between is in the log after seq, so it gets replayed either way
+    with update_log_lock:
+        seq = update_log_seq
+    with storage_lock:
+        total = len(key_index)
+    with populate_snapshots_lock:
+        populate_snapshot_count += 1
+        snapshot_id = str(populate_snapshot_count)
+        populate_snapshots[snapshot_id] = {'created': time.time()}
+
+        # Forget snapshots nobody finished
+        for old_id in [i for i, snapshot in populate_snapshots.items() if time.time() - snapshot['created'] > JOIN_SNAPSHOT_TTL]:
+            del populate_snapshots[old_id]
+
+    return make_response(jsonify({'snapshot': snapshot_id, 'seq': seq, 'total': total}), 200)
+
+@app.route('/populate/snapshot/<snapshot_id>', methods=['GET'])
+def get_populate_snapshot_page(snapshot_id):
+    snapshot = populate_snapshots.get(snapshot_id)
+    if snapshot is None:
+        return make_response(jsonify({'error': 'No such snapshot'}), 404)
+
+    # Get the page, the limit keys after the cursor (the last key of the page before)
+    after = request.args.get('after')
+    limit = request.args.get('limit', JOIN_CHUNK_SIZE, type=int)
+    page = {}
+    versions = {}
+    dependencies = {}
+    with storage_lock:
+        keys = key_index.scan(after=after, limit=limit)
+    for key in keys:
+        if key in key_value_store:
+            page[key] = key_value_store[key]
+            versions[key] = key_versions.get(key)
+            if key in key_dependencies:
+                dependencies[key] = key_dependencies[key]
+
+    # Last page, forget the snapshot
+    next_cursor = keys[-1] if len(keys) == limit else None
+    if next_cursor is None:
+        with populate_snapshots_lock:
+            populate_snapshots.pop(snapshot_id, None)
+
+    return make_response(jsonify({'kvs': page, 'versions': versions, 'dependencies': dependencies, 'next': next_cursor}), 200)
+
+@app.route('/populate/log', methods=['GET'])
+def get_populate_log():
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', JOIN_CHUNK_SIZE, type=int)
+
+    # Take the vc first, it must not cover writes that are not in the updates
+    vc = get_known_clock()
+    updates = get_updates_since(since, limit)
+    if updates is None:
+        return make_response(jsonify({'error': f'Update log no longer goes back to {since}'}), 410)
+    return make_response(jsonify({'updates': updates, 'vc': vc}), 200)
+
+@app.route('/populate/catch-up', methods=['PUT'])
+def get_populate_catch_up():
+    # Get data from request
+    data = request.get_json(silent=True)
 
-    # Update shard_count
-    shard_count = data.get('shard-count')
+    # Check that vc is in data
+    if data is None or 'vc' not in data:
+        return make_response(jsonify({'error': 'Missing vc in /populate/catch-up route'}), 400)
+    their_vc = data.get('vc')
 
-    # Check that shard-number is in data
-    if 'shard-number' not in data:
-        make_response(jsonify({'error': 'Missing shard-count in /populate route'}), 400)
+    # Take the vc first, it must not cover writes that are not in the updates
+    vc = get_known_clock()
 
-    # Update shard_number
-    shard_number = data.get('shard-number')
+    # Every write coordinated in my shard group is numbered by its origin, find the ones they haven't seen
+    missing = {}
+    for replica in shard_groups[shard_number][:]:
+        if vc.get(replica, 0) > their_vc.get(replica, 0):
+            missing[replica] = vc.get(replica, 0) - their_vc.get(replica, 0)
+    with update_log_lock:
+        updates = [update for update in update_log if update['origin'] in missing and their_vc.get(update['origin'], 0) < update['counter'] <= vc.get(update['origin'], 0)]
 
-    # Make response 
-    print(f"Updated kvs, vc, shard-count, and shard-groups from {request.headers.get('Replica')}")
-    return make_response(jsonify({'result': f"Updated kvs & vc from {data.get('Replica')}"}))
+    # The log has to hold every one of them, otherwise they repair from my Merkle tree
+    for replica, count in missing.items():
+        if len([update for update in updates if update['origin'] == replica]) != count:
+            return make_response(jsonify({'error': f'Update log no longer has every write from {replica}'}), 410)
+    return make_response(jsonify({'updates': updates, 'vc': vc}), 200)
 
 
 # ================================================================================================================
@@ -816,128 +3798,377 @@ def reshard():
     if new_shard_count > max_shard_groups:
         return make_response(jsonify({"error": "Not enough nodes to provide fault tolerance with requested shard count"}),400)
 
+    # Only one reshard at a time
+    if pending_reshard is not None:
+        return make_response(jsonify({"error": "A reshard is already in progress"}), 409)
+
     # Proceed with resharding ....
     print(f"New shard count: {new_shard_count}")
-    start_reshard(new_shard_count)
+    if not start_reshard(new_shard_count):
+        return make_response(jsonify({"error": "Reshard failed, a shard group could not stream its keys"}), 503)
 
     # Make response
     return make_response(jsonify({"result": "resharded"}), 200)
 
+# This function coordinates an online reshard (the leader), every replica keeps serving requests the whole time:
+#   1. prepare: everyone learns the next routing epoch & starts sending writes to moving keys to their new owners too
+#   2. stream:  each old shard streams the keys that move straight to their new owners
+#   3. commit:  once the new owners caught up, everyone switches to the new routing epoch
+# NOTE: no key:value pairs go through the leader
+# Returns False (and cancels the reshard) if an old shard group could not stream its keys
 def start_reshard(new_shard_count):
     # Get globals 
-    global view_list, shard_groups, shard_count, shard_number, key_value_store
+    global view_list, shard_groups, shard_count
+
+    # Build the new shard groups (replicas stay in their group when they can)
+    new_shard_groups = rebalance_shard_groups(new_shard_count)
+    epoch = routing_epoch + 1
+    print(f"New shard groups in reshard (epoch {epoch}): {new_shard_groups}")
+
+    # Prepare everyone for the next routing epoch
+    started = time.perf_counter()
+    data = {'epoch': epoch, 'shard-groups': new_shard_groups, 'shard-count': new_shard_count}
+    send_reshard_phase('prepare', data)
+    observe_metric('kvs_reshard_seconds', time.perf_counter() - started, (('phase', 'prepare'),))
+
+    # Ask 1 replica of each old shard group to stream its moving keys, all shard groups at the same time
+    streamed = time.perf_counter()
+    futures = [replication_pool.submit(request_reshard_stream, i, new_shard_count, new_shard_groups) for i in range(shard_count)]
+    vcs = [future.result() for future in futures]
+    observe_metric('kvs_reshard_seconds', time.perf_counter() - streamed, (('phase', 'stream'),))
+    # Only commit once every old shard group confirmed each of its chunks was staged by every new owner, the old owners drop the keys
+    if any(vc is None for vc in vcs):
+        print(f"Aborting reshard to epoch {epoch}, shard groups {[i for i, vc in enumerate(vcs) if vc is None]} could not stream every key")
+        send_reshard_phase('abort', {'epoch': epoch})
+        count_metric('kvs_reshards_total', (('result', 'aborted'),))
+        return False
 
-    # Make a local kvs copy that holds the entire store
-    entire_kvs_copy = {}
+    # Everyone now holds the keys of their new shard group, switch everyone to the new routing epoch (with all of their causal histories)
+    committed = time.perf_counter()
+    reshard_vc = get_known_vector_clock()
+    reshard_vc.merge_many(vcs)
+    data['vc'] = reshard_vc.to_dict()
+    send_reshard_phase('commit', data)
+    observe_metric('kvs_reshard_seconds', time.perf_counter() - committed, (('phase', 'commit'),))
+    observe_metric('kvs_reshard_seconds', time.perf_counter() - started, (('phase', 'total'),))
+    count_metric('kvs_reshards_total', (('result', 'committed'),))
+    return True
 
-    # Try to contact at least 1 person from each shard
-    for i in range(shard_count):
-        print(f"Trying to contact someone in shard group: {i}")
-        for replica in shard_groups[i][:]:
-            if replica != my_socket_address:
-                try:
-                    # Get the kvs & vc from each shard
-                    url = f"http://{replica}/get-kvs-vc"
-                    response = requests.get(url)
-                    if response.status_code != 200:
-                        # Unexpected behavior
-                        continue
-                    else:
-                        # Get data
-                        data = response.json()
+# This function sends one reshard phase (prepare, commit or abort) to everyone in the view at the same time, myself included
+def send_reshard_phase(phase, data):
+    local = replication_pool.submit(apply_reshard_phase, phase, data)
+    replicas = [replica for replica in view_list[:] if replica != my_socket_address]
+    calls = []
+    for replica in replicas:
+        url = f"http://{replica}/reshard-sheep" if phase == 'commit' else f"http://{replica}/reshard/{phase}"
+        calls.append(('PUT', url, {'json': data, 'timeout': RESHARD_TIMEOUT}))
+    for replica, response in zip(replicas, fan_out(calls)):
+        if isinstance(response, Exception):
+            print(f'cannot send reshard {phase} to {replica}: {response}')
+        elif response.status_code != 200:
+            print(f"Unexpected behavior from {replica} on reshard {phase}, {response.status_code}")
+    local.result()
+
+# This function applies a reshard phase on this replica
+def apply_reshard_phase(phase, data):
+    # Get globals
+    global pending_reshard, reshard_staging, reshard_live_keys, reshard_live_vc
+
+    if phase == 'prepare':
+        new_shard_groups = {int(k): v for k, v in data.get('shard-groups').items()} # convert string to ints
+        pending_reshard = {'epoch': int(data.get('epoch')), 'shard-groups': new_shard_groups, 'shard-count': int(data.get('shard-count'))}
+
+        # Writes I coordinated before this point must reach my shard group before it streams, later ones go to the new owners too
+        wait_for_replication_flush(RESHARD_TIMEOUT)
+    elif phase == 'commit':
+        new_shard_groups = {int(k): v for k, v in data.get('shard-groups').items()} # convert string to ints
+        commit_reshard(new_shard_groups, int(data.get('shard-count')), data.get('vc'), int(data.get('epoch')))
+    else: # phase == abort
+        with state_lock:
+            pending_reshard = None
+            reshard_staging = {}
+            reshard_live_keys = set()
+            reshard_live_vc = VectorClock()
+
+# This function builds the chunk that sends a write I coordinated to the new owners of its key while a reshard is in progress
+# Returns the chunk & the replicas to send it to (None & [] when no reshard is in progress)
+# NOTE: callers hold state_lock with the write, so the reshard can't be committed in between & the write never gets lost
+# these are marked live, so an older copy of the key streamed by the reshard can't overwrite them
+def get_live_migration(method, key, causal_metadata, value=None, dot=None, dependencies=None):
+    reshard = pending_reshard
+    if reshard is None:
+        return None, []
+    destination = get_key_shard_desination(key, reshard['shard-count'])
+    old_members = set(shard_groups[shard_number])
+    recipients = [replica for replica in reshard['shard-groups'][destination] if replica not in old_members]
 
-                        # Check that kvs and vc is in data
-                        if 'kvs' not in data and 'vc' not in data:
-                            continue                #Unexpected behavior
+    if method == 'PUT':
+        chunk = {'kvs': {key: value}, 'versions': {key: dot}, 'dependencies': {key: dependencies} if dependencies else {}, 'live': True, 'epoch': reshard['epoch']}
+    else: # method == DELETE
+        chunk = {'kvs': {}, 'deleted': [key], 'versions': {key: dot}, 'live': True, 'epoch': reshard['epoch']}
+
+    # The leader collected everyone's vc before this write, the new members need mine to know about it
+    chunk['vc'] = causal_metadata
+    return chunk, recipients
+
+# This function sends a live write (see get_live_migration) to the new owners of its key
+def migrate_live_update(chunk, recipients):
+    futures = [reshard_stream_pool.submit(send_reshard_chunk, replica, chunk) for replica in recipients]
+    for future in futures:
+        future.result()
+
+# This function asks the replicas of an old shard group (one at a time, until one answers) to stream their moving keys
+# Returns that shard's vector clock, or None if nobody in the shard group could do it or a new owner did not take every chunk
+def request_reshard_stream(old_shard_id, new_shard_count, new_shard_groups):
+    data = {'shard-count': new_shard_count, 'shard-groups': new_shard_groups, 'old-shard-id': old_shard_id}
+
+    # Prefer streaming from myself, it saves a hop
+    members = sorted(shard_groups[old_shard_id], key=lambda replica: replica != my_socket_address)
+    for replica in members:
+        if replica == my_socket_address:
+            if stream_reshard_out(new_shard_count, new_shard_groups):
+                return get_known_clock()
+            print(f"Unable to stream shard {old_shard_id} in reshard, a new owner did not take every chunk")
+            return None
+        try:
+            url = f"http://{replica}/reshard/stream-out"
+            response = get_peer_session(replica).put(url, json=data, timeout=RESHARD_TIMEOUT)
+            if response.status_code == 200:
+                return response.json().get('vc')
+            print(f"Unexpected behavior from {replica} streaming shard {old_shard_id}: {response.status_code}")
+            # It streamed, but a new owner did not take every chunk (another member would stream to the same new owners)
+            if response.status_code == 503:
+                return None
+        except requests.exceptions.RequestException as e:
+            print(f'Unable to get {replica} to stream shard {old_shard_id} in reshard: {e}')
+    return None
 
-                        entire_kvs_copy.update(data.get('kvs'))
-                        merge_vector_clocks(data.get('vc'))
-                        break
-                except requests.exceptions.RequestException as e:
-                    print(f'Unable to get {replica} information in reshard: {e}')      #TODO: delete broadcast!!!!
+# This function streams the keys of my (old) shard group that move to another group, in chunks, to the replicas of that group
+# Returns whether every chunk was staged by every one of its recipients (the reshard must not be committed otherwise)
+# NOTE: replicas that were already in my shard group have these keys, so they are skipped
+def stream_reshard_out(new_shard_count, new_shard_groups):
+    # Get globals
+    global key_value_store
 
-    # Update shard_count
-    shard_count = new_shard_count
+    old_members = set(shard_groups[shard_number])
+    recipients = {i: [replica for replica in members if replica not in old_members] for i, members in new_shard_groups.items()}
+    chunks = {i: {'kvs': {}, 'versions': {}, 'dependencies': {}} for i in new_shard_groups}
+    futures = []
+    moved = 0
+
+    # Walk over the key index RESHARD_CHUNK_SIZE keys at a time, never a copy of the whole key list or the values
+    for keys in walk_key_index(RESHARD_CHUNK_SIZE):
+        for key in keys:
+            value = key_value_store.get(key, MISSING_VALUE)
+            if value is MISSING_VALUE:
+                continue
+            destination = get_key_shard_desination(key, new_shard_count)
+            if len(recipients[destination]) == 0:
+                continue
+            chunks[destination]['kvs'][key] = value
+            chunks[destination]['versions'][key] = key_versions.get(key)
+            if key in key_dependencies:
+                chunks[destination]['dependencies'][key] = key_dependencies[key]
+            moved += 1
+
+            # Chunk is full, send it to everyone in the new shard group
+            if len(chunks[destination]['kvs']) >= RESHARD_CHUNK_SIZE:
+                for replica in recipients[destination]:
+                    futures.append(reshard_stream_pool.submit(send_reshard_chunk, replica, chunks[destination]))
+                chunks[destination] = {'kvs': {}, 'versions': {}, 'dependencies': {}}
+
+                # Keep a bounded number of chunks in flight, stop at the first one a recipient never took
+                while len(futures) > 2 * RESHARD_STREAMS:
+                    if not futures.pop(0).result():
+                        for future in futures:
+                            future.result()
+                        return False
+
+    # Send what's left
+    for destination, chunk in chunks.items():
+        if len(chunk['kvs']) > 0:
+            for replica in recipients[destination]:
+                futures.append(reshard_stream_pool.submit(send_reshard_chunk, replica, chunk))
+    if not all([future.result() for future in futures]):
+        return False
+    print(f"Streamed {moved} keys out of shard {shard_number} for reshard")
+    return True
 
-    # Now parition the kvs into the new shard count
-    partitioned_kvs = []
+# This function sends one chunk of key:value pairs to a replica's reshard staging area
+# Returns whether the replica staged it (answered 200)
+# NOTE: a failed send is tried again, waiting REPLICATION_RETRY_BACKOFF seconds (doubling up to REPLICATION_RETRY_MAX_BACKOFF) in between,
+# until RESHARD_TIMEOUT seconds went by since the first try (staging the same chunk twice changes nothing)
+def send_reshard_chunk(replica, chunk):
+    if replica == my_socket_address:
+        stage_reshard_chunk(chunk)
+        return True
+    url = f"http://{replica}/reshard/stream-in"
+    headers = {'Replica': my_socket_address}
+    deadline = time.time() + RESHARD_TIMEOUT
+    backoff = REPLICATION_RETRY_BACKOFF
+    while True:
+        try:
+            response = get_peer_session(replica).put(url, json=chunk, headers=headers, timeout=max(deadline - time.time(), 0.1))
+            if response.status_code == 200:
+                return True
+            print(f"Unexpected behavior from {replica} receiving a reshard chunk: {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            print(f'cannot send reshard chunk to {replica}: {e}')
+        if time.time() + backoff >= deadline:
+            count_metric('kvs_reshard_chunk_failures_total', (('peer', replica),))
+            return False
+        time.sleep(backoff)
+        backoff = min(backoff * 2, REPLICATION_RETRY_MAX_BACKOFF)
+
+# This function holds a streamed chunk aside until the reshard is committed
+# Live writes always win over streamed copies, and a live write that shows up after the commit goes straight into the kvs
+def stage_reshard_chunk(chunk):
+    live = chunk.get('live', False)
+    deleted = chunk.get('deleted', [])
+    versions = chunk.get('versions', {})
+    dependencies = chunk.get('dependencies', {})
+
+    # The chunk is staged (or applied) atomically with respect to the commit
+    with state_lock:
+        # The reshard this write belongs to was already committed here
+        if live and int(chunk.get('epoch', 0)) <= routing_epoch:
+            for key, value in chunk.get('kvs').items():
+                store_put(key, value, versions.get(key), dependencies.get(key))
+            for key in deleted:
+                store_delete(key, versions.get(key))
+            merge_vector_clocks(chunk.get('vc'))
+            persist_vector_clock()
+            drain_hold_back_queue()
+            return
+
+        # Remember the writer's vc, it is merged when the reshard is committed
+        if live and chunk.get('vc') is not None:
+            reshard_live_vc.merge(chunk.get('vc'))
+
+        for key, value in chunk.get('kvs').items():
+            if live:
+                reshard_live_keys.add(key)
+            elif key in reshard_live_keys:
+                continue
+            reshard_staging[key] = (value, versions.get(key), dependencies.get(key))
+        for key in deleted:
+            reshard_live_keys.add(key)
+            reshard_staging[key] = (RESHARD_TOMBSTONE, versions.get(key), None)
+
+# This function switches this replica to the new shard groups & routing epoch
+# It drops the keys that moved away & adds the ones that were streamed in
+def commit_reshard(new_shard_groups, new_shard_count, vc, epoch):
+    # Get globals
+    global reshard_staging, reshard_live_keys, reshard_live_vc, pending_reshard, shard_groups, shard_count, shard_number, routing_epoch
+
+    # Nothing else changes the routing or causal state while switching
+    with routing_lock, state_lock:
+        # Already switched
+        if epoch <= routing_epoch:
+            return
+
+        shard_groups = new_shard_groups
+        shard_count = new_shard_count
+        shard_number = get_shard_number(my_socket_address)
+        routing_epoch = epoch
+        pending_reshard = None
+        persist_routing()
+
+        # Drop the keys (& tombstones) that are not mine anymore
+        for key in set(key_value_store.keys()) | set(key_versions.keys()):
+            if get_key_shard_desination(key) != shard_number:
+                store_drop(key)
+
+        # Add the keys that moved to me
+        # NOTE: a key I already have was replicated to me by a new shard group member that switched first, so it is newer than the streamed copy
+        staging = reshard_staging
+        reshard_staging = {}
+        reshard_live_keys = set()
+        for key, (value, dot, dependencies) in staging.items():
+            if key in key_versions:
+                continue
+            if value is RESHARD_TOMBSTONE:
+                store_delete(key, dot)
+            else:
+                store_put(key, value, dot, dependencies)
+
+        # Take everyone's causal history (& the writers' of the live writes), then keep only my (new) shard group's entries in my vc
+        live_vc = reshard_live_vc
+        reshard_live_vc = VectorClock()
+        merge_vector_clocks(vc, live_vc)
+        scope_vector_clock()
+        persist_vector_clock()
+        print(f"Reshard committed, epoch {routing_epoch}, shard-groups: {shard_groups}, shard number: {shard_number}")
+
+    threading.Thread(target=sync_clocks_after_reshard, daemon=True).start()
+
+# This function exchanges final vcs with my new shard group right after a reshard commit
+# NOTE: writes coordinated right before a commit advance the coordinator's vc entry even when their key went to another shard group,
+# the reshard vc was taken before them, so one anti-entropy round with each new peer (pushing my vc too) brings everyone up to date
+def sync_clocks_after_reshard():
+    for peer in [replica for replica in shard_groups.get(shard_number, []) if replica != my_socket_address]:
+        try:
+            run_anti_entropy(peer, push_vc=True)
+        except requests.exceptions.RequestException as e:
+            print(f"Unable to sync clocks with {peer} after the reshard: {e}")
 
-    # Initialize the partitioned kvs 
-    for i in range(new_shard_count):
-        partitioned_kvs.append({})  # Initialize an empty dictionary for each shard
-        print(f"Partitioned_kvs: {partitioned_kvs}")
+@app.route('/reshard/stream-out', methods=['PUT'])
+def reshard_stream_out():
+    # Get data
+    data = request.get_json(silent=True)
 
-    # Now iterate over the entire kvs and split data into the partitioned kvs
-    for key, value in entire_kvs_copy.items():
-        # Find out where this key:value will go 
-        key_shard_destination = get_key_shard_desination(key)
-        
-        # Insert into correct partition
-        partitioned_kvs[key_shard_destination][key] = value
+    # Check that shard-count & shard-groups are in data
+    if data is None or 'shard-count' not in data or 'shard-groups' not in data:
+        return make_response(jsonify({'error': 'Not all data is provided'}), 400)
 
-    
-    # Now partition the new shard groups
-    shard_groups.clear()
-    shard_groups = make_shard_groups()
-    print(f"View for new shard groups: {view_list}")
-    print(f"New shard groups in reshard: {shard_groups}")
+    new_shard_groups = {int(k): v for k, v in data.get('shard-groups').items()} # convert string to ints
+    if not stream_reshard_out(int(data.get('shard-count')), new_shard_groups):
+        return make_response(jsonify({'error': 'A new owner did not take every chunk of my shard'}), 503)
 
-    # Now send new info to each shard
-    for replica in view_list[:]:
-        if replica == my_socket_address:
-            # Update shard-number
-            # shard_number = view_list.index(my_socket_address) % shard_count 
-            shard_number = get_shard_number(my_socket_address)
+    # Return response with my vc, the leader needs it to merge everyone's history
+    return make_response(jsonify({'result': 'Streamed', 'vc': get_known_clock()}), 200)
 
-            # Update kvs
-            key_value_store = partitioned_kvs[shard_number]
-        else:
-            try:
-                # Find out what shard-group this replica is in 
-                # replica_shard_number = view_list.index(replica) % shard_count 
-                replica_shard_number = get_shard_number(replica)
-                url = f"http://{replica}/reshard-sheep"
-                data = {'kvs': partitioned_kvs[replica_shard_number], 'vc': vector_clock, 'shard-groups': shard_groups, 'shard-count': shard_count}
-                response = requests.put(url, json=data, timeout=10)
-                if response.status_code != 200:
-                    print(f"Unexpected behavior from {replica}, {response.status_code}")
-                    pass #TODO: unexpected behavior
-            except requests.exceptions.RequestException as e:
-                print(f'cannot send new data for reshard to {replica}: {e}')
-                #TODO: delete broadcast
+@app.route('/reshard/stream-in', methods=['PUT'])
+def reshard_stream_in():
+    # Get data
+    data = request.get_json(silent=True)
 
-@app.route('/reshard-sheep', methods=['PUT'])
-def sheep_reshard():
-    # Get globals
-    global vector_clock, key_value_store, shard_groups, shard_count, shard_number
+    # Check that kvs is in data
+    if data is None or 'kvs' not in data:
+        return make_response(jsonify({'error': 'Missing kvs in /reshard/stream-in route'}), 400)
+
+    # Hold the keys aside until the reshard is committed
+    stage_reshard_chunk(data)
+    return make_response(jsonify({'result': 'Staged'}), 200)
 
+@app.route('/reshard/prepare', methods=['PUT'])
+def reshard_prepare():
     # Get data
-    data =  request.get_json()
+    data = request.get_json(silent=True)
 
-    # Check that vc, kvs, shard-groups, shard-count is in data
-    if 'kvs' not in data or 'vc' not in data or 'shard-groups' not in data or 'shard-count' not in data:
+    # Check that epoch, shard-groups, shard-count is in data
+    if data is None or 'epoch' not in data or 'shard-groups' not in data or 'shard-count' not in data:
        return make_response(jsonify({'error': 'Not all data is provided'}), 400)
 
-    # Get new vc, kvs, shard-groups, shard-count & update
-    vector_clock.clear()
-    vector_clock = data.get('vc')
+    apply_reshard_phase('prepare', data)
+    return make_response(jsonify({'result': 'Prepared'}), 200)
 
-    key_value_store.clear()
-    key_value_store = data.get('kvs')
+@app.route('/reshard/abort', methods=['PUT'])
+def reshard_abort():
+    apply_reshard_phase('abort', request.get_json(silent=True))
+    return make_response(jsonify({'result': 'Aborted'}), 200)
 
-    shard_groups.clear()
-    shard_groups_str = data.get('shard-groups')
-    shard_groups = {int(k): v for k, v in shard_groups_str.items()} # convert string to ints
-    print(f"Shard-sheep, shard-groups: {shard_groups}")
+@app.route('/reshard-sheep', methods=['PUT'])
+def sheep_reshard():
+    # Get data
+    data =  request.get_json(silent=True)
 
-    shard_count_str = data.get('shard-count')             
-    shard_count = int(shard_count_str)
+    # Check that vc, epoch, shard-groups, shard-count is in data
+    if data is None or 'vc' not in data or 'epoch' not in data or 'shard-groups' not in data or 'shard-count' not in data:
+       return make_response(jsonify({'error': 'Not all data is provided'}), 400)
 
-    # Update shard-number & hash-ring
-    # shard_number = view_list.index(my_socket_address) % shard_count 
-    shard_number = get_shard_number(my_socket_address)
+    apply_reshard_phase('commit', data)
 
-    print(f"Shard sheep update: {shard_groups}")
     # Return response
     return make_response(jsonify({'result': 'Updated'}), 200)
 
@@ -946,7 +4177,7 @@ def get_kvs_vc():
     # Get globals
     global key_value_store, vector_clock
 
-    return make_response(jsonify({'kvs': key_value_store, 'vc': vector_clock}), 200)
+    return make_response(jsonify({'kvs': key_value_store, 'vc': vector_clock.to_dict()}), 200)
 
 
 # ================================================================================================================
@@ -974,15 +4205,242 @@ else:
     print("SHARD_COUNT environment variable is not set.")
     shard_count = None
 
+# Placement strategy that maps keys to shards: 'modulo' (md5 % shard count), 'jump' (jump consistent hash) or 'ring' (virtual-node ring)
+PLACEMENT_STRATEGY = os.getenv('PLACEMENT_STRATEGY', 'modulo').lower()
+PLACEMENT_VNODES = int(os.getenv('PLACEMENT_VNODES', '128'))
+
 # Create a view list to keep track of running replicas
 view_list = my_view.split(",") if my_view else []
 view_list.sort()
 
-# Create vector clock that has everyone in your view list
-vector_clock = {key: 0 for key in view_list}
+# Create the locks of the shared state (requests are served by many threads at once)
+# routing_lock: view list, shard groups, shard count & routing epoch changes
+# state_lock: vector clocks, hold-back queue & the kvs writes that go with them (dependency test + apply + merge happen as one)
+# NOTE: always taken in that order (then storage_lock), never held across a network call & never taken by reads
+routing_lock = threading.RLock()
+state_lock = threading.RLock()
+
+# Create the slot of each replica address in the vector clocks (& the address of each slot)
+clock_slots = {}
+clock_addresses = []
+clock_slots_lock = threading.Lock()
+
+# Create vector clock, it only gets (non-zero) entries for the replicas of my shard group
+vector_clock = VectorClock()
+
+# Create the clock of replicas that left my shard group (kept for duplicate checks & repairs, never sent to clients)
+departed_clock = VectorClock()
 
 # Create a key value store dictionary
-key_value_store = {} 
+key_value_store = {}
+MISSING_VALUE = object() 
+
+# Create the ordered index of the kvs' keys (for scans), with about INDEX_LOAD keys per sublist
+INDEX_LOAD = int(os.getenv('INDEX_LOAD', '512'))
+key_index = SortedKeyIndex()
+
+# Replication mode: 'sync' answers the client after every replica acknowledged (unless REPLICATION_HANDOFF_TIMEOUT is set), 'async' right after the local write
+REPLICATION_MODE = os.getenv('REPLICATION_MODE', 'sync').lower()
+
+# Replication tuning: per-peer timeout (seconds) & fan-out pool size
+REPLICATION_TIMEOUT = float(os.getenv('REPLICATION_TIMEOUT', '10'))
+
+# Async replication batching: max updates per batch & how long (seconds) a batch may wait to fill up
+REPLICATION_BATCH_SIZE = int(os.getenv('REPLICATION_BATCH_SIZE', '64'))
+REPLICATION_BATCH_WINDOW = float(os.getenv('REPLICATION_BATCH_WINDOW', '0'))
+REPLICATION_POOL_SIZE = int(os.getenv('REPLICATION_POOL_SIZE', '8'))
+
+# Seconds a sync broadcast waits on a replica before it hands the update over to the replica's outbound queue
+# NOTE: off (0) by default, a handed off update is acknowledged before that replica has it, so sync mode waits for the slowest
+REPLICATION_HANDOFF_TIMEOUT = float(os.getenv('REPLICATION_HANDOFF_TIMEOUT', '0'))
+
+# Seconds an outbound batch the replica rejected waits before it is sent again, doubling up to REPLICATION_RETRY_MAX_BACKOFF
+REPLICATION_RETRY_BACKOFF = float(os.getenv('REPLICATION_RETRY_BACKOFF', '0.1'))
+REPLICATION_RETRY_MAX_BACKOFF = 5
+
+# Create a bounded thread pool & keep-alive sessions for fanning out kvs updates to the shard group
+replication_pool = ThreadPoolExecutor(max_workers=REPLICATION_POOL_SIZE)
+peer_sessions = {}
+peer_sessions_lock = threading.Lock()
+
+# Network engine for calls to other replicas: 'threads' (requests sessions & a thread per call) or 'asyncio' (one event loop)
+NETWORK_ENGINE = os.getenv('NETWORK_ENGINE', 'threads').lower()
+
+# Seconds between checks of whether a fan-out can stop waiting on a replica (see fan_out)
+FAN_OUT_POLL_INTERVAL = 0.05
+
+# Metrics: histogram bucket bounds (seconds) & keys sampled to estimate the kvs size in bytes
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_SAMPLE_SIZE = 256
+
+# Tracing: share of client /kvs requests traced without a Trace-Id header (0 to 1)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+
+# Profiler: seconds between stack samples (by default) & the longest run /admin/profile allows
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_MAX_SECONDS = 60
+profile_lock = threading.Lock()
+
+# Create the counters ({(name, labels): value}) & histograms ({(name, labels): {'buckets', 'sum', 'count'}}) behind /metrics
+metric_counters = {}
+metric_histograms = {}
+metrics_lock = threading.Lock()
+
+# Create the per-replica fan-out pools of the threads engine ({replica: pool}, created on first use) & the pool gossip runs on,
+# & the event loop (started on first use) & keep-alive pools of the asyncio engine
+peer_pools = {}
+peer_pools_lock = threading.Lock()
+gossip_pool = ThreadPoolExecutor(max_workers=REPLICATION_POOL_SIZE)
+network_loop = None
+network_loop_lock = threading.Lock()
+network_connections = {}
+
+# Create the ordered outbound queues used by async replication: {replica: {'updates': deque, ...}}
+outbound_queues = {}
+outbound_queues_lock = threading.Lock()
+
+# Reshard tuning: keys per streamed chunk, chunks streamed at the same time & timeout (seconds) for reshard requests
+RESHARD_CHUNK_SIZE = int(os.getenv('RESHARD_CHUNK_SIZE', '500'))
+RESHARD_STREAMS = int(os.getenv('RESHARD_STREAMS', '4'))
+RESHARD_TIMEOUT = float(os.getenv('RESHARD_TIMEOUT', '60'))
+
+# Create the pool that streams reshard chunks & the staging area for keys streamed to me during a reshard
+# NOTE: reshard_live_keys holds keys written while the reshard runs, streamed (older) copies never overwrite them
+# NOTE: reshard_live_vc holds the writers' vcs of those writes, merged into my vc at commit
+reshard_stream_pool = ThreadPoolExecutor(max_workers=RESHARD_STREAMS)
+reshard_staging = {}
+reshard_live_keys = set()
+reshard_live_vc = VectorClock()
+RESHARD_TOMBSTONE = object()
+
+# Create the routing epoch (bumped by every reshard) & the reshard being prepared, if any
+routing_epoch = 0
+pending_reshard = None
+MAX_FORWARD_HOPS = int(os.getenv('MAX_FORWARD_HOPS', '3'))
+
+# Forwarding tuning: timeout (seconds) for a forwarded request, failures in a row that open a replica's circuit & how long (seconds) it stays open
+FORWARD_TIMEOUT = float(os.getenv('FORWARD_TIMEOUT', '30'))
+FORWARD_BREAKER_FAILURES = int(os.getenv('FORWARD_BREAKER_FAILURES', '3'))
+FORWARD_BREAKER_COOLDOWN = float(os.getenv('FORWARD_BREAKER_COOLDOWN', '5'))
+FORWARD_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length')
+
+# Bulk import/export tuning: key:value pairs per import batch & NDJSON lines per export chunk
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '500'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '500'))
+
+# Scan tuning: keys per page when no limit is given & the most a page may hold
+SCAN_DEFAULT_LIMIT = int(os.getenv('SCAN_DEFAULT_LIMIT', '100'))
+SCAN_MAX_LIMIT = int(os.getenv('SCAN_MAX_LIMIT', '1000'))
+
+# Create the count of requests I have outstanding at each replica & their circuit breakers: {replica: {'failures', 'open-until'}}
+forwarding_outstanding = {}
+forwarding_breakers = {}
+forwarding_lock = threading.Lock()
+
+# Create the count of sync kvs broadcasts still waiting on replicas
+inflight_broadcasts = 0
+inflight_broadcasts_done = threading.Condition()
+
+# Create the update log: the last UPDATE_LOG_SIZE writes I applied, numbered by update_log_seq
+UPDATE_LOG_SIZE = int(os.getenv('UPDATE_LOG_SIZE', '10000'))
+update_log = deque(maxlen=UPDATE_LOG_SIZE)
+update_log_seq = 0
+update_log_lock = threading.Lock()
+
+# Joining a shard group (/populate): keys per chunk, timeout (seconds) per request, catch-up rounds (& failed joins between log lines) & how long (seconds) a source keeps a snapshot
+JOIN_CHUNK_SIZE = int(os.getenv('JOIN_CHUNK_SIZE', '1000'))
+JOIN_TIMEOUT = float(os.getenv('JOIN_TIMEOUT', '30'))
+JOIN_ATTEMPTS = int(os.getenv('JOIN_ATTEMPTS', '5'))
+JOIN_SNAPSHOT_TTL = float(os.getenv('JOIN_SNAPSHOT_TTL', '600'))
+
+# Create the join state: whether I'm still pulling my shard's data & the keys replicated to me meanwhile
+joining_shard = False
+join_fresh_keys = set()
+join_lock = threading.Lock()
+
+# Create the snapshots I'm serving to joining replicas: {snapshot id: {'keys': [...], 'created': time}}
+populate_snapshots = {}
+populate_snapshot_count = 0
+populate_snapshots_lock = threading.Lock()
+
+# Create the hold-back queue for replicated updates that arrived before their dependencies: {sender: {counter: update}}
+hold_back_queue = {}
+
+# Anti-entropy: seconds between rounds with a random replica of my shard group (0 turns it off) & 2^MERKLE_DEPTH buckets in the Merkle tree
+ANTI_ENTROPY_INTERVAL = float(os.getenv('ANTI_ENTROPY_INTERVAL', '10'))
+MERKLE_DEPTH = int(os.getenv('MERKLE_DEPTH', '10'))
+MERKLE_LEVELS_PER_ROUND = 5
+
+# Failure detector: seconds between heartbeats (0 turns it off), replicas each one watches, phi above which a replica is taken out,
+# intervals remembered per replica, the smallest standard deviation (seconds) assumed & how long (seconds) a replica may pause
+# on top of its usual interval
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', '1'))
+HEARTBEAT_PEERS = int(os.getenv('HEARTBEAT_PEERS', '5'))
+PHI_THRESHOLD = float(os.getenv('PHI_THRESHOLD', '8'))
+PHI_WINDOW = int(os.getenv('PHI_WINDOW', '100'))
+PHI_MIN_DEVIATION = float(os.getenv('PHI_MIN_DEVIATION', '0.2'))
+PHI_ACCEPTABLE_PAUSE = float(os.getenv('PHI_ACCEPTABLE_PAUSE', '1'))
+
+# Largest heartbeat datagram (bytes), an answer piggybacks at most GOSSIP_MAX_UPDATES membership entries
+HEARTBEAT_MAX_BYTES = 65507
+
+# Create the heartbeat histories of the failure detector: {replica: {'intervals': deque, 'last': time}}
+heartbeat_histories = {}
+heartbeat_lock = threading.Lock()
+
+# Gossip membership: seconds between rounds (0 turns it off), replicas gossiped with per round, times log2(n) each update is sent,
+# most updates piggybacked on one message & rounds between whole-table exchanges
+GOSSIP_INTERVAL = float(os.getenv('GOSSIP_INTERVAL', '0.2'))
+GOSSIP_FANOUT = int(os.getenv('GOSSIP_FANOUT', '3'))
+GOSSIP_RETRANSMIT_MULT = int(os.getenv('GOSSIP_RETRANSMIT_MULT', '3'))
+GOSSIP_MAX_UPDATES = int(os.getenv('GOSSIP_MAX_UPDATES', '32'))
+GOSSIP_SYNC_ROUNDS = int(os.getenv('GOSSIP_SYNC_ROUNDS', '25'))
+
+# Create the membership table ({replica: {'status': 'alive' | 'dead', 'incarnation': n}}) & the updates still being gossiped ({replica: sends left})
+# NOTE: the rest of VIEW is only in my view_list, every replica's entry comes from its own gossip (one that never came up isn't spread)
+membership = {my_socket_address: {'status': 'alive', 'incarnation': 0}}
+gossip_queue = {}
+
+# Create the startup state: whether a replica answered my join & whether startup (join & catch-up) is done
+# NOTE: the join is tried again after GOSSIP_INTERVAL, doubling up to STARTUP_MAX_BACKOFF seconds
+view_joined = False
+startup_done = False
+STARTUP_MAX_BACKOFF = 5
+
+# Create the key versions ({key: (origin, counter)}, tombstones included) & the Merkle buckets: their hashes & their keys
+# key_dependencies holds the causal metadata outside my shard group that the last write to a key depended on
+key_versions = {}
+key_dependencies = {}
+merkle_leaves = [0] * (1 << MERKLE_DEPTH)
+merkle_bucket_keys = [set() for _ in range(1 << MERKLE_DEPTH)]
+
+# Create the set of keys whose version is a tombstone & the last vector clock each replica sent me in anti-entropy
+# NOTE: a tombstone every clock of my shard group covers is forgotten (see collect_tombstones)
+tombstone_keys = set()
+peer_clocks = {}
+
+# Durable storage: directory for the write-ahead log & snapshots (unset keeps the kvs in memory only),
+# whether the log is fsynced before a write is acknowledged & how many log records trigger a snapshot
+DATA_DIR = os.getenv('DATA_DIR')
+WAL_FSYNC = os.getenv('WAL_FSYNC', 'true').lower() != 'false'
+SNAPSHOT_EVERY = int(os.getenv('SNAPSHOT_EVERY', '100000'))
+SNAPSHOT_MAGIC = b'KVSSNAP1'
+
+# Create the storage state: storage_lock keeps the kvs & the log in the same order,
+# the wal writer picks up wal_pending & moves wal_durable up to the last record it fsynced (or sets wal_error if it can't)
+storage_lock = threading.Lock()
+wal_pending = []
+wal_appended = 0
+wal_durable = 0
+wal_error = None
+wal_cond = threading.Condition()
+wal_local = threading.local()
+wal_file = None
+wal_segment = 0
+wal_vector_clock = {}
+wal_records_since_snapshot = 0
+snapshot_state = None
+snapshot_lock = threading.Lock()
 
 # Create a shard group, this is the group that this repllica will be in
 if shard_count is not None:
@@ -999,16 +4457,33 @@ else:
     shard_number = None
     print(f"No shard_count, I'm not apart of any shard group yet ...")
 
+# Load whatever I had on disk before I went down
+recovered_from_disk = recover_from_disk() if DATA_DIR else False
+
 
 
 # ================================================================================================================
 # ----------------------------------------------------------------------------------------------------------------
-#                              INITIALIZE ON STARTUP (ONLY BROADCAST YOUR VIEW) 
+#                              INITIALIZE ON STARTUP (ONLY GOSSIP YOUR VIEW) 
 # ----------------------------------------------------------------------------------------------------------------
 # ================================================================================================================
 
 
-broadcast_view('PUT', my_socket_address)
+# Join the view (& catch up on the writes I missed if I restarted with my data) in the background, requests are served meanwhile
+threading.Thread(target=start_node, daemon=True).start()
+
+# Start comparing my shard's data with the rest of my shard group in the background
+if ANTI_ENTROPY_INTERVAL > 0:
+    threading.Thread(target=anti_entropy_loop, daemon=True).start()
+
+# Start gossiping membership changes
+if GOSSIP_INTERVAL > 0:
+    threading.Thread(target=gossip_loop, daemon=True).start()
+
+# Start answering heartbeats (whether I send any or not) & sending them, so down replicas are found before requests wait on them
+threading.Thread(target=heartbeat_listener, daemon=True).start()
+if HEARTBEAT_INTERVAL > 0:
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
 
 
 
@@ -0,0 +1,3 @@
+# Benchmark harness: N-node clusters of the app on localhost, a load generator & the scenarios measured with them
+from .cluster import LocalCluster
+from .workload import Workload, run_workload, summarize_latencies
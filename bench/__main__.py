@@ -0,0 +1,165 @@
+# Command line of the benchmark harness: python -m bench <scenario> [options] (see the README, (20) Benchmarks)
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from .cluster import LocalCluster, REPO_ROOT
+from .workload import Workload
+from .scenarios import run_throughput, run_reshard, run_add_member, run_failure
+
+
+# This function will add the options every scenario takes: the cluster & the workload
+def add_common_options(parser):
+    parser.add_argument('--nodes', type=int, default=6, help='replicas in the cluster')
+    parser.add_argument('--shards', type=int, default=2, help='shard groups in the cluster')
+    parser.add_argument('--base-port', type=int, default=9100, help='replicas listen on base-port + 1, + 2, ...')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='environment variable for every replica (repeatable)')
+    parser.add_argument('--data-dir', help='give every replica a DATA_DIR under this directory (durable storage)')
+    parser.add_argument('--log-dir', help='write each replica\'s log to <log-dir>/<port>.log')
+    parser.add_argument('--keys', type=int, default=10000, help='keys in the workload (all written once before it runs)')
+    parser.add_argument('--read-ratio', type=float, default=0.9, help='share of GETs, the rest are PUTs')
+    parser.add_argument('--key-skew', type=float, default=0.0, help='zipf exponent of key popularity (0 = uniform, 0.99 = typical hot keys)')
+    parser.add_argument('--value-size', type=int, default=100, help='characters per value')
+    parser.add_argument('--forward-ratio', type=float, default=0.0, help='share of requests sent outside the key\'s shard group (forwarded)')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds a client waits on a request')
+    parser.add_argument('--output', help='results file (default bench/results/<scenario>-<time>.json)')
+
+# This function will return the commit the benchmark ran on & whether app.py had changes on top of it
+def get_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', 'app.py'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+# This function will print the throughput & latency of a summary (or of each summary in a dict of them)
+def print_summaries(results, prefix=''):
+    for name, value in results.items():
+        if isinstance(value, dict) and 'p99' in value:
+            print(f"{prefix}{name:<20} {value['ok']:>8} ok  {value['throughput'] or 0:>10.1f}/s  p50 {value['p50']}ms  p99 {value['p99']}ms  p999 {value['p999']}ms")
+        elif isinstance(value, dict):
+            print_summaries(value, f"{prefix}{name} ")
+
+# This function will run a scenario on a new cluster & save its results
+def run_scenario(args):
+    env = dict(item.split('=', 1) for item in args.env)
+    workload = Workload(args.keys, args.read_ratio, args.key_skew, args.value_size, args.forward_ratio, args.concurrency, args.timeout)
+    cluster = LocalCluster(args.nodes, args.shards, args.base_port, env, log_dir=args.log_dir, data_root=args.data_dir)
+    commit, dirty = get_revision()
+    record = {
+        'scenario': args.scenario,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'app-modified': dirty,
+        'cluster': {'nodes': args.nodes, 'shards': args.shards, 'env': env, 'durable': args.data_dir is not None},
+        'workload': workload.to_dict(),
+    }
+
+    print(f"Starting {args.nodes} replicas in {args.shards} shard groups")
+    with cluster:
+        if args.scenario == 'throughput':
+            record['options'] = {'duration': args.duration, 'warmup': args.warmup}
+            record['results'] = run_throughput(cluster, workload, args.duration, args.warmup)
+        elif args.scenario == 'reshard':
+            record['options'] = {'to-shards': args.to_shards, 'fail-recipient': args.fail_recipient}
+            record['results'] = run_reshard(cluster, workload, args.to_shards, fail_recipient=args.fail_recipient)
+        elif args.scenario == 'add-member':
+            record['options'] = {'shard': args.shard}
+            record['results'] = run_add_member(cluster, workload, args.shard)
+        elif args.scenario == 'failure':
+            record['options'] = {'duration': args.duration, 'fail-at': args.fail_at, 'mode': args.mode, 'recover-after': args.recover_after}
+            record['results'] = run_failure(cluster, workload, args.duration, args.fail_at, mode=args.mode, recover_after=args.recover_after)
+
+    output = args.output or os.path.join(REPO_ROOT, 'bench', 'results', f"{args.scenario}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(record, file, indent=2)
+
+    scalars = {name: value for name, value in record['results'].items() if not isinstance(value, (dict, list))}
+    if len(scalars) > 0:
+        print(json.dumps(scalars))
+    print_summaries({name: value for name, value in record['results'].items() if name != 'timeline'})
+    print(f"Saved {output}")
+
+# This function will collect every summary of a results file by path: {'workload all': summary, ...}
+def get_summaries(results, prefix=''):
+    summaries = {}
+    for name, value in results.items():
+        if isinstance(value, dict) and 'p99' in value:
+            summaries[f"{prefix}{name}"] = value
+        elif isinstance(value, dict):
+            summaries.update(get_summaries(value, f"{prefix}{name} "))
+    return summaries
+
+# This function will compare a results file against a baseline: throughput, latency percentiles & the scenario's timings
+def compare_results(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+    if baseline['scenario'] != candidate['scenario']:
+        print(f"Warning: comparing a {baseline['scenario']} run with a {candidate['scenario']} run")
+    print(f"baseline {baseline['commit']} ({baseline['started']}) vs candidate {candidate['commit']} ({candidate['started']})")
+
+    def change(old, new):
+        if old is None or new is None:
+            return f"{old} -> {new}"
+        percent = f" ({(new - old) / old * 100:+.1f}%)" if old != 0 else ''
+        return f"{old} -> {new}{percent}"
+
+    for name, value in baseline['results'].items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(candidate['results'].get(name), (int, float)):
+            print(f"{name:<28} {change(value, candidate['results'][name])}")
+    old_summaries = get_summaries(baseline['results'])
+    new_summaries = get_summaries(candidate['results'])
+    for path in old_summaries:
+        if path not in new_summaries:
+            continue
+        print(path)
+        for metric in ('throughput', 'p50', 'p99', 'p999'):
+            print(f"    {metric:<24} {change(old_summaries[path][metric], new_summaries[path][metric])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Benchmarks of the key-value store on a localhost cluster')
+    scenarios = parser.add_subparsers(dest='scenario', required=True)
+
+    throughput = scenarios.add_parser('throughput', help='throughput & latency of a workload')
+    add_common_options(throughput)
+    throughput.add_argument('--duration', type=float, default=30, help='seconds measured')
+    throughput.add_argument('--warmup', type=float, default=5, help='seconds run before measuring')
+
+    reshard = scenarios.add_parser('reshard', help='reshard duration (& latency while it runs)')
+    add_common_options(reshard)
+    reshard.add_argument('--to-shards', type=int, required=True, help='shard groups to reshard to')
+    reshard.add_argument('--fail-recipient', action='store_true', help='crash a new owner of moving keys right before the reshard (it must abort & lose no key)')
+
+    add_member = scenarios.add_parser('add-member', help='time for a new replica to join a shard group (/populate)')
+    add_common_options(add_member)
+    add_member.add_argument('--shard', type=int, default=0, help='shard group the new replica joins')
+
+    failure = scenarios.add_parser('failure', help='latency while a replica fails')
+    add_common_options(failure)
+    failure.add_argument('--duration', type=float, default=30, help='seconds measured')
+    failure.add_argument('--fail-at', type=float, default=10, help='seconds into the run the last replica fails')
+    failure.add_argument('--mode', choices=('pause', 'kill'), default='pause', help='pause (hangs) or kill (crashes) the replica')
+    failure.add_argument('--recover-after', type=float, help='resume a paused replica this many seconds after it failed')
+
+    compare = scenarios.add_parser('compare', help='compare a results file against a baseline')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+
+    args = parser.parse_args(argv)
+    if args.scenario == 'compare':
+        compare_results(args)
+    else:
+        run_scenario(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
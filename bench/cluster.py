@@ -0,0 +1,116 @@
+# A cluster of the app on localhost ports: one gunicorn process per replica (no Docker), like the containers in the README
+import os
+import sys
+import signal
+import subprocess
+import time
+import requests
+
+# The repo root, where app.py is
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# This class starts, breaks & stops an N-node, S-shard cluster on 127.0.0.1
+# NOTE: every replica runs like the Dockerfile runs it (1 gunicorn worker, 8 threads) & logs to <log_dir>/<port>.log
+class LocalCluster:
+    def __init__(self, nodes, shards, base_port=9100, env=None, threads=8, log_dir=None, data_root=None, host='127.0.0.1'):
+        self.host = host
+        self.base_port = base_port
+        self.shards = shards
+        self.env = dict(env or {})
+        self.threads = threads
+        self.log_dir = log_dir
+        self.data_root = data_root
+        self.addresses = [f"{host}:{base_port + i}" for i in range(1, nodes + 1)]
+        self.processes = {}
+        self.session = requests.Session()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # This function will start a replica with the given view
+    def start_node(self, address, view, shards=None):
+        env = dict(os.environ)
+        env.update(self.env)
+        env.update({'SOCKET_ADDRESS': address, 'VIEW': ','.join(view), 'SHARD_COUNT': str(shards or self.shards)})
+        if self.data_root is not None:
+            env['DATA_DIR'] = os.path.join(self.data_root, address.split(':')[1])
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            log = open(os.path.join(self.log_dir, f"{address.split(':')[1]}.log"), 'a')
+        else:
+            log = subprocess.DEVNULL
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', f'--bind={address}', '--workers=1', f'--threads={self.threads}']
+        self.processes[address] = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    # This function will start every replica & wait until they are all ready
+    def start(self, timeout=60):
+        for address in self.addresses:
+            self.start_node(address, self.addresses)
+        self.wait_ready(self.addresses, timeout)
+
+    # This function will wait until every given replica answers GET /ready with 200
+    def wait_ready(self, addresses, timeout=60):
+        deadline = time.time() + timeout
+        pending = list(addresses)
+        while len(pending) > 0:
+            if time.time() > deadline:
+                raise RuntimeError(f"Replicas not ready after {timeout}s: {pending}")
+            for address in pending[:]:
+                process = self.processes.get(address)
+                if process is not None and process.poll() is not None:
+                    raise RuntimeError(f"Replica {address} exited with {process.returncode}")
+                try:
+                    if self.session.get(f"http://{address}/ready", timeout=1).status_code == 200:
+                        pending.remove(address)
+                except requests.exceptions.RequestException:
+                    pass
+            time.sleep(0.05)
+
+    # This function will start a new replica (in no shard group yet) that joins the view of the cluster & return its address
+    def add_node(self, timeout=60):
+        address = f"{self.host}:{self.base_port + len(self.addresses) + 1}"
+        self.addresses.append(address)
+        self.start_node(address, self.addresses)
+        self.wait_ready([address], timeout)
+        return address
+
+    # This function will send a signal to a replica's process group
+    def signal_node(self, address, signum):
+        process = self.processes[address]
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    # This function will hang a replica (it keeps its sockets open but never answers), like a stuck node
+    def pause_node(self, address):
+        self.signal_node(address, signal.SIGSTOP)
+
+    # This function will let a paused replica run again
+    def resume_node(self, address):
+        self.signal_node(address, signal.SIGCONT)
+
+    # This function will kill a replica, like a crashed node (its connections get refused)
+    def kill_node(self, address):
+        self.signal_node(address, signal.SIGKILL)
+        self.processes[address].wait()
+
+    # This function will stop every replica
+    def stop(self):
+        for address, process in self.processes.items():
+            if process.poll() is None:
+                self.signal_node(address, signal.SIGCONT)
+                self.signal_node(address, signal.SIGTERM)
+        deadline = time.time() + 10
+        for address, process in self.processes.items():
+            try:
+                process.wait(max(deadline - time.time(), 0.1))
+            except subprocess.TimeoutExpired:
+                self.signal_node(address, signal.SIGKILL)
+                process.wait()
+        self.processes = {}
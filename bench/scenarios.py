@@ -0,0 +1,193 @@
+# Benchmark scenarios: each one runs on a started LocalCluster & returns its results as a dict (saved as JSON by __main__)
+import random
+import threading
+import time
+import requests
+
+from .workload import Router, preload_keys, run_workload, summarize_workload, summarize_latencies, summarize_timeline
+
+
+# This function will read a metric from a replica's GET /metrics: {'label="value",...': value} ('' for no labels)
+def get_metric_values(address, name):
+    values = {}
+    text = requests.get(f"http://{address}/metrics", timeout=10).text
+    for line in text.splitlines():
+        if line.startswith('#') or not line.startswith(name):
+            continue
+        series, _, value = line.rpartition(' ')
+        if series == name:
+            values[''] = float(value)
+        elif series.startswith(name + '{'):
+            values[series[len(name) + 1:-1]] = float(value)
+    return values
+
+# This function will wait until a condition holds, checking every interval seconds
+# Returns the seconds it took, or None if it didn't hold within timeout
+def wait_until(condition, timeout, interval=0.05):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            if condition():
+                return round(time.perf_counter() - started, 3)
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(interval)
+    return None
+
+# This function will run a workload in the background until stop is set
+# Returns the thread & the list its samples go into once it ends
+def start_background_load(nodes, workload, metadata, stop, excluded=None):
+    samples = []
+    def run():
+        samples.extend(run_workload(nodes, workload, float('inf'), metadata, excluded, stop))
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, samples
+
+
+# This function will measure throughput & latency of a workload: warmup seconds first (not measured), then duration seconds
+def run_throughput(cluster, workload, duration, warmup=0):
+    metadata = preload_keys(cluster.addresses, workload)
+    if warmup > 0:
+        run_workload(cluster.addresses, workload, warmup, metadata)
+    samples = run_workload(cluster.addresses, workload, duration, metadata)
+    return {'workload': summarize_workload(samples, duration)}
+
+# This function will count the workload's keys that no replica (but the excluded ones) returns anymore
+# NOTE: an answer held back for causal dependencies (503) is asked again a few times before the key counts as missing
+def count_missing_keys(nodes, workload, metadata, excluded=(), attempts=5):
+    router = Router(nodes)
+    rng = random.Random(0)
+    session = requests.Session()
+    missing = 0
+    for rank in range(workload.keys):
+        key = f"bench-{rank}"
+        for _ in range(attempts):
+            replica, _ = router.pick_replica(key, False, rng, excluded)
+            response = session.get(f"http://{replica}/kvs/{key}", json={'causal-metadata': metadata}, timeout=10)
+            if response.status_code != 503:
+                break
+            time.sleep(0.1)
+        if response.status_code != 200:
+            missing += 1
+    return missing
+
+# This function will measure how long a reshard to new_shards shard groups takes (& each of its phases on the leader),
+# with the workload running the whole time (concurrency 0 reshards an idle cluster)
+# NOTE: with fail_recipient, the last replica (a new owner of moving keys, rebalancing moves the last members of the groups that
+# shrink) crashes right before the reshard. The reshard must then abort, & every key is read back afterwards to check none was lost
+def run_reshard(cluster, workload, new_shards, settle=1, fail_recipient=False):
+    metadata = preload_keys(cluster.addresses, workload)
+    leader = cluster.addresses[0]
+    excluded = set()
+    stop = threading.Event()
+    load = None
+    load_started = time.perf_counter()
+    if workload.concurrency > 0:
+        load = start_background_load(cluster.addresses, workload, metadata, stop, excluded)
+        time.sleep(settle)
+
+    victim = cluster.addresses[-1] if fail_recipient else None
+    if victim is not None:
+        excluded.add(victim)
+        cluster.kill_node(victim)
+
+    started = time.perf_counter()
+    response = requests.put(f"http://{leader}/shard/reshard", json={'shard-count': new_shards}, timeout=600)
+    seconds = time.perf_counter() - started
+    result = {'old-shards': cluster.shards, 'new-shards': new_shards, 'status': response.status_code, 'seconds': round(seconds, 3)}
+    result['phases'] = {labels.split('"')[1]: round(value, 3) for labels, value in get_metric_values(leader, 'kvs_reshard_seconds_sum').items()}
+
+    if load is not None:
+        time.sleep(settle)
+        stop.set()
+        load[0].join()
+        result['workload'] = summarize_workload(load[1], time.perf_counter() - load_started)
+        result['during-reshard'] = summarize_latencies([sample for sample in load[1] if settle <= sample[0] < settle + seconds], seconds)
+
+    if victim is not None:
+        result['failed-recipient'] = victim
+        result['aborted'] = response.status_code != 200
+        result['missing-keys'] = count_missing_keys([replica for replica in cluster.addresses if replica != victim], workload, metadata, excluded)
+    return result
+
+# This function will measure adding a new replica to a shard group: the /shard/add-member call & the time until the
+# new member pulled the shard (/populate) & is ready, with the workload running the whole time
+def run_add_member(cluster, workload, shard=0, settle=1, timeout=600):
+    metadata = preload_keys(cluster.addresses, workload)
+    stop = threading.Event()
+    load = None
+    load_started = time.perf_counter()
+    if workload.concurrency > 0:
+        load = start_background_load(cluster.addresses, workload, metadata, stop)
+        time.sleep(settle)
+
+    member = cluster.add_node()
+    started = time.perf_counter()
+    response = requests.put(f"http://{cluster.addresses[0]}/shard/add-member/{shard}", json={'socket-address': member}, timeout=60)
+    call_seconds = time.perf_counter() - started
+    def joined():
+        in_shard = requests.get(f"http://{member}/shard/node-shard-id", timeout=5).json().get('node-shard-id') == shard
+        return in_shard and requests.get(f"http://{member}/ready", timeout=5).status_code == 200
+    ready_seconds = wait_until(joined, timeout)
+    result = {'member': member, 'shard': shard, 'status': response.status_code, 'add-member-seconds': round(call_seconds, 3),
+              'ready-seconds': None if ready_seconds is None else round(call_seconds + ready_seconds, 3),
+              'populate-seconds': round(sum(get_metric_values(member, 'kvs_populate_seconds_sum').values()), 3),
+              'keys': requests.get(f"http://{member}/key-count", timeout=10).json()}
+
+    if load is not None:
+        time.sleep(settle)
+        stop.set()
+        load[0].join()
+        result['workload'] = summarize_workload(load[1], time.perf_counter() - load_started)
+    return result
+
+# This function will measure request latency while a replica fails: the workload runs for duration seconds & victim
+# is paused (hangs, mode 'pause') or killed (mode 'kill') at fail_at seconds, clients stop sending it requests right then
+# The samples are split into before the failure, until the failure detector took it out of the view & after that
+# NOTE: with recover_after, a paused victim is resumed that many seconds after the failure (it gets no client requests again)
+def run_failure(cluster, workload, duration, fail_at, victim=None, mode='pause', recover_after=None, window=1.0):
+    metadata = preload_keys(cluster.addresses, workload)
+    victim = victim or cluster.addresses[-1]
+    observer = next(replica for replica in cluster.addresses if replica != victim)
+    excluded = set()
+    events = {}
+
+    def fail():
+        time.sleep(fail_at)
+        excluded.add(victim)
+        started = time.perf_counter()
+        if mode == 'kill':
+            cluster.kill_node(victim)
+        else:
+            cluster.pause_node(victim)
+        def removed():
+            return victim not in requests.get(f"http://{observer}/view", timeout=5).json().get('view', [])
+        events['detected-after'] = wait_until(removed, duration)
+        if recover_after is not None and mode == 'pause':
+            time.sleep(max(recover_after - (time.perf_counter() - started), 0))
+            cluster.resume_node(victim)
+            events['resumed-after'] = round(time.perf_counter() - started, 3)
+            def back():
+                return victim in requests.get(f"http://{observer}/view", timeout=5).json().get('view', [])
+            rejoined = wait_until(back, duration)
+            events['rejoined-after-resume'] = rejoined
+
+    failer = threading.Thread(target=fail, daemon=True)
+    failer.start()
+    samples = run_workload(cluster.addresses, workload, duration, metadata, excluded)
+    failer.join()
+
+    detected = fail_at + (events.get('detected-after') or duration)
+    phases = {
+        'before': [sample for sample in samples if sample[0] < fail_at],
+        'detecting': [sample for sample in samples if fail_at <= sample[0] < detected],
+        'after': [sample for sample in samples if sample[0] >= detected],
+    }
+    spans = {'before': fail_at, 'detecting': detected - fail_at, 'after': max(duration - detected, 0)}
+    result = {'victim': victim, 'mode': mode, 'fail-at': fail_at}
+    result.update(events)
+    result['phases'] = {name: summarize_latencies(phase, spans[name]) for name, phase in phases.items()}
+    result['workload'] = summarize_workload(samples, duration)
+    result['timeline'] = summarize_timeline(samples, window)
+    return result
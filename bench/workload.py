@@ -0,0 +1,224 @@
+# Load generator: client threads sending a configurable mix of /kvs requests & recording the latency of each one
+import bisect
+import random
+import threading
+import time
+import requests
+
+from kvs_client.placement import get_key_shard
+
+
+# This class describes a workload
+# read_ratio: share of GETs (the rest are PUTs), key_skew: zipf exponent of key popularity (0 = uniform),
+# forward_ratio: share of requests sent to a replica outside the key's shard group (so they take a forwarding hop)
+class Workload:
+    def __init__(self, keys=10000, read_ratio=0.9, key_skew=0.0, value_size=100, forward_ratio=0.0, concurrency=16, timeout=10):
+        self.keys = keys
+        self.read_ratio = read_ratio
+        self.key_skew = key_skew
+        self.value_size = value_size
+        self.forward_ratio = forward_ratio
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        # Cumulative weights of a zipf distribution over the keys, a key is then picked with one binary search
+        self.cumulative = None
+        if key_skew > 0:
+            total = 0.0
+            self.cumulative = []
+            for rank in range(keys):
+                total += 1.0 / (rank + 1) ** key_skew
+                self.cumulative.append(total)
+
+    # This function will return the workload's settings (for the results file)
+    def to_dict(self):
+        return {'keys': self.keys, 'read-ratio': self.read_ratio, 'key-skew': self.key_skew, 'value-size': self.value_size,
+                'forward-ratio': self.forward_ratio, 'concurrency': self.concurrency, 'timeout': self.timeout}
+
+    # This function will pick a key by the workload's popularity
+    def pick_key(self, rng):
+        if self.cumulative is None:
+            rank = rng.randrange(self.keys)
+        else:
+            rank = min(bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1]), self.keys - 1)
+        return f"bench-{rank}"
+
+    # This function will make a value of value_size characters
+    def make_value(self, seq):
+        prefix = f"{seq}:"
+        return prefix + 'v' * max(self.value_size - len(prefix), 0)
+
+
+# This class follows the routing table of the cluster, to send a request to a replica inside (or outside) the key's shard group
+class Router:
+    def __init__(self, nodes, timeout=10):
+        self.nodes = list(nodes)
+        self.timeout = timeout
+        self.placement = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    # This function will fetch the routing table from any replica
+    def refresh(self):
+        for node in self.nodes:
+            try:
+                response = requests.get(f"http://{node}/shard/placement", timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                continue
+            if response.status_code == 200:
+                placement = response.json()
+                with self.lock:
+                    if self.placement is None or placement['epoch'] >= self.placement['epoch']:
+                        self.placement = placement
+                return
+        raise RuntimeError('No replica answered with the routing table')
+
+    # This function will check a response's Routing-Epoch & refresh the routing table if a reshard happened
+    def observe(self, response):
+        epoch = response.headers.get('Routing-Epoch')
+        if epoch is not None and int(epoch) > self.placement['epoch']:
+            try:
+                self.refresh()
+            except RuntimeError:
+                pass
+
+    # This function will pick the replica to send a request for a key to & whether it is 'local' (in the key's shard group) or 'forward'
+    # NOTE: replicas in excluded (e.g. a failed node) are never picked
+    def pick_replica(self, key, forward, rng, excluded=()):
+        placement = self.placement
+        shard = get_key_shard(key, placement['shard-count'], placement['strategy'], placement['vnodes'])
+        members = [replica for replica in placement['shard-groups'].get(str(shard), []) if replica not in excluded]
+        if forward:
+            others = [replica for replica in self.nodes if replica not in members and replica not in excluded]
+            if len(others) > 0:
+                return rng.choice(others), 'forward'
+        if len(members) == 0:
+            members = [replica for replica in self.nodes if replica not in excluded]
+        return rng.choice(members), 'local'
+
+
+# This function will merge causal-metadata from a response into a client's
+def merge_metadata(metadata, returned):
+    merged = dict(metadata or {})
+    for address, counter in (returned or {}).items():
+        if counter > merged.get(address, 0):
+            merged[address] = counter
+    return merged
+
+
+# This function will write every key of the workload once (with /kvs-batch, chunk keys at a time) before it runs
+# Returns the causal-metadata covering the writes
+def preload_keys(nodes, workload, chunk=500):
+    session = requests.Session()
+    metadata = None
+    for start in range(0, workload.keys, chunk):
+        operations = [{'method': 'PUT', 'key': f"bench-{i}", 'value': workload.make_value(i)} for i in range(start, min(start + chunk, workload.keys))]
+        response = session.put(f"http://{nodes[(start // chunk) % len(nodes)]}/kvs-batch", json={'operations': operations, 'causal-metadata': metadata}, timeout=120)
+        if response.status_code != 200:
+            raise RuntimeError(f"Preloading keys failed: {response.status_code} {response.text}")
+        metadata = merge_metadata(metadata, response.json().get('causal-metadata'))
+    return metadata
+
+
+# This function will run a workload against the cluster for the given seconds (or until stop is set)
+# Returns one sample per request: (seconds since the start, latency in seconds, method, 'local' or 'forward', status code or 'error')
+# NOTE: every client thread is its own causal client (it keeps its own causal-metadata), excluded can change while it runs
+def run_workload(nodes, workload, duration, metadata=None, excluded=None, stop=None, seed=None):
+    router = Router(nodes, workload.timeout)
+    excluded = excluded if excluded is not None else set()
+    stop = stop or threading.Event()
+    samples = []
+    samples_lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + duration
+
+    def client(index):
+        rng = random.Random(None if seed is None else seed + index)
+        session = requests.Session()
+        causal_metadata = metadata
+        own = []
+        seq = 0
+        while not stop.is_set() and time.perf_counter() < deadline:
+            key = workload.pick_key(rng)
+            method = 'GET' if rng.random() < workload.read_ratio else 'PUT'
+            replica, path = router.pick_replica(key, rng.random() < workload.forward_ratio, rng, excluded)
+            body = {'causal-metadata': causal_metadata}
+            if method == 'PUT':
+                seq += 1
+                body['value'] = workload.make_value(seq)
+            sent = time.perf_counter()
+            try:
+                response = session.request(method, f"http://{replica}/kvs/{key}", json=body, timeout=workload.timeout)
+                status = response.status_code
+            except requests.exceptions.RequestException:
+                response = None
+                status = 'error'
+            own.append((sent - started, time.perf_counter() - sent, method, path, status))
+
+            if response is not None:
+                router.observe(response)
+                if response.headers.get('Content-Type', '').startswith('application/json'):
+                    causal_metadata = merge_metadata(causal_metadata, response.json().get('causal-metadata'))
+        with samples_lock:
+            samples.extend(own)
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(workload.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    samples.sort(key=lambda sample: sample[0])
+    return samples
+
+
+# This function will return a percentile (nearest rank) of sorted values
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+# This function will summarize samples: counts, throughput & p50/p99/p999 latency (ms) of the requests that got an answer below 500
+def summarize_latencies(samples, seconds):
+    latencies = sorted(latency for _, latency, _, _, status in samples if status != 'error' and status < 500)
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample[4])] = statuses.get(str(sample[4]), 0) + 1
+    summary = {
+        'requests': len(samples),
+        'ok': len(latencies),
+        'statuses': statuses,
+        'throughput': round(len(latencies) / seconds, 2) if seconds > 0 else None,
+    }
+    for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(latencies, fraction)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    summary['max'] = round(latencies[-1] * 1000, 3) if len(latencies) > 0 else None
+    return summary
+
+
+# This function will summarize samples as a whole & by method, path & (method, path)
+def summarize_workload(samples, seconds):
+    summary = {'all': summarize_latencies(samples, seconds)}
+    groups = {}
+    for sample in samples:
+        groups.setdefault(sample[2], []).append(sample)
+        groups.setdefault(sample[3], []).append(sample)
+        groups.setdefault(f"{sample[2]} {sample[3]}", []).append(sample)
+    for name, group in sorted(groups.items()):
+        summary[name] = summarize_latencies(group, seconds)
+    return summary
+
+
+# This function will summarize samples in windows of the given seconds (by when the request was sent), to see latency change over time
+def summarize_timeline(samples, window=1.0):
+    windows = {}
+    for sample in samples:
+        windows.setdefault(int(sample[0] // window), []).append(sample)
+    timeline = []
+    # Windows where no request was sent (every client was stuck waiting) are kept, with no requests
+    for index in range(max(windows) + 1 if windows else 0):
+        summary = summarize_latencies(windows.get(index, []), window)
+        summary['start'] = round(index * window, 3)
+        timeline.append(summary)
+    return timeline
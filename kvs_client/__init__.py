@@ -0,0 +1,3 @@
+# Client library for the sharded key-value store
+from .client import KVSClient, KVSError, KeyNotFound
+from .placement import get_key_shard
@@ -0,0 +1,128 @@
+# Shard-aware client: caches the routing table & sends each key straight to a replica of its shard group (no forwarding hop)
+import random
+import threading
+import time
+import requests
+
+from .placement import get_key_shard
+
+
+# This exception is raised when the store answers a request with an error (or no replica answers at all)
+class KVSError(Exception):
+    def __init__(self, message, status_code=None, response=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = response
+
+# This exception is raised when a key does not exist
+class KeyNotFound(KVSError, KeyError):
+    pass
+
+# This class is a client of the key-value store
+# NOTE: it tracks causal-metadata for the caller, so every request sees the writes & reads the caller made before it
+class KVSClient:
+    def __init__(self, nodes, timeout=10, retries=3):
+        # nodes: socket addresses (ip:port) of any replicas, used to learn the routing table
+        self.nodes = list(nodes)
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        self.causal_metadata = None
+        self.placement = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    # This function will fetch the routing table (placement strategy, shard groups & routing epoch) from any replica
+    def refresh(self):
+        with self.lock:
+            known = self.nodes + [replica for members in (self.placement or {}).get('shard-groups', {}).values() for replica in members]
+        for node in dict.fromkeys(known):
+            try:
+                response = self.session.get(f"http://{node}/shard/placement", timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                continue
+            if response.status_code != 200:
+                continue
+            placement = response.json()
+            with self.lock:
+                # Never go back to an older routing epoch (a replica that hasn't heard of a reshard yet)
+                if self.placement is None or placement['epoch'] >= self.placement['epoch']:
+                    self.placement = placement
+            return
+        raise KVSError('No replica answered with the routing table')
+
+    # This function will return the shard group that owns a key, by the cached routing table
+    def get_shard(self, key):
+        placement = self.placement
+        return get_key_shard(key, placement['shard-count'], placement['strategy'], placement['vnodes'])
+
+    # This function will return the replicas of a key's shard group, in a random order to spread the load
+    def get_replicas(self, key):
+        members = self.placement['shard-groups'].get(str(self.get_shard(key)), [])
+        return random.sample(members, len(members))
+
+    # This function will merge causal-metadata from a response into the caller's
+    def merge_causal_metadata(self, causal_metadata):
+        with self.lock:
+            merged = dict(self.causal_metadata or {})
+            for address, counter in (causal_metadata or {}).items():
+                if counter > merged.get(address, 0):
+                    merged[address] = counter
+            self.causal_metadata = merged
+
+    # This function will send a request for a key to its shard group & return the response
+    # NOTE: a replica that can't be reached or is missing causal dependencies (503) is skipped for the next one in the group,
+    # if they all fail the routing table is refreshed & the request tried again after a short wait
+    def request(self, method, key, data=None):
+        response = None
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(0.1 * attempt)
+            for replica in self.get_replicas(key):
+                body = dict(data or {})
+                body['causal-metadata'] = self.causal_metadata
+                try:
+                    response = self.session.request(method, f"http://{replica}/kvs/{key}", json=body, timeout=self.timeout)
+                except requests.exceptions.RequestException:
+                    continue
+
+                # A newer routing epoch means a reshard moved keys, the replica still forwarded this request correctly
+                epoch = response.headers.get('Routing-Epoch')
+                if epoch is not None and int(epoch) > self.placement['epoch']:
+                    self.refresh()
+                if response.status_code == 503:
+                    continue
+
+                result = response.json() if response.headers.get('Content-Type', '').startswith('application/json') else {}
+                if 'causal-metadata' in result:
+                    self.merge_causal_metadata(result['causal-metadata'])
+                return response
+            self.refresh()
+
+        if response is None:
+            raise KVSError(f"No replica of shard {self.get_shard(key)} answered {method} {key}")
+        raise KVSError(f"{method} {key} failed: {response.text}", response.status_code, response)
+
+    # This function will return the value of a key (raises KeyNotFound if it does not exist)
+    def get(self, key):
+        response = self.request('GET', key)
+        if response.status_code == 404:
+            raise KeyNotFound(key, 404, response)
+        if response.status_code != 200:
+            raise KVSError(f"GET {key} failed: {response.text}", response.status_code, response)
+        return response.json()['value']
+
+    # This function will set the value of a key & return the result ('created' or 'replaced')
+    def put(self, key, value):
+        response = self.request('PUT', key, {'value': value})
+        if response.status_code not in (200, 201):
+            raise KVSError(f"PUT {key} failed: {response.text}", response.status_code, response)
+        return response.json()['result']
+
+    # This function will delete a key (raises KeyNotFound if it does not exist)
+    def delete(self, key):
+        response = self.request('DELETE', key)
+        if response.status_code == 404:
+            raise KeyNotFound(key, 404, response)
+        if response.status_code != 200:
+            raise KVSError(f"DELETE {key} failed: {response.text}", response.status_code, response)
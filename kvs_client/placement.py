@@ -0,0 +1,51 @@
+# Key-to-shard placement, shared by the replicas (app.py) & the client so both always agree on a key's shard group
+import hashlib
+import bisect
+
+# Create a cache of hash rings (one per shard count & virtual node count) for the ring placement strategy
+hash_rings = {}
+
+# This function will find the shard group that a key will be assigned to with the given placement strategy
+def get_key_shard(key, count, strategy='modulo', vnodes=128):
+    key_hash = int(hashlib.md5(key.encode()).hexdigest(), 16)
+
+    # Use the selected placement strategy
+    if strategy == 'jump':
+        return jump_consistent_hash(key_hash, count)
+    elif strategy == 'ring':
+        return ring_shard_lookup(key_hash, count, vnodes)
+    return hash(key_hash) % count
+
+# This function maps a key hash to one of count buckets with jump consistent hashing (Lamping & Veach)
+# NOTE: going from N to N+1 buckets only moves ~1/(N+1) of the keys, all of them into the new bucket
+def jump_consistent_hash(key_hash, count):
+    key = key_hash & 0xFFFFFFFFFFFFFFFF
+    bucket = -1
+    next_bucket = 0
+    while next_bucket < count:
+        bucket = next_bucket
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+# This function will build (once per shard count) a hash ring with vnodes virtual nodes per shard
+def get_hash_ring(count, vnodes):
+    ring = hash_rings.get((count, vnodes))
+    if ring is None:
+        points = []
+        for shard_id in range(count):
+            for vnode in range(vnodes):
+                point = int(hashlib.md5(f"{shard_id}-{vnode}".encode()).hexdigest(), 16) >> 64
+                points.append((point, shard_id))
+        points.sort()
+        ring = ([point for point, _ in points], [shard_id for _, shard_id in points])
+        hash_rings[(count, vnodes)] = ring
+    return ring
+
+# This function maps a key hash to the shard owning the first virtual node clockwise from it on the ring
+def ring_shard_lookup(key_hash, count, vnodes):
+    positions, owners = get_hash_ring(count, vnodes)
+    index = bisect.bisect_right(positions, key_hash >> 64)
+    if index == len(positions):
+        index = 0
+    return owners[index]
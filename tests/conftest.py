@@ -0,0 +1,8 @@
+# Shared setup for the unit tests: app.py reads its replica settings from the environment when it is imported,
+# so it gets a single-replica view (no shard group) & the repository root goes on the path for app & kvs_client
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SOCKET_ADDRESS', '127.0.0.1:18090')
+os.environ.setdefault('VIEW', os.environ['SOCKET_ADDRESS'])
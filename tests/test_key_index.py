@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+import app
+from app import SortedKeyIndex
+
+
+@pytest.fixture(autouse=True)
+def small_sublists(monkeypatch):
+    # Small sublists so a few hundred keys already split & empty them
+    monkeypatch.setattr(app, 'INDEX_LOAD', 4)
+
+
+def flatten(index):
+    return [key for sublist in index.lists for key in sublist]
+
+
+def test_keeps_keys_in_order_without_duplicates():
+    keys = [f"k{random.randrange(300):03d}" for _ in range(600)]
+    index = SortedKeyIndex()
+    for key in keys:
+        index.add(key)
+    assert flatten(index) == sorted(set(keys))
+    assert len(index) == len(set(keys))
+    assert index.maxes == [sublist[-1] for sublist in index.lists]
+    assert all(len(sublist) <= 2 * app.INDEX_LOAD for sublist in index.lists)
+
+
+def test_remove():
+    keys = [f"k{i:03d}" for i in range(100)]
+    index = SortedKeyIndex(keys)
+    removed = set(random.sample(keys, 60))
+    for key in removed:
+        index.remove(key)
+    index.remove('missing')
+    assert flatten(index) == [key for key in keys if key not in removed]
+    assert index.maxes == [sublist[-1] for sublist in index.lists]
+    for key in keys:
+        index.remove(key)
+    assert len(index) == 0 and index.scan() == []
+
+
+def test_scan_start_end_prefix_limit():
+    index = SortedKeyIndex(['a1', 'a2', 'a3', 'b1', 'b2', 'c1'])
+    assert index.scan(limit=4) == ['a1', 'a2', 'a3', 'b1']
+    assert index.scan(start='a2', limit=10) == ['a2', 'a3', 'b1', 'b2', 'c1']
+    assert index.scan(end='b2', limit=10) == ['a1', 'a2', 'a3', 'b1']
+    assert index.scan(prefix='b', limit=10) == ['b1', 'b2']
+    assert index.scan(prefix='b', start='a', limit=10) == ['b1', 'b2']
+    assert index.scan(after='a3', limit=10) == ['b1', 'b2', 'c1']
+    assert index.scan(after='a25', limit=10) == ['a3', 'b1', 'b2', 'c1']
+    assert index.scan(start='z', limit=10) == []
+
+
+def test_scan_cursor_pages_through_every_key_once():
+    keys = sorted(f"k{i:04d}" for i in range(257))
+    index = SortedKeyIndex(keys)
+    seen = []
+    after = None
+    while True:
+        page = index.scan(after=after, limit=10)
+        if len(page) == 0:
+            break
+        seen.extend(page)
+        after = page[-1]
+    assert seen == keys
+
+
+def test_walk_key_index(monkeypatch):
+    keys = [f"k{i:03d}" for i in range(95)]
+    monkeypatch.setattr(app, 'key_index', SortedKeyIndex(keys))
+    chunks = list(app.walk_key_index(10))
+    assert [len(chunk) for chunk in chunks] == [10] * 9 + [5]
+    assert [key for chunk in chunks for key in chunk] == keys
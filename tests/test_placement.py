@@ -0,0 +1,43 @@
+import pytest
+
+from kvs_client import placement
+from kvs_client.placement import get_key_shard
+
+STRATEGIES = ('modulo', 'jump', 'ring')
+KEYS = [f"key{i}" for i in range(2000)]
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_shard_is_in_range(strategy):
+    for count in range(1, 9):
+        assert all(0 <= get_key_shard(key, count, strategy) < count for key in KEYS)
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_shard_is_stable(strategy):
+    first = [get_key_shard(key, 4, strategy) for key in KEYS]
+    # A fresh hash ring must place keys the same way
+    placement.hash_rings.clear()
+    assert [get_key_shard(key, 4, strategy) for key in KEYS] == first
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_every_shard_gets_keys(strategy):
+    assert set(get_key_shard(key, 4, strategy) for key in KEYS) == {0, 1, 2, 3}
+
+
+def test_unknown_strategy_is_modulo():
+    assert [get_key_shard(key, 3, 'unknown') for key in KEYS] == [get_key_shard(key, 3) for key in KEYS]
+
+
+@pytest.mark.parametrize('strategy', ('jump', 'ring'))
+def test_growing_only_moves_keys_to_the_new_shard(strategy):
+    for count in range(1, 8):
+        moved = 0
+        for key in KEYS:
+            before, after = get_key_shard(key, count, strategy), get_key_shard(key, count + 1, strategy)
+            if before != after:
+                assert after == count
+                moved += 1
+        # About 1/(count + 1) of the keys move, far from the (count)/(count + 1) modulo moves
+        assert moved < 2 * len(KEYS) / (count + 1)
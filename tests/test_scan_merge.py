@@ -0,0 +1,88 @@
+import pytest
+
+import app
+from app import make_scan_page, merge_scan_pages
+
+
+@pytest.fixture(autouse=True)
+def two_shards(monkeypatch):
+    monkeypatch.setattr(app, 'shard_count', 2)
+    monkeypatch.setattr(app, 'PLACEMENT_STRATEGY', 'modulo')
+
+
+def page(keys, limit, values=None):
+    return make_scan_page(keys, values, limit)
+
+
+def test_merges_in_key_order():
+    pages = {0: page(['a', 'c', 'e'], 5), 1: page(['b', 'd'], 5)}
+    merged = merge_scan_pages(pages, 5, False)
+    assert merged == {'keys': ['a', 'b', 'c', 'd', 'e'], 'next-cursor': 'e'}
+
+
+def test_stops_at_limit():
+    pages = {0: page(['a', 'c', 'e'], 10), 1: page(['b', 'd', 'f'], 10)}
+    merged = merge_scan_pages(pages, 4, False)
+    assert merged['keys'] == ['a', 'b', 'c', 'd']
+    assert merged['next-cursor'] == 'd'
+
+
+def test_last_page_has_no_cursor():
+    pages = {0: page(['a'], 3), 1: page(['b'], 3)}
+    assert merge_scan_pages(pages, 3, False)['next-cursor'] is None
+
+
+def test_stops_where_a_full_page_ends():
+    # Shard 0 may have more keys after 'c', so nothing past it can be returned yet
+    pages = {0: page(['a', 'c'], 2), 1: page(['b', 'd', 'e'], 5)}
+    merged = merge_scan_pages(pages, 5, False)
+    assert merged['keys'] == ['a', 'b', 'c']
+    assert merged['next-cursor'] == 'c'
+
+
+def test_cursor_pages_through_every_key_once():
+    shards = {0: ['a', 'c', 'e', 'g', 'i'], 1: ['b', 'd', 'f', 'h']}
+    seen = []
+    after = None
+    while True:
+        pages = {}
+        for shard_id, keys in shards.items():
+            keys = [key for key in keys if after is None or key > after][:2]
+            pages[shard_id] = page(keys, 2)
+        merged = merge_scan_pages(pages, 2, False)
+        seen.extend(merged['keys'])
+        if merged['next-cursor'] is None:
+            break
+        after = merged['next-cursor']
+    assert seen == sorted(shards[0] + shards[1])
+
+
+def test_duplicate_key_keeps_the_owners_entry():
+    key = 'moving'
+    owner = app.get_key_shard_desination(key)
+    other = 1 - owner
+    for order in ((owner, other), (other, owner)):
+        pages = {shard_id: page([key], 5, [f"from {shard_id}"]) for shard_id in order}
+        merged = merge_scan_pages(pages, 5, True)
+        assert merged['keys'] == [key]
+        assert merged['values'] == [f"from {owner}"]
+
+
+def test_duplicate_keys_only_count_once_towards_the_limit():
+    pages = {0: page(['a', 'b', 'c'], 3, [1, 2, 3]), 1: page(['b', 'c', 'd'], 3, [2, 3, 4])}
+    merged = merge_scan_pages(pages, 3, True)
+    assert merged['keys'] == ['a', 'b', 'c']
+    assert merged['values'] == [1, 2, 3]
+    assert merged['next-cursor'] == 'c'
+
+
+def test_values_of_different_types():
+    pages = {0: page(['a', 'b'], 5, [1, {'x': 1}]), 1: page(['a', 'c'], 5, ['one', None])}
+    merged = merge_scan_pages(pages, 5, True)
+    assert merged['keys'] == ['a', 'b', 'c']
+    assert merged['values'][1:] == [{'x': 1}, None]
+
+
+def test_without_values():
+    pages = {0: page(['a'], 5, ['v']), 1: page(['b'], 5, ['w'])}
+    assert 'values' not in merge_scan_pages(pages, 5, False)
@@ -0,0 +1,68 @@
+from app import VectorClock
+
+
+def test_increment_set_get():
+    clock = VectorClock()
+    assert clock.get('vc-a') == 0
+    assert clock.increment('vc-a') == 1
+    assert clock.increment('vc-a') == 2
+    clock.set('vc-b', 5)
+    clock.advance('vc-b', 3)
+    assert clock.to_dict() == {'vc-a': 2, 'vc-b': 5}
+
+
+def test_to_dict_drops_zero_entries():
+    clock = VectorClock({'vc-a': 0, 'vc-b': 1})
+    assert clock.to_dict() == {'vc-b': 1}
+
+
+def test_merge_is_pointwise_max():
+    clock = VectorClock({'vc-a': 3, 'vc-b': 1})
+    clock.merge(VectorClock({'vc-b': 4, 'vc-c': 2}))
+    clock.merge({'vc-a': 1, 'vc-d': 7})
+    assert clock.to_dict() == {'vc-a': 3, 'vc-b': 4, 'vc-c': 2, 'vc-d': 7}
+
+
+def test_merge_many_matches_merge():
+    others = [VectorClock({'vc-a': 2}), {'vc-b': 3, 'vc-a': 1}, None, VectorClock({'vc-e': 1})]
+    many = VectorClock({'vc-c': 1})
+    many.merge_many(others)
+    one_by_one = VectorClock({'vc-c': 1})
+    for other in others:
+        if other:
+            one_by_one.merge(other)
+    assert many.to_dict() == one_by_one.to_dict()
+
+
+def test_copy_is_independent():
+    clock = VectorClock({'vc-a': 1})
+    copy = clock.copy()
+    copy.increment('vc-a')
+    assert clock.get('vc-a') == 1 and copy.get('vc-a') == 2
+
+
+def test_covers_another_clock():
+    clock = VectorClock({'vc-a': 3, 'vc-b': 1})
+    assert clock.covers(VectorClock({'vc-a': 2}))
+    assert clock.covers(VectorClock({'vc-a': 3, 'vc-b': 1}))
+    assert not clock.covers(VectorClock({'vc-b': 2}))
+    assert not VectorClock({'vc-a': 1}).covers(clock)
+    # A clock with more slots, all of them zero past mine, is still covered
+    assert VectorClock().covers(VectorClock({'vc-z': 0}))
+
+
+def test_covers_a_dict():
+    clock = VectorClock({'vc-a': 3})
+    assert clock.covers({'vc-a': 3})
+    assert not clock.covers({'vc-a': 4})
+    assert not clock.covers({'vc-new': 1})
+
+
+def test_covers_ignore_and_addresses():
+    clock = VectorClock({'vc-a': 1})
+    other = VectorClock({'vc-a': 1, 'vc-b': 5})
+    assert not clock.covers(other)
+    assert clock.covers(other, ignore='vc-b')
+    assert clock.covers({'vc-a': 1, 'vc-b': 5}, ignore='vc-b')
+    assert clock.covers(other, addresses=['vc-a'])
+    assert not clock.covers(other, addresses=['vc-a', 'vc-b'])